@@ -1,23 +1,250 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+import base64
+import csv
+import hashlib
+import io
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import click
+from flask import Flask, render_template, stream_template, request, redirect, url_for, session, flash, jsonify, Response, make_response
 import psycopg2
 import psycopg2.extras
 
+import assets
+import async_db
+import book_import
+import db
+import instrumentation
+import migrate
+import outbox_worker
+import partitions
+import plan_check
+import realtime
+import recommend
+import repository
+import suggest
+import swap_matcher
+from db import get_db_connection
+
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'  # change this
+db.init_app(app)
+instrumentation.init_app(app)
+async_db.init_app(app)
+assets.init_app(app)
+suggest.init_app(app)
 
 # -----------------------------
 # Helper Functions
 # -----------------------------
+class TTLCache:
+    """Small thread-safe in-process cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+# Unread counts are stored on users.unread_notifications (maintained by the
+# outbox worker) and cached briefly per worker, so rendering the navbar badge
+# never touches the notifications table
+app.config.setdefault('UNREAD_COUNT_TTL', float(os.environ.get('UNREAD_COUNT_TTL', 5)))
+unread_count_cache = TTLCache(app.config['UNREAD_COUNT_TTL'])
+
 def get_unread_notification_count(user_id):
     """Get count of unread notifications for a user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM notifications WHERE user_id=%s AND status='unread'", (user_id,))
-    count = cursor.fetchone()[0]
-    cursor.close()
-    conn.close()
+    count = unread_count_cache.get(user_id)
+    if count is None:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        row = repository.fetch_one(cursor, repository.UNREAD_COUNT, user_id=user_id)
+        cursor.close()
+        count = row[0] if row else 0
+        unread_count_cache.set(user_id, count)
     return count
 
+app.config.setdefault('OUTBOX_BATCH_SIZE', 500)
+app.config.setdefault('OUTBOX_MAX_ATTEMPTS', 5)
+
+def add_notification(cursor, user_id, type, content, key):
+    """Queue one notification; see add_notifications"""
+    add_notifications(cursor, [(user_id, type, content, key)])
+
+def add_notifications(cursor, notifications):
+    """Queue (user_id, type, content, idempotency_key) notifications in the
+    caller's transaction; the outbox worker (flask outbox-worker) delivers them"""
+    outbox_worker.enqueue(cursor, notifications)
+
+def fetch_independent(cursor, queries):
+    """Run repository statements that don't depend on each other: [(statement, params, 'all' | 'one')].
+
+    With DB_ASYNC on they run concurrently on the async pool (async_db.py),
+    each on its own connection to the server `cursor` is on: the primary, or
+    the replica this request was routed to, which already has the session's
+    writes. Reading from that same server, after whatever the caller read
+    first (a page's ETag version), the results are never older than it.
+    Otherwise, or if the replica stops answering, they run one after another
+    on `cursor`, as prepared statements. Returns the results in order.
+    """
+    if async_db.enabled():
+        replica = db.current_replica()
+        try:
+            runs = async_db.get_runner(replica.dsn if replica else None).run(
+                [(stmt.sql, params, fetch) for stmt, params, fetch in queries])
+        except async_db.Error:
+            if replica is None:
+                raise
+            app.logger.warning("Async queries on a replica failed; running them on the request's connection",
+                               exc_info=True)
+        else:
+            results = []
+            for (stmt, params, _), (result, elapsed) in zip(queries, runs):
+                instrumentation.record_query(stmt.sql, params, elapsed)
+                results.append(result)
+            return results
+    results = []
+    for stmt, params, fetch in queries:
+        repository.execute(cursor, stmt, params)
+        results.append(cursor.fetchone() if fetch == 'one' else cursor.fetchall())
+    return results
+
+def encode_cursor(position, row_id):
+    """Opaque keyset-pagination cursor for a (position, id) pair; position is a
+    timestamp or a number, depending on the sort order"""
+    raw = '%s|%d' % (position.isoformat() if isinstance(position, datetime) else position, row_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(token, parse_position=datetime.fromisoformat):
+    """Inverse of encode_cursor; returns None for a missing or malformed cursor"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        position, row_id = raw.split('|')
+        return parse_position(position), int(row_id)
+    except (ValueError, ArithmeticError):
+        return None
+
+app.config.setdefault('PAGE_SIZE', 20)
+app.config.setdefault('MAX_PAGE_SIZE', 100)
+
+def get_page_size():
+    """Page size from ?per_page=, clamped to 1..MAX_PAGE_SIZE"""
+    try:
+        per_page = int(request.args.get('per_page', app.config['PAGE_SIZE']))
+    except ValueError:
+        per_page = app.config['PAGE_SIZE']
+    return max(1, min(per_page, app.config['MAX_PAGE_SIZE']))
+
+def finite_decimal(value):
+    """Decimal(value), rejecting NaN and infinities with ValueError"""
+    number = Decimal(value)
+    if not number.is_finite():
+        raise ValueError("not a finite number: %r" % value)
+    return number
+
+def get_min_rating():
+    """Minimum average rating from ?min_rating= (1-5), or None for no filter"""
+    try:
+        min_rating = finite_decimal(request.args.get('min_rating') or '0')
+    except (ValueError, ArithmeticError):
+        return None
+    return min(min_rating, 5) if min_rating > 0 else None
+
+@app.template_global()
+def page_url(**overrides):
+    """URL of the current page with some query args replaced (None removes one)"""
+    args = request.args.to_dict()
+    args.update(overrides)
+    args = {k: str(v) for k, v in args.items() if v is not None}
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+# Opt-in: list pages send their HTML while it renders, reading rows through
+# server-side cursors STREAM_ITERSIZE at a time instead of all at once
+app.config.setdefault('STREAM_PAGES', os.environ.get('STREAM_PAGES', '').lower() in ('1', 'true', 'yes'))
+app.config.setdefault('STREAM_ITERSIZE', int(os.environ.get('STREAM_ITERSIZE', 200)))
+
+def render_page(template, **context):
+    """render_template, or with STREAM_PAGES on, a response that sends the page as it renders.
+
+    The request's connection stays checked out until the last byte is sent,
+    and the Server-Timing header only counts the queries run before then.
+    """
+    if not app.config['STREAM_PAGES']:
+        return render_template(template, **context)
+    return Response(stream_template(template, **context), headers={'X-Accel-Buffering': 'no'})
+
+class NextCursor:
+    """next_cursor of a streamed page, known once the template has looped over its rows"""
+
+    def __init__(self, rows, position, row_id):
+        self.rows = rows
+        self.position = position
+        self.row_id = row_id
+
+    def __bool__(self):
+        return self.rows.has_more
+
+    def __str__(self):
+        return encode_cursor(self.rows.last[self.position], self.rows.last[self.row_id])
+
+def _templates_version():
+    """Digest of the templates, so cached pages are revalidated after a deploy"""
+    folder = os.path.join(app.root_path, app.template_folder)
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name), 'rb') as f:
+            digest.update(name.encode() + b'\0' + f.read())
+    return digest.hexdigest()[:12]
+
+TEMPLATES_VERSION = _templates_version()
+
+def conditional_page(version, last_modified, render):
+    """Answer 304 Not Modified if the browser already has this version of the page.
+
+    `version` is whatever the page's content depends on (row timestamps,
+    counts, the viewer's own state); it is hashed with the viewer and the
+    templates into the ETag. Pages are personalised, so they are cached
+    privately and revalidated on every view: a repeat view costs one
+    version query and no rendering. A page with a pending flash message is
+    always rendered.
+    """
+    etag = hashlib.sha1(repr((TEMPLATES_VERSION, assets.version, session.get('user_id'), version)).encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag) and not session.get('_flashes'):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
 # Make notification count available to all templates
 @app.context_processor
 def inject_notification_count():
@@ -28,15 +255,29 @@ def inject_notification_count():
 # -----------------------------
 # Database Connection
 # -----------------------------
-def get_db_connection():
-    conn = psycopg2.connect(
-        host='localhost',
-        user='postgres',  # default PostgreSQL user
-        password='admin',  # change this to your PostgreSQL password
-        database='book_exchange',
-        port='5432'  # default PostgreSQL port
-    )
-    return conn
+# Connections come from a per-worker pool (see db.py). get_db_connection()
+# hands out the one connection checked out for the current request; it is
+# returned to the pool (and rolled back if left uncommitted) at teardown.
+# Settings: DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, DB_PORT, DB_POOL_MIN,
+# DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_AFTER (env or app.config).
+#
+# Views marked @db.read_only may be served from a streaming replica listed
+# in DB_REPLICAS. After a request writes on the primary, the session keeps
+# the primary's WAL position, and that user's reads only go to a replica
+# that has replayed past it (or to the primary), so they see their own writes.
+
+@app.route('/pool_stats')
+def pool_stats():
+    return jsonify(db.get_pool().stats())
+
+# Pooled connections time every statement (see instrumentation.py): each
+# response carries a Server-Timing header with the request's DB time and
+# query count, statements over SLOW_QUERY_MS are logged with the shape of
+# their parameters, and /metrics exposes this worker's counters.
+@app.route('/metrics')
+def metrics():
+    return Response(instrumentation.metrics.render(db.get_pool().stats()) + suggest.render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
 
 # -----------------------------
 # Home / Landing
@@ -70,7 +311,6 @@ def signup():
             return redirect(url_for('signup'))
         finally:
             cursor.close()
-            conn.close()
     
     return render_template('signup.html')
 
@@ -85,10 +325,8 @@ def login():
 
         conn = get_db_connection()
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute("SELECT * FROM users WHERE email=%s", (email,))
-        user = cursor.fetchone()
+        user = repository.fetch_one(cursor, repository.USER_BY_EMAIL, email=email)
         cursor.close()
-        conn.close()
 
         if user and user['password'] == password:
             session['user_id'] = user['user_id']
@@ -113,6 +351,7 @@ def logout():
 # Profile
 # -----------------------------
 @app.route('/profile')
+@db.read_only
 def profile():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -121,34 +360,23 @@ def profile():
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    # Fetch user info
-    cursor.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
-    user = cursor.fetchone()
-    
-    # Fetch user statistics
-    cursor.execute("SELECT COUNT(*) as total_books FROM books WHERE user_id=%s", (user_id,))
-    total_books = cursor.fetchone()['total_books']
-    
-    cursor.execute("SELECT COUNT(*) as total_swaps FROM swap_requests WHERE (sender_id=%s OR receiver_id=%s) AND status='accepted'", (user_id, user_id))
-    total_swaps = cursor.fetchone()['total_swaps']
-    
-    cursor.execute("SELECT AVG(rating)::NUMERIC(3,2) as avg_rating, COUNT(*) as total_reviews FROM reviews WHERE reviewed_id=%s", (user_id,))
-    review_stats = cursor.fetchone()
+    # User row and its precomputed stats (user_stats, kept current by triggers)
+    user = repository.fetch_one(cursor, repository.PROFILE, user_id=user_id)
     
     cursor.close()
-    conn.close()
     
     return render_template('profile.html', 
                          user=user, 
-                         total_books=total_books,
-                         total_swaps=total_swaps,
-                         avg_rating=review_stats['avg_rating'] or 0,
-                         total_reviews=review_stats['total_reviews'])
+                         total_books=user['total_books'],
+                         total_swaps=user['total_swaps'],
+                         avg_rating=user['avg_rating'] or 0,
+                         total_reviews=user['total_reviews'])
 
 # -----------------------------
 # Reviews Page
 # -----------------------------
 @app.route('/reviews')
+@db.read_only
 def reviews():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -156,39 +384,31 @@ def reviews():
     user_id = session['user_id']
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    
-    # Fetch reviews received by the user
-    cursor.execute("""
-        SELECT r.rating, r.comment, r.created_at, 
-               u.name AS reviewer_name, 
-               b.title AS book_title, b.author AS book_author
-        FROM reviews r
-        JOIN users u ON r.reviewer_id = u.user_id
-        JOIN books b ON r.book_id = b.book_id
-        WHERE r.reviewed_id=%s
-        ORDER BY r.created_at DESC
-    """, (user_id,))
-    received_reviews = cursor.fetchall()
-    
-    # Fetch reviews given by the user
-    cursor.execute("""
-        SELECT r.rating, r.comment, r.created_at,
-               u.name AS reviewed_user_name,
-               b.title AS book_title, b.author AS book_author
-        FROM reviews r
-        JOIN users u ON r.reviewed_id = u.user_id
-        JOIN books b ON r.book_id = b.book_id
-        WHERE r.reviewer_id=%s
-        ORDER BY r.created_at DESC
-    """, (user_id,))
-    given_reviews = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
-    
-    return render_template('reviews.html', 
-                         received_reviews=received_reviews,
-                         given_reviews=given_reviews)
+    version = repository.fetch_one(cursor, repository.REVIEWS_VERSION, user_id=user_id)
+    
+    def render():
+        # Reviews received and given by the user
+        if app.config['STREAM_PAGES']:
+            received_reviews, given_reviews = (
+                repository.stream(conn, stmt, {'user_id': user_id}, app.config['STREAM_ITERSIZE'])
+                for stmt in (repository.REVIEWS_RECEIVED, repository.REVIEWS_GIVEN))
+        else:
+            received_reviews, given_reviews = fetch_independent(cursor, [
+                (repository.REVIEWS_RECEIVED, {'user_id': user_id}, 'all'),
+                (repository.REVIEWS_GIVEN, {'user_id': user_id}, 'all'),
+            ])
+        return render_page('reviews.html', 
+                           received_reviews=received_reviews,
+                           given_reviews=given_reviews,
+                           stats=version)
+    
+    try:
+        return conditional_page(tuple(version.values()),
+                                max(filter(None, (version['received_updated_at'], version['given_updated_at'])),
+                                    default=None),
+                                render)
+    finally:
+        cursor.close()
 
 
 # -----------------------------
@@ -207,21 +427,60 @@ def add_book():
         
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO books (user_id, title, author, genre) VALUES (%s, %s, %s, %s)",
+        cursor.execute("INSERT INTO books (user_id, title, author, genre) VALUES (%s, %s, %s, %s) RETURNING book_id",
                        (user_id, title, author, genre))
+        book_id = cursor.fetchone()[0]
         conn.commit()
         cursor.close()
-        conn.close()
+        suggest.get_index().add(book_id, user_id, title, author)
         
         flash("Book added successfully!", "success")
         return redirect(url_for('my_books'))
     
     return render_template('add_book.html')
 
+# -----------------------------
+# Bulk Import Books
+# -----------------------------
+app.config.setdefault('IMPORT_CHUNK_SIZE', 5000)
+
+@app.route('/import_books', methods=['GET', 'POST'])
+def import_books():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash("Choose a CSV or JSON Lines file to import.", "danger")
+            return redirect(url_for('import_books'))
+        
+        fmt = request.form.get('format') or book_import.detect_format(upload.filename)
+        if fmt not in ('csv', 'jsonl'):
+            flash("Could not tell the file format; pick CSV or JSON Lines.", "danger")
+            return redirect(url_for('import_books'))
+        
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        try:
+            result = book_import.import_books(get_db_connection(), session['user_id'], stream, fmt,
+                                              chunk_size=app.config['IMPORT_CHUNK_SIZE'])
+        except (ValueError, csv.Error) as e:
+            flash(f"Import failed: {e}", "danger")
+            return redirect(url_for('import_books'))
+        
+        if result['imported']:
+            suggest.request_sync()
+        flash(f"Imported {result['imported']} book(s); {result['failed']} row(s) skipped.",
+              "success" if result['imported'] else "danger")
+        return render_template('import_books.html', result=result)
+    
+    return render_template('import_books.html', result=None)
+
 # -----------------------------
 # My Books
 # -----------------------------
 @app.route('/my_books')
+@db.read_only
 def my_books():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -229,47 +488,111 @@ def my_books():
     user_id = session['user_id']
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute("SELECT * FROM books WHERE user_id=%s", (user_id,))
-    books = cursor.fetchall()
+    books = repository.fetch_all(cursor, repository.MY_BOOKS, user_id=user_id)
     cursor.close()
-    conn.close()
     
     return render_template('my_books.html', books=books)
 
 # -----------------------------
 # Available Books
 # -----------------------------
+# How many of the stored recommendations (recommend.py) the first page shows
+app.config.setdefault('RECOMMENDATIONS_SHOWN', 6)
+
 @app.route('/available_books')
+@db.read_only
 def available_books():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
     user_id = session['user_id']
+    genre = request.args.get('genre', '').strip() or None
+    author = request.args.get('author', '').strip() or None
+    sort = request.args.get('sort') if request.args.get('sort') in repository.SORTS else 'newest'
+    min_rating = get_min_rating()
+    per_page = get_page_size()
+    after = decode_cursor(request.args.get('after'), datetime.fromisoformat if sort == 'newest' else finite_decimal)
+    
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    # Fetch books that are available and not owned by current user
-    cursor.execute("""
-        SELECT b.*, 
-               EXISTS(
-                   SELECT 1 
-                   FROM swap_requests sr 
-                   WHERE sr.book_id = b.book_id AND sr.sender_id = %s AND sr.status = 'pending'
-               ) AS request_sent
-        FROM books b
-        WHERE b.status='available' AND b.user_id != %s
-    """, (user_id, user_id))
-    
-    books = cursor.fetchall()
+    # Keyset pagination: walk books_available_created_idx (newest first) or
+    # books_available_rating_idx (best rated first) from the cursor position
+    # instead of reading (and skipping) everything before it
+    if app.config['STREAM_PAGES']:
+        stmt, params = repository.available_books_query(user_id, genre, author, after, per_page + 1,
+                                                        sort=sort, min_rating=min_rating)
+        books = repository.stream(conn, stmt, params, app.config['STREAM_ITERSIZE'], limit=per_page)
+        next_cursor = NextCursor(books, repository.SORTS[sort][0], 'book_id')
+    else:
+        books = repository.available_books(cursor, user_id, genre, author, after, per_page + 1,
+                                           sort=sort, min_rating=min_rating)
+        next_cursor = None
+        if len(books) > per_page:
+            books = books[:per_page]
+            next_cursor = encode_cursor(books[-1][repository.SORTS[sort][0]], books[-1]['book_id'])
+    recommended = []
+    if after is None and not genre and not author and not min_rating and sort == 'newest':
+        recommended = repository.fetch_all(cursor, repository.RECOMMENDATIONS, user_id=user_id,
+                                           limit=app.config['RECOMMENDATIONS_SHOWN'])
     cursor.close()
-    conn.close()
     
-    return render_template('available_books.html', books=books)
+    return render_page('available_books.html', books=books, recommended=recommended,
+                       genre=genre, author=author, sort=sort, min_rating=min_rating, per_page=per_page,
+                       next_cursor=next_cursor, is_first_page=after is None)
+
+# -----------------------------
+# Search Books
+# -----------------------------
+@app.route('/search')
+@db.read_only
+def search():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    user_id = session['user_id']
+    query = request.args.get('q', '').strip()
+    per_page = get_page_size()
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page = 1
+    
+    books = []
+    has_next = False
+    if query:
+        conn = get_db_connection()
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        
+        books = repository.fetch_all(cursor, repository.SEARCH, query=query, user_id=user_id,
+                                     limit=per_page + 1, offset=(page - 1) * per_page)
+        cursor.close()
+        
+        has_next = len(books) > per_page
+        books = books[:per_page]
+    
+    return render_template('search.html', books=books, query=query,
+                         page=page, has_next=has_next)
+
+# Type-ahead for the search box, answered from this worker's in-memory index
+# (suggest.py) without touching the database
+@app.route('/suggest')
+def suggest_books():
+    if 'user_id' not in session:
+        return Response(status=401)
+    query = request.args.get('q', '')
+    return jsonify({'query': query,
+                    'suggestions': suggest.get_index().search(query, app.config['SUGGEST_LIMIT'],
+                                                              exclude_user=session['user_id'])})
 
 # -----------------------------
 # Book Details with Reviews
 # -----------------------------
+# Newest reviews listed on a book's page; the count and average come from the book row
+app.config.setdefault('BOOK_REVIEWS_SHOWN', 20)
+
 @app.route('/book_details/<int:book_id>')
+@db.read_only
 def book_details(book_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -277,51 +600,30 @@ def book_details(book_id):
     user_id = session['user_id']
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    version = repository.fetch_one(cursor, repository.BOOK_VERSION, book_id=book_id, user_id=user_id)
     
-    # Get book details
-    cursor.execute("""
-        SELECT b.*, u.name as owner_name
-        FROM books b
-        JOIN users u ON b.user_id = u.user_id
-        WHERE b.book_id = %s
-    """, (book_id,))
-    
-    book = cursor.fetchone()
-    
-    if not book:
+    if not version:
+        cursor.close()
         flash("Book not found", "error")
         return redirect(url_for('available_books'))
     
-    # Get reviews for this book
-    cursor.execute("""
-        SELECT r.*, u.name as reviewer_name
-        FROM reviews r
-        JOIN users u ON r.reviewer_id = u.user_id
-        WHERE r.book_id = %s
-        ORDER BY r.created_at DESC
-    """, (book_id,))
-    
-    reviews = cursor.fetchall()
-    
-    # Check if current user can send request
-    cursor.execute("""
-        SELECT EXISTS(
-            SELECT 1 
-            FROM swap_requests sr 
-            WHERE sr.book_id = %s AND sr.sender_id = %s AND sr.status = 'pending'
-        ) AS request_sent
-    """, (book_id, user_id))
-    
-    request_info = cursor.fetchone()
-    
-    cursor.close()
-    conn.close()
-    
-    return render_template('book_details.html', 
-                         book=book, 
-                         reviews=reviews, 
-                         request_sent=request_info['request_sent'],
-                         can_request=(book['status'] == 'available' and book['user_id'] != user_id))
+    def render():
+        book, reviews = fetch_independent(cursor, [
+            (repository.BOOK, {'book_id': book_id}, 'one'),
+            (repository.BOOK_REVIEWS, {'book_id': book_id, 'limit': app.config['BOOK_REVIEWS_SHOWN']}, 'all'),
+        ])
+        return render_template('book_details.html', 
+                             book=book, 
+                             reviews=reviews, 
+                             request_sent=version['request_sent'],
+                             can_request=(book['status'] == 'available' and book['user_id'] != user_id))
+    
+    try:
+        return conditional_page(tuple(version.values()),
+                                max(filter(None, (version['updated_at'], version['reviews_updated_at']))),
+                                render)
+    finally:
+        cursor.close()
 
 # -----------------------------
 # Send Swap Request
@@ -341,19 +643,18 @@ def send_request(book_id):
     book = cursor.fetchone()
     
     if book and book['user_id'] != user_id:
-        cursor.execute("INSERT INTO swap_requests (book_id, sender_id, receiver_id) VALUES (%s, %s, %s)",
+        cursor.execute("INSERT INTO swap_requests (book_id, sender_id, receiver_id) VALUES (%s, %s, %s) RETURNING request_id",
                        (book_id, user_id, book['user_id']))
-        conn.commit()
+        request_id = cursor.fetchone()['request_id']
         
         # Notification for owner
-        cursor.execute("INSERT INTO notifications (user_id, type, content, status) VALUES (%s, %s, %s, %s)",
-                       (book['user_id'], 'swap_request', f'{session["user_name"]} requested your book "{book["title"]}".', 'unread'))
+        add_notification(cursor, book['user_id'], 'swap_request', f'{session["user_name"]} requested your book "{book["title"]}".',
+                         f'swap_request:{request_id}')
         conn.commit()
         
         flash("Swap request sent!", "success")
     
     cursor.close()
-    conn.close()
     return redirect(url_for('available_books'))
 
 # -----------------------------
@@ -363,6 +664,7 @@ def send_request(book_id):
 # Swap Requests (Inbox) - CORRECTED LOGIC
 # -----------------------------
 @app.route('/swap_requests')
+@db.read_only
 def swap_requests():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -371,39 +673,100 @@ def swap_requests():
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    # 1. Requests received (books others want from me) - I am the RECEIVER_ID
-    cursor.execute("""
-        SELECT sr.request_id, b.book_id, b.title, u.name AS sender_name, sr.status, sr.sender_id
-        FROM swap_requests sr
-        JOIN books b ON sr.book_id = b.book_id
-        JOIN users u ON sr.sender_id = u.user_id
-        WHERE sr.receiver_id=%s
-    """, (user_id,))
-    received = cursor.fetchall()
-    
-    # Review functionality moved to return requests page
-    
-    # 2. Requests sent (books I requested) - I am the SENDER_ID
-    cursor.execute("""
-        SELECT sr.request_id, b.book_id, b.title, u.name AS receiver_name, sr.status, sr.receiver_id
-        FROM swap_requests sr
-        JOIN books b ON sr.book_id = b.book_id
-        JOIN users u ON sr.receiver_id = u.user_id
-        WHERE sr.sender_id=%s
-    """, (user_id,))
-    sent = cursor.fetchall()
+    # Requests received (I am the RECEIVER_ID) and sent (I am the SENDER_ID), and swap circle
+    # offers, in one round trip
+    if app.config['STREAM_PAGES']:
+        received, sent, cycles = repository.swap_request_streams(conn, user_id, app.config['STREAM_ITERSIZE'])
+    else:
+        received, sent, cycles = repository.swap_request_lists(cursor, user_id)
     
     # Review functionality moved to return requests page
             
     cursor.close()
-    conn.close()
     
-    return render_template('swap_requests.html', received=received, sent=sent)
+    return render_page('swap_requests.html', received=received, sent=sent, cycles=cycles)
 
 
 # -----------------------------
 # Accept / Reject Swap
 # -----------------------------
+def accept_swap_requests(cursor, owner_id, request_ids):
+    """Accept pending requests for the owner's books; returns the ids of the books swapped.
+
+    Each book is locked before anything changes, so two concurrent accepts
+    for the same book serialise and the second finds it already swapped.
+    At most one request per book wins (the oldest selected); every other
+    pending request for an accepted book is rejected in the same statement,
+    and all affected senders are notified with one multi-row insert.
+    """
+    cursor.execute("""
+        SELECT b.book_id, b.title
+        FROM books b
+        WHERE b.user_id=%s AND b.status='available'
+          AND b.book_id IN (
+              SELECT sr.book_id FROM swap_requests sr
+              WHERE sr.request_id = ANY(%s) AND sr.receiver_id=%s AND sr.status='pending'
+          )
+        ORDER BY b.book_id
+        FOR UPDATE
+    """, (owner_id, request_ids, owner_id))
+    titles = {row['book_id']: row['title'] for row in cursor.fetchall()}
+    if not titles:
+        return []
+    
+    cursor.execute("""
+        UPDATE swap_requests sr SET status='accepted'
+        FROM (
+            SELECT DISTINCT ON (book_id) request_id
+            FROM swap_requests
+            WHERE request_id = ANY(%s) AND book_id = ANY(%s) AND status='pending'
+            ORDER BY book_id, request_id
+        ) winner
+        WHERE sr.request_id = winner.request_id
+        RETURNING sr.request_id, sr.book_id, sr.sender_id
+    """, (request_ids, list(titles)))
+    accepted = cursor.fetchall()
+    if not accepted:
+        return []
+    book_ids = [row['book_id'] for row in accepted]
+    
+    cursor.execute("UPDATE books SET status='swapped' WHERE book_id = ANY(%s)", (book_ids,))
+    
+    # Create active swap records to track who has each book
+    psycopg2.extras.execute_values(cursor,
+        "INSERT INTO active_swaps (book_id, owner_id, holder_id) VALUES %s",
+        [(row['book_id'], owner_id, row['sender_id']) for row in accepted],
+        page_size=len(accepted))
+    
+    # The books are gone: turn down everyone else who asked for them
+    cursor.execute("""
+        UPDATE swap_requests SET status='rejected'
+        WHERE book_id = ANY(%s) AND status='pending'
+        RETURNING request_id, book_id, sender_id
+    """, (book_ids,))
+    rejected = cursor.fetchall()
+    
+    add_notifications(cursor,
+        [(row['sender_id'], 'swap_request', 'Your swap request has been accepted!',
+          f'swap_accepted:{row["request_id"]}') for row in accepted] +
+        [(row['sender_id'], 'swap_request',
+          f'Your swap request for "{titles[row["book_id"]]}" was declined because the book was swapped to someone else.',
+          f'swap_rejected:{row["request_id"]}') for row in rejected])
+    return book_ids
+
+def reject_swap_requests(cursor, owner_id, request_ids):
+    """Reject pending requests addressed to the owner; returns the number rejected"""
+    cursor.execute("""
+        UPDATE swap_requests SET status='rejected'
+        WHERE request_id = ANY(%s) AND receiver_id=%s AND status='pending'
+        RETURNING request_id, sender_id
+    """, (request_ids, owner_id))
+    rejected = cursor.fetchall()
+    add_notifications(cursor,
+        [(row['sender_id'], 'swap_request', 'Your swap request has been rejected.',
+          f'swap_rejected:{row["request_id"]}') for row in rejected])
+    return len(rejected)
+
 @app.route('/respond_request/<int:request_id>/<string:action>')
 def respond_request(request_id, action):
     if 'user_id' not in session:
@@ -413,30 +776,150 @@ def respond_request(request_id, action):
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    cursor.execute("SELECT * FROM swap_requests WHERE request_id=%s AND receiver_id=%s", (request_id, user_id))
-    request_row = cursor.fetchone()
+    swapped = []
+    if action == 'accept':
+        swapped = accept_swap_requests(cursor, user_id, [request_id])
+        if not swapped:
+            flash("That request is no longer pending or the book has already been swapped.", "danger")
+    elif action == 'reject':
+        reject_swap_requests(cursor, user_id, [request_id])
+    conn.commit()
+    suggest.get_index().discard(swapped)
+    
+    cursor.close()
+    return redirect(url_for('swap_requests'))
+
+# Accept or reject several received requests at once, in one transaction
+@app.route('/respond_requests', methods=['POST'])
+def respond_requests():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    user_id = session['user_id']
+    action = request.form.get('action')
+    request_ids = [int(r) for r in request.form.getlist('request_id') if r.isdigit()]
     
-    if request_row:
+    if request_ids and action in ('accept', 'reject'):
+        conn = get_db_connection()
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         if action == 'accept':
-            cursor.execute("UPDATE swap_requests SET status='accepted' WHERE request_id=%s", (request_id,))
-            cursor.execute("UPDATE books SET status='swapped' WHERE book_id=%s", (request_row['book_id'],))
-            
-            # Create active swap record to track who has the book
-            cursor.execute("INSERT INTO active_swaps (book_id, owner_id, holder_id) VALUES (%s, %s, %s)",
-                           (request_row['book_id'], request_row['receiver_id'], request_row['sender_id']))
-            
-            # Notification for sender
-            cursor.execute("INSERT INTO notifications (user_id, type, content, status) VALUES (%s, %s, %s, %s)",
-                           (request_row['sender_id'], 'swap_request', f'Your swap request has been accepted!', 'unread'))
-            
-        elif action == 'reject':
-            cursor.execute("UPDATE swap_requests SET status='rejected' WHERE request_id=%s", (request_id,))
-            cursor.execute("INSERT INTO notifications (user_id, type, content, status) VALUES (%s, %s, %s, %s)",
-                           (request_row['sender_id'], 'swap_request', f'Your swap request has been rejected.', 'unread'))
+            swapped = accept_swap_requests(cursor, user_id, request_ids)
+            count = len(swapped)
+        else:
+            swapped = []
+            count = reject_swap_requests(cursor, user_id, request_ids)
         conn.commit()
+        suggest.get_index().discard(swapped)
+        cursor.close()
+        flash(f"{count} request(s) {action}ed.", "success")
+    else:
+        flash("Select at least one request.", "danger")
+    
+    return redirect(url_for('swap_requests'))
+
+# -----------------------------
+# Swap Circles
+# -----------------------------
+app.config.setdefault('SWAP_CYCLE_MAX_LENGTH', 4)
+app.config.setdefault('SWAP_CYCLE_TTL_HOURS', 48)
+app.config.setdefault('SWAP_MATCH_MAX_FRONTIER', 1000)
+
+def complete_swap_cycle(cursor, cycle_id):
+    """Accept every request of a fully accepted circle, or none of them.
+
+    All the circle's books are locked in id order first, the same order
+    accept_swap_requests locks in, and each request must still be pending
+    on an available book. Otherwise the circle is cancelled and its
+    requests go back to the matcher. Returns True if the swaps happened.
+    """
+    cursor.execute("""
+        SELECT book_id FROM books
+        WHERE book_id IN (SELECT book_id FROM swap_cycle_members WHERE cycle_id = %s)
+        ORDER BY book_id
+        FOR UPDATE
+    """, (cycle_id,))
+    # Outer joins: a request or book that no longer exists fails the check below
+    cursor.execute("""
+        SELECT m.request_id, m.user_id, sr.receiver_id, sr.status AS request_status, b.status AS book_status
+        FROM swap_cycle_members m
+        LEFT JOIN swap_requests sr ON sr.request_id = m.request_id
+        LEFT JOIN books b ON b.book_id = m.book_id
+        WHERE m.cycle_id = %s
+        ORDER BY m.book_id
+    """, (cycle_id,))
+    members = cursor.fetchall()
+    if any(m['request_status'] != 'pending' or m['book_status'] != 'available' for m in members):
+        cursor.execute("UPDATE swap_cycles SET status='cancelled' WHERE cycle_id=%s", (cycle_id,))
+        swap_matcher.requeue(cursor, [m['request_id'] for m in members])
+        add_notifications(cursor,
+            [(m['user_id'], 'swap_request', 'A swap circle you accepted fell through: one of its books is no longer available.',
+              f'swap_cycle_cancelled:{cycle_id}:{m["user_id"]}') for m in members])
+        return False
+    for m in members:
+        if not accept_swap_requests(cursor, m['receiver_id'], [m['request_id']]):
+            raise RuntimeError("swap circle %d changed while its books were locked" % cycle_id)
+    cursor.execute("UPDATE swap_cycles SET status='completed' WHERE cycle_id=%s", (cycle_id,))
+    return True
+
+@app.route('/swap_cycles/<int:cycle_id>/<string:action>', methods=['POST'])
+def respond_swap_cycle(cycle_id, action):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    if action not in ('accept', 'decline'):
+        return redirect(url_for('swap_requests'))
+    
+    user_id = session['user_id']
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    
+    # The cycle row lock serialises members answering at the same time,
+    # so exactly one of them sees the last acceptance
+    cursor.execute("""
+        SELECT c.status FROM swap_cycles c
+        WHERE c.cycle_id=%s
+          AND EXISTS (SELECT 1 FROM swap_cycle_members m WHERE m.cycle_id = c.cycle_id AND m.user_id=%s)
+        FOR UPDATE OF c
+    """, (cycle_id, user_id))
+    cycle = cursor.fetchone()
+    if not cycle or cycle['status'] != 'offered':
+        conn.rollback()
+        cursor.close()
+        flash("That swap circle is no longer open.", "danger")
+        return redirect(url_for('swap_requests'))
+    
+    if action == 'accept':
+        cursor.execute("""
+            UPDATE swap_cycle_members SET accepted_at = CURRENT_TIMESTAMP
+            WHERE cycle_id=%s AND user_id=%s AND accepted_at IS NULL
+        """, (cycle_id, user_id))
+        cursor.execute("SELECT count(*) FILTER (WHERE accepted_at IS NULL) AS waiting FROM swap_cycle_members WHERE cycle_id=%s",
+                       (cycle_id,))
+        if cursor.fetchone()['waiting']:
+            flash("Accepted. The swap happens once everyone in the circle accepts.", "success")
+        elif complete_swap_cycle(cursor, cycle_id):
+            flash("Everyone accepted: the swap circle is complete!", "success")
+        else:
+            flash("The swap circle fell through: one of its books is no longer available.", "danger")
+    else:
+        cursor.execute("UPDATE swap_cycles SET status='declined' WHERE cycle_id=%s", (cycle_id,))
+        cursor.execute("""
+            UPDATE swap_cycle_members SET declined_at = CURRENT_TIMESTAMP
+            WHERE cycle_id=%s AND user_id=%s
+            RETURNING request_id
+        """, (cycle_id, user_id))
+        declined = {row['request_id'] for row in cursor.fetchall()}
+        cursor.execute("SELECT request_id, user_id FROM swap_cycle_members WHERE cycle_id=%s", (cycle_id,))
+        others = [row for row in cursor.fetchall() if row['request_id'] not in declined]
+        swap_matcher.requeue(cursor, [row['request_id'] for row in others])
+        add_notifications(cursor,
+            [(row['user_id'], 'swap_request', 'A swap circle you were offered was declined by another member.',
+              f'swap_cycle_declined:{cycle_id}:{row["user_id"]}') for row in others])
+        flash("Swap circle declined.", "info")
+    conn.commit()
+    # A completed circle swapped books owned by several people; let the loader re-read them
+    suggest.request_sync()
     
     cursor.close()
-    conn.close()
     return redirect(url_for('swap_requests'))
 
 # -----------------------------
@@ -456,16 +939,15 @@ def review(user_id, book_id):
         cursor.execute("""
             INSERT INTO reviews (reviewer_id, reviewed_id, book_id, rating, comment) 
             VALUES (%s, %s, %s, %s, %s)
+            RETURNING review_id
         """, (session['user_id'], user_id, book_id, rating, comment))
+        review_id = cursor.fetchone()[0]
         
-        cursor.execute("""
-            INSERT INTO notifications (user_id, type, content, status) 
-            VALUES (%s, %s, %s, %s)
-        """, (user_id, 'review', f'You received a new review from {session["user_name"]}', 'unread'))
+        add_notification(cursor, user_id, 'review', f'You received a new review from {session["user_name"]}',
+                         f'review:{review_id}')
         
         conn.commit()
         cursor.close()
-        conn.close()
         
         flash("Review submitted!", "success")
         return redirect(url_for('profile'))
@@ -481,18 +963,112 @@ def notifications():
         return redirect(url_for('login'))
     
     user_id = session['user_id']
+    per_page = get_page_size()
+    after = decode_cursor(request.args.get('after'))
+    
+    if after:
+        stmt, params = repository.NOTIFICATIONS_AFTER, {'user_id': user_id, 'created_at': after[0],
+                                                        'notification_id': after[1], 'limit': per_page + 1}
+    else:
+        stmt, params = repository.NOTIFICATIONS, {'user_id': user_id, 'limit': per_page + 1}
+    
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cursor.execute("SELECT * FROM notifications WHERE user_id=%s ORDER BY created_at DESC", (user_id,))
-    notifications = cursor.fetchall()
+    if app.config['STREAM_PAGES']:
+        # The rows aren't in hand until the page renders, so this page's unread
+        # rows are marked read first; the page still shows them as unread
+        cursor.execute("UPDATE notifications SET status='read' "
+                       "WHERE notification_id IN (SELECT notification_id FROM (" + stmt.sql + ") page) "
+                       "AND status='unread' RETURNING notification_id", dict(params, limit=per_page))
+        just_read = {row['notification_id'] for row in cursor.fetchall()}
+        marked = len(just_read)
+    else:
+        notifications = repository.fetch_all(cursor, stmt, **params)
+        next_cursor = None
+        if len(notifications) > per_page:
+            notifications = notifications[:per_page]
+            next_cursor = encode_cursor(notifications[-1]['created_at'], notifications[-1]['notification_id'])
+        
+        # Only the unread rows on this page are marked read; rows already read are left alone
+        shown_unread = [n['notification_id'] for n in notifications if n['status'] == 'unread']
+        marked = 0
+        if shown_unread:
+            cursor.execute("UPDATE notifications SET status='read' WHERE notification_id = ANY(%s) AND status='unread'",
+                           (shown_unread,))
+            marked = cursor.rowcount
+    if marked:
+        cursor.execute("UPDATE users SET unread_notifications = GREATEST(unread_notifications - %s, 0) WHERE user_id=%s",
+                       (marked, user_id))
+        conn.commit()
+        unread_count_cache.invalidate(user_id)
     
-    cursor.execute("UPDATE notifications SET status='read' WHERE user_id=%s", (user_id,))
-    conn.commit()
+    cursor.close()
+    
+    if app.config['STREAM_PAGES']:
+        notifications = repository.stream(
+            conn, stmt, params, app.config['STREAM_ITERSIZE'], limit=per_page,
+            transform=lambda n: dict(n, status='unread') if n['notification_id'] in just_read else n)
+        next_cursor = NextCursor(notifications, 'created_at', 'notification_id')
+    
+    return render_page('notifications.html', notifications=notifications,
+                       next_cursor=next_cursor, is_first_page=after is None)
+
+@app.route('/notifications/mark_all_read', methods=['POST'])
+def mark_all_notifications_read():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
     
+    user_id = session['user_id']
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Reset the counter first: its row lock orders us against the outbox worker's increments
+    cursor.execute("UPDATE users SET unread_notifications=0 WHERE user_id=%s", (user_id,))
+    cursor.execute("UPDATE notifications SET status='read' WHERE user_id=%s AND status='unread'", (user_id,))
+    conn.commit()
     cursor.close()
-    conn.close()
+    unread_count_cache.set(user_id, 0)
+    
+    flash("All notifications marked as read.", "success")
+    return redirect(url_for('notifications'))
+
+# -----------------------------
+# Live Notification Stream (server-sent events)
+# -----------------------------
+# Fed by pg_notify from the notifications insert trigger through one shared
+# LISTEN connection per worker (realtime.py). The stream holds no pooled
+# connection while open, but it does occupy a server thread, so run it
+# under a threaded or async worker.
+app.config.setdefault('SSE_KEEPALIVE', 15.0)
+
+@app.route('/notifications/stream')
+def notification_stream():
+    if 'user_id' not in session:
+        return Response(status=401)
+    
+    user_id = session['user_id']
+    unread = get_unread_notification_count(user_id)
+    hub = realtime.get_hub()
+    keepalive = app.config['SSE_KEEPALIVE']
+    
+    def stream():
+        q = hub.subscribe(user_id)
+        try:
+            yield realtime.format_sse('unread', {'unread_count': unread})
+            while True:
+                try:
+                    event = q.get(timeout=keepalive)
+                except queue.Empty:
+                    # Comment line: keeps proxies from timing out and surfaces disconnects
+                    yield ": keepalive\n\n"
+                    continue
+                if event.get('unread_count') is not None:
+                    unread_count_cache.set(user_id, event['unread_count'])
+                yield realtime.format_sse('notification', event)
+        finally:
+            hub.unsubscribe(user_id, q)
     
-    return render_template('notifications.html', notifications=notifications)
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # -----------------------------
 # Return Book (Re-swap back to available)
@@ -526,14 +1102,14 @@ def request_return(book_id):
             cursor.execute("""
                 INSERT INTO return_requests (book_id, owner_id, holder_id, message) 
                 VALUES (%s, %s, %s, %s)
+                RETURNING return_request_id
             """, (book_id, user_id, swap_info['holder_id'], message))
+            return_request_id = cursor.fetchone()['return_request_id']
             
             # Notify the current holder
-            cursor.execute("""
-                INSERT INTO notifications (user_id, type, content, status) 
-                VALUES (%s, %s, %s, %s)
-            """, (swap_info['holder_id'], 'return_request', 
-                  f"Someone is requesting the return of '{swap_info['title']}'", 'unread'))
+            add_notification(cursor, swap_info['holder_id'], 'return_request', 
+                  f"Someone is requesting the return of '{swap_info['title']}'",
+                  f'return_request:{return_request_id}')
             
             conn.commit()
             flash(f"Return request sent to {swap_info['holder_name']}!", "success")
@@ -541,7 +1117,6 @@ def request_return(book_id):
             flash("Book swap not found.", "error")
         
         cursor.close()
-        conn.close()
         return redirect(url_for('my_books'))
     
     # GET request - show form
@@ -554,7 +1129,6 @@ def request_return(book_id):
     
     book_info = cursor.fetchone()
     cursor.close()
-    conn.close()
     
     if not book_info:
         flash("Book not found or not currently swapped.", "error")
@@ -576,7 +1150,7 @@ def respond_return(return_request_id, action):
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
     cursor.execute("""
-        SELECT rr.*, b.title, u.name as owner_name
+        SELECT rr.*, b.title, b.author, u.name as owner_name
         FROM return_requests rr 
         JOIN books b ON rr.book_id = b.book_id
         JOIN users u ON rr.owner_id = u.user_id
@@ -595,28 +1169,26 @@ def respond_return(return_request_id, action):
             cursor.execute("DELETE FROM active_swaps WHERE book_id=%s", (return_request['book_id'],))
             
             # Notify owner
-            cursor.execute("""
-                INSERT INTO notifications (user_id, type, content, status) 
-                VALUES (%s, %s, %s, %s)
-            """, (return_request['owner_id'], 'return_request', 
-                  f"Your book '{return_request['title']}' has been returned and is now available!", 'unread'))
+            add_notification(cursor, return_request['owner_id'], 'return_request', 
+                  f"Your book '{return_request['title']}' has been returned and is now available!",
+                  f'return_accepted:{return_request_id}')
             
             flash(f"You have returned '{return_request['title']}' to {return_request['owner_name']}", "success")
             
         elif action == 'reject':
             cursor.execute("UPDATE return_requests SET status='rejected' WHERE return_request_id=%s", (return_request_id,))
-            cursor.execute("""
-                INSERT INTO notifications (user_id, type, content, status) 
-                VALUES (%s, %s, %s, %s)
-            """, (return_request['owner_id'], 'return_request', 
-                  f"Your return request for '{return_request['title']}' was declined.", 'unread'))
+            add_notification(cursor, return_request['owner_id'], 'return_request', 
+                  f"Your return request for '{return_request['title']}' was declined.",
+                  f'return_rejected:{return_request_id}')
             
             flash("Return request declined.", "info")
         
         conn.commit()
+        if action == 'accept':
+            suggest.get_index().add(return_request['book_id'], return_request['owner_id'],
+                                    return_request['title'], return_request['author'])
     
     cursor.close()
-    conn.close()
     return redirect(url_for('my_return_requests'))
 
 
@@ -624,6 +1196,7 @@ def respond_return(return_request_id, action):
 # View Return Requests (both sent and received)
 # --------------------------------------
 @app.route('/return_requests')
+@db.read_only
 def my_return_requests():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -632,45 +1205,282 @@ def my_return_requests():
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     
-    # Return requests I sent (as book owner)
-    cursor.execute("""
-        SELECT rr.*, b.title, b.author, u.name as holder_name,
-               EXISTS(
-                   SELECT 1 FROM reviews r 
-                   WHERE r.book_id = rr.book_id 
-                   AND r.reviewer_id = rr.holder_id
-               ) as holder_reviewed
-        FROM return_requests rr 
-        JOIN books b ON rr.book_id = b.book_id
-        JOIN users u ON rr.holder_id = u.user_id
-        WHERE rr.owner_id = %s
-        ORDER BY rr.created_at DESC
-    """, (user_id,))
-    sent_requests = cursor.fetchall()
+    # Return requests I sent (as book owner) and received (as current holder), in one round trip
+    if app.config['STREAM_PAGES']:
+        sent_requests, received_requests = repository.return_request_streams(conn, user_id,
+                                                                             app.config['STREAM_ITERSIZE'])
+    else:
+        sent_requests, received_requests = repository.return_request_lists(cursor, user_id)
     
-    # Return requests I received (as current holder)
+    cursor.close()
+    
+    return render_page('return_requests.html', sent_requests=sent_requests, received_requests=received_requests)
+
+# -----------------------------
+# Messages
+# -----------------------------
+app.config.setdefault('MESSAGES_PAGE_SIZE', 30)
+MESSAGE_MAX_BYTES = 2000  # messages_body_check
+
+# Where a conversation's Back link goes
+MESSAGE_LISTS = {'swap': 'swap_requests', 'return': 'my_return_requests'}
+
+def message_parties(cursor, kind, request_id, user_id):
+    """(other party's id, their name, book title) of a request user_id is on, or None"""
+    row = repository.fetch_one(cursor, repository.MESSAGE_PARTIES[kind], request_id=request_id)
+    if row is None or user_id not in (row['first_id'], row['second_id']):
+        return None
+    if user_id == row['first_id']:
+        return row['second_id'], row['second_name'], row['title']
+    return row['first_id'], row['first_name'], row['title']
+
+def open_conversation(cursor, kind, request_id, user_ids):
+    """conversation_id of a request's conversation, creating it and its members on first use"""
     cursor.execute("""
-        SELECT rr.*, b.title, b.author, u.name as owner_name,
-               EXISTS(
-                   SELECT 1 FROM reviews r 
-                   WHERE r.book_id = rr.book_id 
-                   AND r.reviewer_id = %s
-               ) as review_given
-        FROM return_requests rr 
-        JOIN books b ON rr.book_id = b.book_id
-        JOIN users u ON rr.owner_id = u.user_id
-        WHERE rr.holder_id = %s
-        ORDER BY rr.created_at DESC
-    """, (user_id, user_id))
-    received_requests = cursor.fetchall()
+        INSERT INTO conversations (request_kind, request_id) VALUES (%s, %s)
+        ON CONFLICT (request_kind, request_id) DO NOTHING
+        RETURNING conversation_id
+    """, (kind, request_id))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT conversation_id FROM conversations WHERE request_kind = %s AND request_id = %s",
+                       (kind, request_id))
+        return cursor.fetchone()['conversation_id']
+    psycopg2.extras.execute_values(cursor,
+        "INSERT INTO conversation_members (conversation_id, user_id) VALUES %s",
+        [(row['conversation_id'], member) for member in sorted(user_ids)])
+    return row['conversation_id']
+
+@app.route('/messages/<any(swap, return):kind>/<int:request_id>')
+def message_thread(kind, request_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    user_id = session['user_id']
+    per_page = app.config['MESSAGES_PAGE_SIZE']
+    try:
+        before = int(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        before = None
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    parties = message_parties(cursor, kind, request_id, user_id)
+    if parties is None:
+        cursor.close()
+        flash("Conversation not found", "danger")
+        return redirect(url_for(MESSAGE_LISTS[kind]))
+    other_id, other_name, title = parties
+    
+    messages, older = [], None
+    conversation = repository.fetch_one(cursor, repository.CONVERSATION, user_id=user_id, kind=kind,
+                                        request_id=request_id)
+    if conversation:
+        if before:
+            messages = repository.fetch_all(cursor, repository.MESSAGE_THREAD_BEFORE,
+                                            conversation_id=conversation['conversation_id'],
+                                            before=before, limit=per_page + 1)
+        else:
+            messages = repository.fetch_all(cursor, repository.MESSAGE_THREAD,
+                                            conversation_id=conversation['conversation_id'], limit=per_page + 1)
+        if len(messages) > per_page:
+            messages = messages[:per_page]
+            older = messages[-1]['message_id']
+        
+        # Seeing the newest message reads everything before it: one marker moves, no message rows change
+        if messages and before is None and messages[0]['message_id'] > conversation['last_read_message_id']:
+            cursor.execute("""
+                UPDATE conversation_members SET last_read_message_id = %s
+                WHERE conversation_id = %s AND user_id = %s AND last_read_message_id < %s
+            """, (messages[0]['message_id'], conversation['conversation_id'], user_id, messages[0]['message_id']))
+            conn.commit()
+    
+    cursor.close()
+    
+    return render_template('messages.html', kind=kind, request_id=request_id, title=title,
+                           other_name=other_name, messages=messages, older=older,
+                           back=url_for(MESSAGE_LISTS[kind]), is_first_page=before is None)
+
+@app.route('/messages/<any(swap, return):kind>/<int:request_id>', methods=['POST'])
+def post_message(kind, request_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    user_id = session['user_id']
+    thread = url_for('message_thread', kind=kind, request_id=request_id)
+    body = request.form.get('body', '').strip()
+    if not body:
+        flash("Write a message first.", "danger")
+        return redirect(thread)
+    if len(body.encode('utf-8')) > MESSAGE_MAX_BYTES:
+        flash("That message is too long.", "danger")
+        return redirect(thread)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    parties = message_parties(cursor, kind, request_id, user_id)
+    if parties is None:
+        cursor.close()
+        flash("Conversation not found", "danger")
+        return redirect(url_for(MESSAGE_LISTS[kind]))
+    other_id, _, title = parties
     
+    conversation_id = open_conversation(cursor, kind, request_id, (user_id, other_id))
+    cursor.execute("""
+        INSERT INTO messages (conversation_id, sender_id, body) VALUES (%s, %s, %s)
+        RETURNING message_id, created_at
+    """, (conversation_id, user_id, body))
+    message = cursor.fetchone()
+    cursor.execute("""
+        UPDATE conversations
+        SET last_message_id = GREATEST(last_message_id, %(id)s),
+            last_message_at = GREATEST(last_message_at, %(at)s)
+        WHERE conversation_id = %(conversation_id)s
+    """, {'id': message['message_id'], 'at': message['created_at'], 'conversation_id': conversation_id})
+    # Your own messages count as read; the recipient's marker keys their notification
+    cursor.execute("""
+        UPDATE conversation_members
+        SET last_read_message_id = GREATEST(last_read_message_id, %s)
+        WHERE conversation_id = %s AND user_id = %s
+    """, (message['message_id'], conversation_id, user_id))
+    cursor.execute("SELECT last_read_message_id FROM conversation_members WHERE conversation_id = %s AND user_id = %s",
+                   (conversation_id, other_id))
+    read_up_to = cursor.fetchone()['last_read_message_id']
+    
+    # One notification per run of unread messages, not one per message
+    add_notification(cursor, other_id, 'message',
+                     f'{session.get("user_name", "Someone")} sent you a message about "{title}".',
+                     f'message:{conversation_id}:{read_up_to}')
+    conn.commit()
     cursor.close()
-    conn.close()
     
-    return render_template('return_requests.html', sent_requests=sent_requests, received_requests=received_requests)
+    return redirect(thread)
+
+# -----------------------------
+# CLI Commands
+# -----------------------------
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations (migrations/*.sql)"""
+    applied = migrate.apply_migrations(get_db_connection())
+    print("Applied %d migration(s)." % len(applied) if applied else "Database is up to date.")
+
+@app.cli.command('check-plans')
+def check_plans_command():
+    """Fail if any route query can only be answered with a sequential scan"""
+    failures = plan_check.find_seq_scans(get_db_connection())
+    for name, tables in failures.items():
+        print("SEQ SCAN  %s: %s" % (name, ', '.join(tables)))
+    if failures:
+        raise SystemExit(1)
+    print("All %d route queries are index-driven." % len(plan_check.ROUTE_QUERIES))
+
+@app.cli.command('outbox-worker')
+def outbox_worker_command():
+    """Deliver queued notifications from notification_outbox until interrupted"""
+    outbox_worker.run(db.connect_kwargs(app.config),
+                      batch_size=app.config['OUTBOX_BATCH_SIZE'],
+                      max_attempts=app.config['OUTBOX_MAX_ATTEMPTS'])
+
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user-id', type=int, required=True, help='Owner of the imported books')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension')
+def import_books_command(path, user_id, fmt):
+    """Bulk-load books from a CSV or JSON Lines file with COPY"""
+    fmt = fmt or book_import.detect_format(path)
+    if fmt is None:
+        raise click.UsageError("can't tell the format of %s; pass --format" % path)
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        result = book_import.import_books(get_db_connection(), user_id, f, fmt,
+                                          chunk_size=app.config['IMPORT_CHUNK_SIZE'])
+    for line_no, message in result['errors']:
+        print("line %d: %s" % (line_no, message))
+    if result['failed'] > len(result['errors']):
+        print("... %d more error(s)" % (result['failed'] - len(result['errors'])))
+    print("Imported %d book(s); %d row(s) skipped." % (result['imported'], result['failed']))
+
+@app.cli.command('rebuild-user-stats')
+def rebuild_user_stats_command():
+    """Recompute user_stats and book ratings from the base tables and report rows that had drifted"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT rebuild_user_stats()")
+    corrected = cursor.fetchone()[0]
+    conn.commit()
+    cursor.execute("SELECT rebuild_book_ratings()")
+    corrected_books = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+    print("user_stats rebuilt; %d row(s) corrected." % corrected)
+    print("Book ratings rebuilt; %d book(s) corrected." % corrected_books)
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static/ into ASSETS_FOLDER for long-lived caching"""
+    manifest = assets.build(app.static_folder, app.config['ASSETS_FOLDER'])
+    for name, hashed in sorted(manifest.items()):
+        print("%s -> %s" % (name, hashed))
+    print("Built %d asset(s); restart the app to serve them." % len(manifest))
+
+app.config.setdefault('RECOMMENDATIONS_TOP_K', 20)
+app.config.setdefault('RECOMMENDATIONS_NEIGHBOURS', 50)
+app.config.setdefault('RECOMMENDATIONS_GENRE_WEIGHT', 0.3)
+
+@app.cli.command('recommend')
+@click.option('--incremental', is_flag=True, help='Only recompute users queued since the last run')
+def recommend_command(incremental):
+    """Rebuild the "Books you might like" lists (needs NumPy and SciPy unless --incremental)"""
+    cfg = app.config
+    if incremental:
+        updated = recommend.update_dirty(get_db_connection(), top_k=cfg['RECOMMENDATIONS_TOP_K'],
+                                         genre_weight=cfg['RECOMMENDATIONS_GENRE_WEIGHT'])
+        if updated is None:
+            print("A full rebuild is running; nothing done.")
+        else:
+            print("Updated recommendations for %d user(s)." % updated)
+        return
+    users = recommend.rebuild(get_db_connection(), top_k=cfg['RECOMMENDATIONS_TOP_K'],
+                              neighbours=cfg['RECOMMENDATIONS_NEIGHBOURS'],
+                              genre_weight=cfg['RECOMMENDATIONS_GENRE_WEIGHT'])
+    print("Rebuilt recommendations for %d user(s)." % users)
+
+@app.cli.command('match-swaps')
+def match_swaps_command():
+    """Offer swap circles through requests queued since the last run, and close stale offers"""
+    cfg = app.config
+    result = swap_matcher.process_queue(get_db_connection(), max_length=cfg['SWAP_CYCLE_MAX_LENGTH'],
+                                        max_frontier=cfg['SWAP_MATCH_MAX_FRONTIER'],
+                                        ttl_hours=cfg['SWAP_CYCLE_TTL_HOURS'])
+    if result is None:
+        print("Another matcher is running; nothing done.")
+    else:
+        print("Scanned %d request(s); offered %d swap circle(s)." % result)
+
+app.config.setdefault('PARTITION_MONTHS_AHEAD', 3)
+app.config.setdefault('PARTITION_RETENTION', {})  # table -> (months, 'archive' | 'drop'); see partitions.py
+
+@app.cli.command('maintain-partitions')
+@click.option('--no-retention', is_flag=True, help='Only create upcoming partitions')
+def maintain_partitions_command(no_retention):
+    """Create next months' partitions and archive or drop months past retention"""
+    conn = get_db_connection()
+    for name in partitions.ensure_partitions(conn, months_ahead=app.config['PARTITION_MONTHS_AHEAD']):
+        print("Created %s" % name)
+    if not no_retention:
+        for name, action in partitions.apply_retention(conn, app.config['PARTITION_RETENTION']):
+            print("%s %s" % ('Dropped' if action == 'drop' else 'Archived', name))
+    print("Partitions are up to date.")
 
 # -----------------------------
 # Run App
 # -----------------------------
 if __name__ == '__main__':
+    # Dev server: deliver notifications in-process rather than needing `flask outbox-worker`
+    # (WERKZEUG_RUN_MAIN is set in the reloader's serving child only)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(target=outbox_worker.run, args=(db.connect_kwargs(app.config),),
+                         kwargs={'batch_size': app.config['OUTBOX_BATCH_SIZE'],
+                                 'max_attempts': app.config['OUTBOX_MAX_ATTEMPTS']},
+                         name='outbox-worker', daemon=True).start()
     app.run(debug=True)
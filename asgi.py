@@ -0,0 +1,38 @@
+"""ASGI entry point, e.g. `DB_ASYNC=1 uvicorn asgi:application --workers 4`.
+
+The Flask views are synchronous WSGI code, so every request runs on a thread
+from a pool of ASGI_THREADS (default 64) per worker, and holds it until its
+response is sent. An open /notifications/stream holds one for as long as it
+stays open, so size the pool for those plus the ordinary requests in
+flight. With DB_ASYNC on, pages run their independent queries concurrently
+on the psycopg 3 async pool (see async_db.py).
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from app import app
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 64))
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='wsgi')
+
+
+class _PooledInstance(WsgiToAsgiInstance):
+    # asgiref's own run_wsgi_app is thread-sensitive: every request of a worker
+    # runs on one shared thread, one at a time, and an endless event stream
+    # would block the rest. Run the same code on the pool instead.
+    run_wsgi_app = SyncToAsync(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+                               thread_sensitive=False, executor=_executor)
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi that serves requests concurrently on a thread pool"""
+
+    async def __call__(self, scope, receive, send):
+        await _PooledInstance(self.wsgi_application)(scope, receive, send)
+
+
+application = PooledWsgiToAsgi(app)
@@ -0,0 +1,157 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+
+from flask import abort, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # without it only gzip variants are built
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+# Fingerprinted files never change, so browsers may keep them for a year without asking
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Worth compressing; images and fonts are compressed already
+COMPRESSIBLE = {'.css', '.js', '.json', '.map', '.svg', '.txt', '.xml', '.html'}
+
+# Precompressed variants, best first: (Accept-Encoding token, file suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Logical name (e.g. 'base.css') -> fingerprinted name; set by init_app
+_manifest = {}
+_folder = None
+version = None
+
+
+# -----------------------------
+# Build
+# -----------------------------
+def _fingerprinted(name, digest):
+    root, ext = os.path.splitext(name)
+    return '%s.%s%s' % (root, digest[:12], ext)
+
+
+def _write(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _compressors():
+    yield '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        yield '.br', lambda data: brotli.compress(data, quality=11)
+
+
+def _read_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def build(static_folder, out_folder):
+    """Copy every file under static_folder into out_folder under a name that
+    carries a hash of its contents, next to .gz and .br variants, and write
+    manifest.json mapping the original names to the new ones.
+
+    Files left from the build before this one are kept, so pages rendered
+    just before a deploy can still load their assets; anything older is
+    removed. Returns the manifest."""
+    os.makedirs(out_folder, exist_ok=True)
+    previous = _read_manifest(out_folder)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != out_folder]
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            logical = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            hashed = _fingerprinted(logical, hashlib.sha256(data).hexdigest())
+            manifest[logical] = hashed
+            target = os.path.join(out_folder, hashed)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                _write(target, data)
+                log.info("built %s", hashed)
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE:
+                continue
+            for suffix, compress in _compressors():
+                if os.path.exists(target + suffix):
+                    continue
+                compressed = compress(data)
+                # Tiny files can come out larger; the plain file serves those
+                if len(compressed) < len(data):
+                    _write(target + suffix, compressed)
+    if brotli is None:
+        log.warning("brotli is not installed (pip install brotli); only gzip variants were written")
+
+    keep = {MANIFEST} | set(manifest.values()) | set(previous.values())
+    for root, dirs, files in os.walk(out_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, out_folder).replace(os.sep, '/')
+            for _, suffix in ENCODINGS:
+                if rel.endswith(suffix):
+                    rel = rel[:-len(suffix)]
+            if rel not in keep:
+                os.remove(path)
+    _write(os.path.join(out_folder, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+# -----------------------------
+# Serving
+# -----------------------------
+def asset_url(endpoint, **values):
+    """url_for() that points static files at their fingerprinted build, if
+    there is one: asset_url('static', filename='base.css')"""
+    if endpoint == 'static' and values.get('filename') in _manifest:
+        values['filename'] = _manifest[values['filename']]
+        return url_for('assets', **values)
+    return url_for(endpoint, **values)
+
+
+def serve(filename):
+    """A fingerprinted asset, precompressed in the best encoding the browser accepts"""
+    if filename == MANIFEST or filename.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    chosen = None
+    for encoding, suffix in ENCODINGS:
+        path = safe_join(_folder, filename + suffix)
+        if request.accept_encodings.quality(encoding) > 0 and path and os.path.isfile(path):
+            chosen = encoding, suffix
+            break
+    response = send_from_directory(_folder, filename + (chosen[1] if chosen else ''), mimetype=mimetype)
+    if chosen:
+        response.headers['Content-Encoding'] = chosen[0]
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def init_app(app):
+    global _manifest, _folder, version
+    app.config.setdefault('ASSETS_FOLDER', os.path.join(app.static_folder, 'dist'))
+    _folder = app.config['ASSETS_FOLDER']
+    _manifest = _read_manifest(_folder)
+    if not _manifest:
+        log.info("no asset manifest in %s; serving static files unfingerprinted (run `flask build-assets`)",
+                 _folder)
+    # Pages embed the asset URLs, so their ETags must change with a new build
+    version = hashlib.sha1(json.dumps(_manifest, sort_keys=True).encode()).hexdigest()[:12]
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve)
+    app.add_template_global(asset_url)
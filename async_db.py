@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+import time
+
+from flask import current_app
+
+import db
+
+try:
+    from psycopg import Error
+    from psycopg.conninfo import make_conninfo
+    from psycopg.rows import dict_row
+    from psycopg_pool import AsyncConnectionPool
+except ImportError:  # psycopg 3 is only needed with DB_ASYNC on
+    AsyncConnectionPool = None
+
+    class Error(Exception):
+        pass
+
+
+# -----------------------------
+# Concurrent Query Runner
+# -----------------------------
+class AsyncQueryRunner:
+    """Runs batches of independent read queries concurrently.
+
+    One event loop per worker runs in a background thread and owns a psycopg 3
+    AsyncConnectionPool. A request submits a batch and waits for the whole of
+    it; each query gets its own pooled connection, so a page waits for its
+    slowest query instead of the sum of them. Connections are in autocommit:
+    every query reads its own snapshot, as it would under READ COMMITTED.
+    There is one runner for the primary and one per replica (db.py), so a
+    batch reads from the same server as the rest of its request.
+    """
+
+    def __init__(self, conninfo, min_size=1, max_size=20, timeout=30.0):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='async-db', daemon=True)
+        self._thread.start()
+        self._pool = self._call(self._open(conninfo, min_size, max_size, timeout))
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _open(self, conninfo, min_size, max_size, timeout):
+        pool = AsyncConnectionPool(conninfo, min_size=min_size, max_size=max_size, timeout=timeout,
+                                   kwargs={'autocommit': True, 'row_factory': dict_row}, open=False)
+        await pool.open()
+        return pool
+
+    async def _fetch(self, sql, params, fetch):
+        start = time.perf_counter()
+        async with self._pool.connection() as conn:
+            cursor = await conn.execute(sql, params)
+            result = await (cursor.fetchone() if fetch == 'one' else cursor.fetchall())
+        return result, time.perf_counter() - start
+
+    async def _gather(self, queries):
+        return await asyncio.gather(*(self._fetch(sql, params, fetch) for sql, params, fetch in queries))
+
+    def run(self, queries):
+        """[(sql, params, 'all' | 'one')] -> [(result, seconds)], in order"""
+        return self._call(self._gather(queries))
+
+    def stats(self):
+        return self._pool.get_stats()
+
+
+_runners = {}  # None (the primary) or a replica DSN -> AsyncQueryRunner
+_runners_pid = None
+_runner_lock = threading.Lock()
+
+
+def get_runner(dsn=None):
+    """Return this worker's runner for the primary, or for the replica at `dsn`,
+    creating it on first use (and after a fork)"""
+    global _runners, _runners_pid
+    if _runners_pid != os.getpid() or dsn not in _runners:
+        with _runner_lock:
+            if _runners_pid != os.getpid():
+                _runners, _runners_pid = {}, os.getpid()
+            if dsn not in _runners:
+                if AsyncConnectionPool is None:
+                    raise RuntimeError("DB_ASYNC needs psycopg 3: pip install 'psycopg[binary]' psycopg-pool")
+                cfg = current_app.config
+                if dsn is None:
+                    params = db.connect_kwargs(cfg)
+                    params['dbname'] = params.pop('database')
+                    conninfo, min_size = make_conninfo(**params), cfg['DB_POOL_MIN']
+                else:
+                    # Like the replica pools in db.py, connect on first use only
+                    conninfo, min_size = dsn, 0
+                _runners[dsn] = AsyncQueryRunner(conninfo,
+                                                 min_size=min_size,
+                                                 max_size=cfg['DB_ASYNC_POOL_MAX'],
+                                                 timeout=cfg['DB_POOL_TIMEOUT'])
+    return _runners[dsn]
+
+
+def enabled():
+    return current_app.config['DB_ASYNC']
+
+
+def init_app(app):
+    app.config.setdefault('DB_ASYNC', os.environ.get('DB_ASYNC', '').lower() in ('1', 'true', 'yes'))
+    app.config.setdefault('DB_ASYNC_POOL_MAX', int(os.environ.get('DB_ASYNC_POOL_MAX', 20)))
@@ -0,0 +1,8 @@
+"""Load-testing benchmarks: synthetic data (datagen), load driver (driver), reports (report)
+and the prepared-statement micro-benchmark (statements).
+
+    python -m bench generate --users 1000 --books 20000
+    python -m bench run --concurrency 8 --output before.json
+    python -m bench compare before.json after.json
+    python -m bench statements --output statements.json
+"""
@@ -0,0 +1,112 @@
+import argparse
+import functools
+import sys
+
+import psycopg2
+
+from bench import datagen, driver, report, statements
+
+
+def _connect():
+    from app import app
+    import db
+    return psycopg2.connect(**db.connect_kwargs(app.config))
+
+
+def cmd_generate(args):
+    conn = _connect()
+    try:
+        summary = datagen.generate(conn, users=args.users, books=args.books, requests=args.requests,
+                                   reviews=args.reviews, notifications=args.notifications, seed=args.seed)
+    finally:
+        conn.close()
+    print("Generated %s" % summary)
+
+
+def cmd_run(args):
+    conn = _connect()
+    try:
+        dataset = driver.load_dataset(conn, first_user_id=args.first_user_id)
+    finally:
+        conn.close()
+    if not dataset['user_ids'] or not dataset['book_ids']:
+        sys.exit("No data to run against; run `python -m bench generate` first")
+
+    if args.base_url:
+        make_session = functools.partial(driver.HttpSession, args.base_url)
+        mode = 'http'
+    else:
+        from app import app
+        app.config['DB_POOL_MAX'] = max(app.config['DB_POOL_MAX'], args.concurrency)
+        make_session = functools.partial(driver.TestClientSession, app)
+        mode = 'test_client'
+
+    results, duration = driver.run(make_session, dataset, routes=args.routes, concurrency=args.concurrency,
+                                   requests_per_route=args.requests, seed=args.seed)
+    result = report.summarize(results, duration, mode=mode, concurrency=args.concurrency,
+                              requests_per_route=args.requests, base_url=args.base_url)
+    print(report.format_table(result))
+    if args.output:
+        report.save(result, args.output)
+        print("Saved %s" % args.output)
+
+
+def cmd_statements(args):
+    import plan_check
+    conn = _connect()
+    try:
+        dataset = driver.load_dataset(conn, first_user_id=args.first_user_id)
+        params = dict(plan_check.DEFAULT_PARAMS, user_id=dataset['user_ids'][0], book_id=dataset['book_ids'][0])
+        result = statements.run(conn, params, iterations=args.iterations)
+    finally:
+        conn.close()
+    print(statements.format_table(result))
+    if args.output:
+        report.save(result, args.output)
+        print("Saved %s" % args.output)
+
+
+def cmd_compare(args):
+    print(report.compare(report.load(args.baseline), report.load(args.current)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description="BookSwap load-testing benchmarks")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    gen = sub.add_parser('generate', help="load a synthetic dataset with COPY")
+    gen.add_argument('--users', type=int, default=1000)
+    gen.add_argument('--books', type=int, default=20000)
+    gen.add_argument('--requests', type=int, default=40000)
+    gen.add_argument('--reviews', type=int, default=10000)
+    gen.add_argument('--notifications', type=int, default=100000)
+    gen.add_argument('--seed', type=int, default=42)
+    gen.set_defaults(func=cmd_generate)
+
+    run = sub.add_parser('run', help="drive load at the routes and report latency")
+    run.add_argument('--concurrency', type=int, default=8)
+    run.add_argument('--requests', type=int, default=200, help="requests per route")
+    run.add_argument('--routes', nargs='+', choices=sorted(driver.ROUTES), help="default: all")
+    run.add_argument('--base-url', help="hit a running server (e.g. http://127.0.0.1:8000) instead of the test client")
+    run.add_argument('--first-user-id', type=int, help="first generated user (default: looked up)")
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--output', '-o', help="save the report as JSON")
+    run.set_defaults(func=cmd_run)
+
+    stm = sub.add_parser('statements', help="prepared vs inline statements: planning time and round trips per page")
+    stm.add_argument('--iterations', type=int, default=200)
+    stm.add_argument('--first-user-id', type=int, help="user to run as (default: the first generated one)")
+    stm.add_argument('--output', '-o', help="save the result as JSON")
+    stm.set_defaults(func=cmd_statements)
+
+    cmp = sub.add_parser('compare', help="compare two saved reports")
+    cmp.add_argument('baseline')
+    cmp.add_argument('current')
+    cmp.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import io
+import random
+from datetime import datetime, timedelta
+
+GENRES = ['Fiction', 'Mystery', 'Fantasy', 'Science Fiction', 'Romance', 'History', 'Biography',
+          'Self-help', 'Poetry', 'Thriller', 'Horror', 'Philosophy', 'Science', 'Travel', 'Comics']
+WORDS = ['shadow', 'river', 'night', 'garden', 'empire', 'secret', 'silent', 'winter', 'glass', 'crown',
+         'house', 'stone', 'fire', 'ocean', 'memory', 'city', 'wolf', 'letter', 'island', 'storm',
+         'golden', 'last', 'hidden', 'broken', 'wild', 'northern', 'paper', 'iron', 'lost', 'summer']
+FIRST_NAMES = ['Ada', 'Ben', 'Chen', 'Dana', 'Eli', 'Fatima', 'Goran', 'Hana', 'Ivan', 'Jade',
+               'Kofi', 'Lena', 'Mateo', 'Nia', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sven', 'Tara']
+LAST_NAMES = ['Adams', 'Banerjee', 'Costa', 'Dubois', 'Eriksen', 'Fischer', 'Garcia', 'Haddad',
+              'Ito', 'Jensen', 'Kowalski', 'Lopez', 'Mwangi', 'Novak', 'Okafor', 'Park']
+
+# Password every generated user logs in with
+PASSWORD = 'bench'
+
+
+class Zipf:
+    """Draws 0..n-1 with P(k) proportional to 1/(k+1)**s: a few very popular items, a long tail"""
+
+    def __init__(self, n, s=1.1, rng=random):
+        total = 0.0
+        self.cum_weights = []
+        for k in range(n):
+            total += 1.0 / (k + 1) ** s
+            self.cum_weights.append(total)
+        self.population = range(n)
+        self.rng = rng
+
+    def draw(self, k=1):
+        return self.rng.choices(self.population, cum_weights=self.cum_weights, k=k)
+
+
+def _copy(cursor, table, columns, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join('\\N' if v is None else str(v).replace('\\', '\\\\').replace('\t', ' ').replace('\n', ' ')
+                            for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_expert("COPY %s (%s) FROM STDIN" % (table, ', '.join(columns)), buf)
+
+
+def _next_id(cursor, table, column):
+    cursor.execute("SELECT coalesce(max(%s), 0) + 1 FROM %s" % (column, table))
+    return cursor.fetchone()[0]
+
+
+def generate(conn, users=1000, books=20000, requests=40000, reviews=10000, notifications=100000,
+             seed=42, days=365, log=print):
+    """Load a synthetic dataset with COPY, on top of whatever is already there.
+
+    Ownership, demand and activity are Zipf-skewed: a few heavy users own and
+    request most books, a few popular books draw most requests. Triggers that
+    would fire per row (pg_notify, user_stats) are disabled for the load and
+    the aggregates they maintain are rebuilt once at the end.
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    start = now - timedelta(days=days)
+
+    def ts():
+        return start + timedelta(seconds=rng.random() * days * 86400)
+
+    cursor = conn.cursor()
+    cursor.execute("ALTER TABLE notifications DISABLE TRIGGER USER")
+    cursor.execute("ALTER TABLE users DISABLE TRIGGER USER")
+    cursor.execute("ALTER TABLE books DISABLE TRIGGER USER")
+    cursor.execute("ALTER TABLE swap_requests DISABLE TRIGGER USER")
+    cursor.execute("ALTER TABLE reviews DISABLE TRIGGER USER")
+
+    first_user = _next_id(cursor, 'users', 'user_id')
+    first_book = _next_id(cursor, 'books', 'book_id')
+    first_request = _next_id(cursor, 'swap_requests', 'request_id')
+    user_ids = [first_user + i for i in range(users)]
+    user_pick = Zipf(users, rng=rng)
+    book_pick = Zipf(books, rng=rng)
+
+    log("users: %d" % users)
+    _copy(cursor, 'users', ['user_id', 'name', 'email', 'password', 'created_at'],
+          ((uid, '%s %s' % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+            'bench_user_%d@example.com' % uid, PASSWORD, start) for uid in user_ids))
+
+    log("books: %d" % books)
+    owners = [user_ids[i] for i in user_pick.draw(books)]
+    book_rows = []
+    for i in range(books):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 4))).title()
+        author = '%s %s' % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+        book_rows.append([first_book + i, owners[i], title, author, rng.choice(GENRES), 'available', ts()])
+
+    log("swap requests: %d" % requests)
+    request_rows = []
+    active_swap_rows = []
+    swapped = set()
+    for i, b in enumerate(book_pick.draw(requests)):
+        book = book_rows[b]
+        sender = user_ids[user_pick.draw()[0]]
+        if sender == book[1]:
+            continue
+        roll = rng.random()
+        if roll < 0.15 and book[0] not in swapped:
+            status = 'accepted'
+            swapped.add(book[0])
+            book[5] = 'swapped'
+            active_swap_rows.append((book[0], book[1], sender, ts()))
+        elif roll < 0.4:
+            status = 'rejected'
+        else:
+            status = 'pending'
+        request_rows.append([first_request + i, book[0], sender, book[1], status, ts()])
+    # Accepting a request turns down the rest (see accept_swap_requests)
+    for r in request_rows:
+        if r[4] == 'pending' and r[1] in swapped:
+            r[4] = 'rejected'
+
+    _copy(cursor, 'books', ['book_id', 'user_id', 'title', 'author', 'genre', 'status', 'created_at'], book_rows)
+    _copy(cursor, 'swap_requests', ['request_id', 'book_id', 'sender_id', 'receiver_id', 'status', 'created_at'],
+          request_rows)
+    _copy(cursor, 'active_swaps', ['book_id', 'owner_id', 'holder_id', 'swap_date'], active_swap_rows)
+
+    log("reviews: %d" % reviews)
+    accepted = [r for r in request_rows if r[4] == 'accepted']
+    if accepted:
+        _copy(cursor, 'reviews', ['reviewer_id', 'reviewed_id', 'book_id', 'rating', 'comment', 'created_at'],
+              ((r[2], r[3], r[1], rng.choices([1, 2, 3, 4, 5], weights=[1, 1, 3, 6, 8])[0],
+                'Generated review', ts())
+               for r in (rng.choice(accepted) for _ in range(reviews))))
+
+    log("notifications: %d" % notifications)
+    _copy(cursor, 'notifications', ['user_id', 'type', 'content', 'status', 'created_at'],
+          ((user_ids[u], rng.choice(['swap_request', 'review', 'return_request']), 'Generated notification',
+            'unread' if rng.random() < 0.2 else 'read', ts())
+           for u in user_pick.draw(notifications)))
+
+    for table, column in (('users', 'user_id'), ('books', 'book_id'), ('swap_requests', 'request_id'),
+                          ('active_swaps', 'swap_id'), ('reviews', 'review_id'),
+                          ('notifications', 'notification_id')):
+        cursor.execute("SELECT setval(pg_get_serial_sequence(%s, %s), (SELECT max(" + column + ") FROM " + table + "))",
+                       (table, column))
+
+    for table in ('notifications', 'users', 'books', 'swap_requests', 'reviews'):
+        cursor.execute("ALTER TABLE %s ENABLE TRIGGER USER" % table)
+
+    log("rebuilding aggregates")
+    cursor.execute("SELECT rebuild_user_stats()")
+    cursor.execute("SELECT rebuild_book_ratings()")
+    cursor.execute("""
+        UPDATE users u SET unread_notifications = c.n
+        FROM (SELECT user_id, count(*) AS n FROM notifications WHERE status='unread' GROUP BY user_id) c
+        WHERE u.user_id = c.user_id AND u.user_id >= %s
+    """, (first_user,))
+    conn.commit()
+
+    cursor.execute("ANALYZE")
+    conn.commit()
+    cursor.close()
+    return {'first_user_id': first_user, 'users': users, 'books': books, 'swap_requests': len(request_rows),
+            'reviews': reviews if accepted else 0, 'notifications': notifications}
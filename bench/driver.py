@@ -0,0 +1,137 @@
+import http.cookiejar
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.datagen import PASSWORD
+
+# Read-heavy routes exercised by the driver; each maps to a function that
+# picks a URL for one request given the run's random generator and dataset
+ROUTES = {
+    'available_books': lambda rng, ds: '/available_books',
+    'available_books_genre': lambda rng, ds: '/available_books?genre=Fiction',
+    'search': lambda rng, ds: '/search?q=' + rng.choice(['shadow', 'winter river', 'golden crown', 'storm']),
+    'book_details': lambda rng, ds: '/book_details/%d' % rng.choice(ds['book_ids']),
+    'swap_requests': lambda rng, ds: '/swap_requests',
+    'my_return_requests': lambda rng, ds: '/return_requests',
+    'reviews': lambda rng, ds: '/reviews',
+    'profile': lambda rng, ds: '/profile',
+    'my_books': lambda rng, ds: '/my_books',
+    'notifications': lambda rng, ds: '/notifications',
+}
+
+
+# -----------------------------
+# Query Counting
+# -----------------------------
+_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def server_queries(header):
+    """Query count from the Server-Timing header the app sets (see instrumentation.py)"""
+    match = _QUERIES.search(header or '')
+    return int(match.group(1)) if match else None
+
+
+# -----------------------------
+# Clients
+# -----------------------------
+class TestClientSession:
+    """Requests through the Flask test client, in process"""
+
+    def __init__(self, app, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['user_name'] = 'bench user %d' % user_id
+
+    def get(self, url):
+        response = self.client.get(url)
+        response.get_data()
+        return response.status_code, server_queries(response.headers.get('Server-Timing'))
+
+
+class HttpSession:
+    """Requests against a running server (e.g. gunicorn) over HTTP"""
+
+    def __init__(self, base_url, user_id):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        form = urllib.parse.urlencode({'email': 'bench_user_%d@example.com' % user_id, 'password': PASSWORD})
+        self.opener.open(self.base_url + '/login', form.encode()).read()
+
+    def get(self, url):
+        try:
+            with self.opener.open(self.base_url + url) as response:
+                response.read()
+                return response.status, server_queries(response.headers.get('Server-Timing'))
+        except urllib.error.HTTPError as e:
+            return e.code, server_queries(e.headers.get('Server-Timing'))
+
+
+# -----------------------------
+# Load Driver
+# -----------------------------
+def load_dataset(conn, first_user_id=None, sample=1000):
+    """User and book ids to draw requests from"""
+    cursor = conn.cursor()
+    if first_user_id is None:
+        cursor.execute("SELECT min(user_id) FROM users WHERE email LIKE 'bench\\_user\\_%%'")
+        first_user_id = cursor.fetchone()[0] or 1
+    cursor.execute("SELECT user_id FROM users WHERE user_id >= %s ORDER BY user_id LIMIT %s", (first_user_id, sample))
+    user_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT book_id FROM books TABLESAMPLE SYSTEM (10) LIMIT %s", (sample,))
+    book_ids = [row[0] for row in cursor.fetchall()]
+    if not book_ids:
+        cursor.execute("SELECT book_id FROM books LIMIT %s", (sample,))
+        book_ids = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    conn.rollback()
+    return {'user_ids': user_ids, 'book_ids': book_ids}
+
+
+def run(make_session, dataset, routes=None, concurrency=8, requests_per_route=200, seed=1):
+    """Hit every route `requests_per_route` times from `concurrency` threads.
+
+    Each thread logs in as its own user (heavier users first, matching the
+    generator's skew) and issues its share of requests in a shuffled order.
+    Returns ({route: {'latencies', 'queries', 'errors', 'busy'}}, wall-clock
+    seconds for the whole run).
+    """
+    routes = routes or list(ROUTES)
+    work = [route for route in routes for _ in range(requests_per_route)]
+    random.Random(seed).shuffle(work)
+    shares = [work[i::concurrency] for i in range(concurrency)]
+    results = {route: {'latencies': [], 'queries': [], 'errors': 0, 'busy': 0.0} for route in routes}
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        session = make_session(dataset['user_ids'][index % len(dataset['user_ids'])])
+        for route in shares[index]:
+            url = ROUTES[route](rng, dataset)
+            start = time.perf_counter()
+            try:
+                status, queries = session.get(url)
+            except Exception:
+                status, queries = None, None
+            elapsed = time.perf_counter() - start
+            with lock:
+                result = results[route]
+                result['busy'] += elapsed
+                if status is None or status >= 500:
+                    result['errors'] += 1
+                    continue
+                result['latencies'].append(elapsed)
+                if queries is not None:
+                    result['queries'].append(queries)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return results, time.perf_counter() - started
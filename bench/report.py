@@ -0,0 +1,99 @@
+import json
+import math
+import os
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(results, duration, **meta):
+    """Turn raw driver results into the report saved as JSON"""
+    routes = {}
+    total = 0
+    for route, result in results.items():
+        latencies = sorted(result['latencies'])
+        queries = result['queries']
+        total += len(latencies)
+        routes[route] = {
+            'requests': len(latencies),
+            'errors': result['errors'],
+            'p50_ms': _ms(percentile(latencies, 50)),
+            'p95_ms': _ms(percentile(latencies, 95)),
+            'p99_ms': _ms(percentile(latencies, 99)),
+            'mean_ms': _ms(sum(latencies) / len(latencies)) if latencies else None,
+            'max_ms': _ms(latencies[-1]) if latencies else None,
+            # Requests served per second of time spent on this route, per client
+            'throughput_rps': round(len(latencies) / result['busy'], 1) if result['busy'] else None,
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        }
+    meta.setdefault('commit', git_commit())
+    meta.setdefault('timestamp', datetime.now(timezone.utc).isoformat(timespec='seconds'))
+    meta.setdefault('python', platform.python_version())
+    meta.setdefault('pid', os.getpid())
+    return {
+        'meta': meta,
+        'duration_s': round(duration, 2),
+        'throughput_rps': round(total / duration, 1) if duration else None,
+        'routes': routes,
+    }
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def format_table(report):
+    """Plain-text table of a report, one row per route"""
+    lines = ['%-24s %7s %6s %9s %9s %9s %9s %8s' % ('route', 'reqs', 'errs', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                   'rps', 'queries')]
+    for route, r in sorted(report['routes'].items()):
+        lines.append('%-24s %7d %6d %9s %9s %9s %9s %8s' % (
+            route, r['requests'], r['errors'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            r['throughput_rps'], '-' if r['queries_per_request'] is None else r['queries_per_request']))
+    lines.append('total: %s req/s over %ss (commit %s, concurrency %s)' % (
+        report['throughput_rps'], report['duration_s'], report['meta'].get('commit'),
+        report['meta'].get('concurrency')))
+    return '\n'.join(lines)
+
+
+def compare(baseline, current):
+    """Plain-text p95 / queries-per-request comparison of two reports"""
+    lines = ['%-24s %11s %11s %8s %9s %9s' % ('route', 'base p95', 'new p95', 'change', 'base q', 'new q')]
+    for route in sorted(set(baseline['routes']) | set(current['routes'])):
+        before = baseline['routes'].get(route, {})
+        after = current['routes'].get(route, {})
+        b, a = before.get('p95_ms'), after.get('p95_ms')
+        change = '%+.0f%%' % ((a - b) / b * 100) if a is not None and b else '-'
+        lines.append('%-24s %11s %11s %8s %9s %9s' % (
+            route, b, a, change, before.get('queries_per_request'), after.get('queries_per_request')))
+    lines.append('throughput: %s -> %s req/s (%s -> %s)' % (
+        baseline['throughput_rps'], current['throughput_rps'],
+        baseline['meta'].get('commit'), current['meta'].get('commit')))
+    return '\n'.join(lines)
@@ -0,0 +1,92 @@
+import json
+import time
+
+import psycopg2.extras
+
+import repository
+
+# Statements each page runs per request, and how many round trips the page
+# took before its queries moved to the repository
+PAGES = {
+    'available_books': ([repository.AVAILABLE_BOOKS[('newest', False, False, False, False)]], 1),
+    'search': ([repository.SEARCH], 1),
+    'book_details': ([repository.BOOK_VERSION, repository.BOOK, repository.BOOK_REVIEWS], 3),
+    'swap_requests': ([repository.SWAP_REQUEST_LISTS], 2),
+    'my_return_requests': ([repository.RETURN_REQUEST_LISTS], 2),
+    'reviews': ([repository.REVIEWS_VERSION, repository.REVIEWS_RECEIVED, repository.REVIEWS_GIVEN], 3),
+    'profile': ([repository.PROFILE], 1),
+    'my_books': ([repository.MY_BOOKS], 1),
+    'notifications': ([repository.NOTIFICATIONS], 1),
+}
+
+
+def _planning_ms(cursor, sql, params):
+    cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Planning Time']
+
+
+def _timed(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def measure_statement(conn, stmt, params, iterations=200):
+    """Client-side latency and server planning time of one statement, inline vs prepared"""
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    params = {k: v for k, v in params.items() if k in stmt.params}
+
+    def inline():
+        cursor.execute(stmt.sql, params)
+        cursor.fetchall()
+
+    def prepared():
+        repository.execute(cursor, stmt, params)
+        cursor.fetchall()
+
+    try:
+        inline_ms = _timed(inline, iterations)
+        inline_plan = _planning_ms(cursor, stmt.sql, params)
+        prepared_ms = _timed(prepared, iterations)
+        # After the warm-up above Postgres has had its five custom plans and may now reuse a generic one
+        prepared_plan = _planning_ms(cursor, stmt.execute_sql, params)
+    finally:
+        cursor.close()
+        conn.rollback()
+    return {
+        'inline_ms': round(inline_ms, 3),
+        'prepared_ms': round(prepared_ms, 3),
+        'inline_planning_ms': round(inline_plan, 3),
+        'prepared_planning_ms': round(prepared_plan, 3),
+    }
+
+
+def run(conn, params, iterations=200):
+    """Per-statement timings and per-page planning time and round trips saved"""
+    statements = {}
+    for stmt in repository.STATEMENTS:
+        statements[stmt.name] = measure_statement(conn, stmt, params, iterations)
+    pages = {}
+    for page, (stmts, round_trips_before) in PAGES.items():
+        pages[page] = {
+            'round_trips_before': round_trips_before,
+            'round_trips': len(stmts),
+            'planning_ms_saved': round(sum(statements[s.name]['inline_planning_ms'] -
+                                           statements[s.name]['prepared_planning_ms'] for s in stmts), 3),
+            'latency_ms_saved': round(sum(statements[s.name]['inline_ms'] -
+                                          statements[s.name]['prepared_ms'] for s in stmts), 3),
+        }
+    return {'iterations': iterations, 'params': {k: str(v) for k, v in params.items()},
+            'statements': statements, 'pages': pages}
+
+
+def format_table(result):
+    lines = ['%-22s %11s %13s %16s %15s' % ('page', 'round trips', 'before', 'planning saved', 'latency saved')]
+    for page, r in result['pages'].items():
+        lines.append('%-22s %11d %13d %13.3f ms %12.3f ms' % (
+            page, r['round_trips'], r['round_trips_before'], r['planning_ms_saved'], r['latency_ms_saved']))
+    return '\n'.join(lines)
@@ -0,0 +1,145 @@
+import csv
+import io
+import json
+
+import psycopg2
+
+# Column limits from the books table
+MAX_TITLE = 200
+MAX_AUTHOR = 200
+MAX_GENRE = 100
+
+# Keep at most this many per-row errors in the report; the count stays exact
+MAX_REPORTED_ERRORS = 100
+
+
+def detect_format(filename):
+    """'csv' or 'jsonl' from a file name, or None if it can't be told"""
+    name = (filename or '').lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return None
+
+
+def _read_csv(stream):
+    reader = csv.DictReader(stream)
+    missing = {'title', 'author'} - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError("CSV header is missing: %s" % ', '.join(sorted(missing)))
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _read_jsonl(stream):
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_no, e
+            continue
+        yield line_no, row if isinstance(row, dict) else ValueError("expected a JSON object")
+
+
+def _check_text(name, value):
+    # PostgreSQL text can't hold NUL, and JSON can smuggle in lone surrogates
+    # that have no UTF-8 form; either would fail the whole COPY
+    if '\x00' in value:
+        raise ValueError("%s contains a NUL character" % name)
+    try:
+        value.encode('utf-8')
+    except UnicodeEncodeError:
+        raise ValueError("%s is not valid Unicode" % name)
+
+
+def _clean(row):
+    """Return (title, author, genre) for a valid row, or raise ValueError"""
+    if isinstance(row, Exception):
+        raise ValueError(str(row))
+    title = str(row.get('title') or '').strip()
+    author = str(row.get('author') or '').strip()
+    genre = str(row.get('genre') or '').strip() or None
+    for name, value in (('title', title), ('author', author), ('genre', genre or '')):
+        _check_text(name, value)
+    if not title:
+        raise ValueError("title is required")
+    if not author:
+        raise ValueError("author is required")
+    if len(title) > MAX_TITLE:
+        raise ValueError("title is longer than %d characters" % MAX_TITLE)
+    if len(author) > MAX_AUTHOR:
+        raise ValueError("author is longer than %d characters" % MAX_AUTHOR)
+    if genre and len(genre) > MAX_GENRE:
+        raise ValueError("genre is longer than %d characters" % MAX_GENRE)
+    return title, author, genre
+
+
+def _copy_chunk(cursor, user_id, rows):
+    buf = io.StringIO()
+    # Quote everything so no value can be read as the \. end-of-data marker;
+    # FORCE_NULL turns the (quoted) empty genre back into NULL
+    writer = csv.writer(buf, quoting=csv.QUOTE_ALL)
+    for _, (title, author, genre) in rows:
+        writer.writerow((user_id, title, author, genre or ''))
+    buf.seek(0)
+    cursor.copy_expert("COPY books (user_id, title, author, genre) FROM STDIN WITH (FORMAT csv, FORCE_NULL (genre))", buf)
+
+
+def import_books(conn, user_id, stream, fmt, chunk_size=5000):
+    """Stream rows from a CSV (title,author[,genre] header) or JSON Lines text
+    stream into books owned by user_id, loading valid rows with COPY in chunks.
+
+    Invalid rows are skipped and reported; they never abort the import. A
+    chunk the database rejects is rolled back and loaded again in halves,
+    down to single rows, so only the rows it refuses are reported. Returns {'imported', 'failed', 'errors'} where errors
+    is a list of (line number, message).
+    """
+    rows = _read_csv(stream) if fmt == 'csv' else _read_jsonl(stream)
+    result = {'imported': 0, 'failed': 0, 'errors': []}
+
+    def fail(line_no, message):
+        result['failed'] += 1
+        if len(result['errors']) < MAX_REPORTED_ERRORS:
+            result['errors'].append((line_no, message))
+
+    cursor = conn.cursor()
+
+    def flush(chunk):
+        cursor.execute("SAVEPOINT import_chunk")
+        try:
+            _copy_chunk(cursor, user_id, chunk)
+            cursor.execute("RELEASE SAVEPOINT import_chunk")
+            result['imported'] += len(chunk)
+            return
+        except psycopg2.Error as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT import_chunk")
+            cursor.execute("RELEASE SAVEPOINT import_chunk")
+            error = e
+        # Bisect: a few bad rows cost a few extra COPYs per chunk, not the chunk
+        if len(chunk) == 1:
+            fail(chunk[0][0], "rejected by the database: %s" % str(error).strip().splitlines()[0])
+            return
+        middle = len(chunk) // 2
+        flush(chunk[:middle])
+        flush(chunk[middle:])
+
+    chunk = []
+    try:
+        for line_no, row in rows:
+            try:
+                chunk.append((line_no, _clean(row)))
+            except ValueError as e:
+                fail(line_no, str(e))
+                continue
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+        conn.commit()
+    finally:
+        cursor.close()
+    return result
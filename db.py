@@ -0,0 +1,373 @@
+import itertools
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from flask import g, current_app, has_request_context, request, session
+
+log = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the pool timeout"""
+
+
+# -----------------------------
+# Connection Pool
+# -----------------------------
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections.
+
+    Callers block (up to ``timeout`` seconds) when all ``maxconn`` connections
+    are checked out. Connections that sat idle longer than
+    ``healthcheck_after`` seconds are pinged before being handed out, and
+    replaced if the server went away.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=30.0, healthcheck_after=30.0, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self._connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle = []  # (conn, last_used) pairs, most recently used last
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        return psycopg2.connect(**self._connect_kwargs)
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """Check out a connection, waiting for one to be returned if needed"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    conn, last_used = None, None
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout("no connection available after %.1fs" % self.timeout)
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            waited = time.monotonic() - start
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                self._close_quietly(conn)
+                with self._cond:
+                    self._discarded += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            # The slot was reserved above; give it back so waiters can retry
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, rolling back any open transaction"""
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed:
+                self._size -= 1
+                self._discarded += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if discard:
+            self._close_quietly(conn)
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'wait_time_total': round(self._wait_total, 6),
+                'wait_time_max': round(self._wait_max, 6),
+                'wait_time_avg': round(self._wait_total / self._checkouts, 6) if self._checkouts else 0.0,
+            }
+
+
+# -----------------------------
+# Flask Integration
+# -----------------------------
+def connect_kwargs(config):
+    """psycopg2.connect() arguments for the database configured on the app"""
+    return {
+        'host': config['DB_HOST'],
+        'user': config['DB_USER'],
+        'password': config['DB_PASSWORD'],
+        'database': config['DB_NAME'],
+        'port': config['DB_PORT'],
+    }
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _new_pool(minconn=None, **kwargs):
+    cfg = current_app.config
+    return ConnectionPool(
+        cfg['DB_POOL_MIN'] if minconn is None else minconn,
+        cfg['DB_POOL_MAX'],
+        timeout=cfg['DB_POOL_TIMEOUT'],
+        healthcheck_after=cfg['DB_POOL_HEALTHCHECK_AFTER'],
+        connection_factory=cfg['DB_CONNECTION_FACTORY'],
+        **kwargs
+    )
+
+
+def get_pool():
+    """Return this worker's pool, creating it on first use (and after a fork)"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                # Connections inherited across a fork belong to the parent; drop them unclosed
+                _pool = _new_pool(**connect_kwargs(current_app.config))
+                _pool_pid = os.getpid()
+    return _pool
+
+
+# -----------------------------
+# Read Replicas
+# -----------------------------
+class Replica:
+    """A streaming replica: its pool and the highest WAL position seen replayed"""
+
+    def __init__(self, dsn, pool):
+        self.dsn = dsn
+        self.pool = pool
+        self.replayed_lsn = 0
+        self.down_until = 0.0
+
+
+def parse_lsn(text):
+    """'16/B374D848' -> int, so WAL positions compare in Python"""
+    high, low = text.split('/')
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+_replicas = None
+_replicas_pid = None
+_replica_turn = itertools.count()
+
+
+def get_replicas():
+    """This worker's replicas (DB_REPLICAS), pools created on first use.
+
+    Replica pools start empty: their first connection is made by
+    _checkout_replica, which falls back to the primary if a replica is down.
+    """
+    global _replicas, _replicas_pid
+    if _replicas is None or _replicas_pid != os.getpid():
+        with _pool_lock:
+            if _replicas is None or _replicas_pid != os.getpid():
+                _replicas = [Replica(dsn, _new_pool(minconn=0, dsn=dsn)) for dsn in current_app.config['DB_REPLICAS']]
+                _replicas_pid = os.getpid()
+    return _replicas
+
+
+def _caught_up(replica, conn, min_lsn):
+    """True if the replica has replayed WAL up to min_lsn.
+
+    Replay only moves forward, so once a position is confirmed the check is
+    answered from memory for every older position.
+    """
+    if replica.replayed_lsn >= min_lsn:
+        return True
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_last_wal_replay_lsn()::text")
+    replayed = cursor.fetchone()[0]
+    cursor.close()
+    conn.rollback()
+    if replayed is None:
+        # Not in recovery (promoted, or misconfigured as a primary): it has everything it knows of
+        return True
+    replica.replayed_lsn = max(replica.replayed_lsn, parse_lsn(replayed))
+    return replica.replayed_lsn >= min_lsn
+
+
+def _checkout_replica():
+    """A (pool, connection) on a replica that has this session's own writes, or None"""
+    replicas = get_replicas()
+    min_lsn = session.get('db_lsn')
+    min_lsn = parse_lsn(min_lsn) if min_lsn else 0
+    start = next(_replica_turn)
+    now = time.monotonic()
+    for i in range(len(replicas)):
+        index = (start + i) % len(replicas)
+        replica = replicas[index]
+        if replica.down_until > now:
+            continue
+        try:
+            conn = replica.pool.getconn()
+        except (PoolTimeout, psycopg2.Error):
+            log.warning("Replica %d unavailable; skipping it for %ss", index,
+                        current_app.config['DB_REPLICA_RETRY_AFTER'], exc_info=True)
+            replica.down_until = now + current_app.config['DB_REPLICA_RETRY_AFTER']
+            continue
+        try:
+            if _caught_up(replica, conn, min_lsn):
+                return replica.pool, conn
+        except psycopg2.Error:
+            replica.pool.putconn(conn, discard=True)
+            continue
+        replica.pool.putconn(conn)
+    return None
+
+
+def current_replica():
+    """The Replica the current request's connection came from, or None if it is on the primary"""
+    if not current_app.config['DB_REPLICAS']:
+        return None
+    pool = g.get('db_pool')
+    for replica in get_replicas():
+        if replica.pool is pool:
+            return replica
+    return None
+
+
+def read_only(view):
+    """Mark a view as read-only: its connection may come from a replica"""
+    view.read_only = True
+    return view
+
+
+def _is_read_only_request():
+    if not has_request_context():
+        return False
+    return getattr(current_app.view_functions.get(request.endpoint), 'read_only', False)
+
+
+def get_db_connection():
+    """Get the connection checked out for the current request.
+
+    Views marked @read_only are served from a replica (DB_REPLICAS) that has
+    replayed this session's last write; everything else, and every read-only
+    request no replica can serve, uses the primary.
+    """
+    if 'db' not in g:
+        checkout = None
+        if current_app.config['DB_REPLICAS'] and _is_read_only_request():
+            checkout = _checkout_replica()
+        if checkout is None:
+            checkout = get_pool(), get_pool().getconn()
+        g.db_pool, g.db = checkout
+    return g.db
+
+
+def remember_write_position(response):
+    """After a request that used the primary, pin the session's reads to its WAL position"""
+    if 'db' in g and g.db_pool is get_pool() and current_app.config['DB_REPLICAS'] and not _is_read_only_request():
+        try:
+            cursor = g.db.cursor()
+            cursor.execute("SELECT pg_current_wal_lsn()::text")
+            session['db_lsn'] = cursor.fetchone()[0]
+            cursor.close()
+        except psycopg2.Error:
+            log.warning("Could not read the primary's WAL position", exc_info=True)
+    return response
+
+
+def close_db_connection(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        # putconn() rolls back whatever the request left uncommitted
+        g.pop('db_pool').putconn(conn)
+
+
+def init_app(app):
+    app.config.setdefault('DB_HOST', os.environ.get('DB_HOST', 'localhost'))
+    app.config.setdefault('DB_USER', os.environ.get('DB_USER', 'postgres'))
+    app.config.setdefault('DB_PASSWORD', os.environ.get('DB_PASSWORD', 'admin'))
+    app.config.setdefault('DB_NAME', os.environ.get('DB_NAME', 'book_exchange'))
+    app.config.setdefault('DB_PORT', os.environ.get('DB_PORT', '5432'))
+    app.config.setdefault('DB_POOL_MIN', int(os.environ.get('DB_POOL_MIN', 1)))
+    app.config.setdefault('DB_POOL_MAX', int(os.environ.get('DB_POOL_MAX', 10)))
+    app.config.setdefault('DB_POOL_TIMEOUT', float(os.environ.get('DB_POOL_TIMEOUT', 30)))
+    app.config.setdefault('DB_POOL_HEALTHCHECK_AFTER', float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', 30)))
+    # psycopg2 connection subclass for pooled connections (None = the default)
+    app.config.setdefault('DB_CONNECTION_FACTORY', None)
+    # Streaming replicas for read-only views, as libpq DSNs separated by ';'
+    app.config.setdefault('DB_REPLICAS', [dsn.strip() for dsn in os.environ.get('DB_REPLICAS', '').split(';')
+                                          if dsn.strip()])
+    # Seconds to stop trying a replica that refused a connection
+    app.config.setdefault('DB_REPLICA_RETRY_AFTER', float(os.environ.get('DB_REPLICA_RETRY_AFTER', 10)))
+    app.after_request(remember_write_position)
+    app.teardown_appcontext(close_db_connection)
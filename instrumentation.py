@@ -0,0 +1,243 @@
+import logging
+import os
+import re
+import threading
+import time
+
+import psycopg2.extensions
+from flask import g, has_request_context, request
+
+log = logging.getLogger(__name__)
+
+# Latency buckets (seconds) shared by the request and DB time histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Endpoints left out of the request metrics
+UNTRACKED_ENDPOINTS = {'metrics', 'static', 'assets'}
+
+# Statements at least this slow are logged; set from SLOW_QUERY_MS by init_app
+_slow_query_ms = 200.0
+
+
+# -----------------------------
+# Metrics Registry
+# -----------------------------
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+
+    def observe(self, label_values, value):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for label_values, series in sorted(self._series.items()):
+            labels = _labels(self.labels, label_values)
+            for bound, count in zip(self.buckets, series):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels, bound, count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, labels, series[-2]))
+            lines.append('%s_count{%s} %d' % (self.name, labels, series[-2]))
+            lines.append('%s_sum{%s} %.6f' % (self.name, labels, series[-1]))
+        return lines
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values"""
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+
+    def inc(self, label_values, amount=1):
+        self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        for label_values, value in sorted(self._series.items()):
+            lines.append('%s{%s} %s' % (self.name, _labels(self.labels, label_values), value))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+class Metrics:
+    """Per-worker request and database metrics, rendered in Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_duration = Histogram('bookswap_request_duration_seconds',
+                                          'Time to produce a response, by endpoint.',
+                                          ('endpoint', 'method', 'status'))
+        self.request_db_time = Histogram('bookswap_request_db_seconds',
+                                         'Time spent in SQL statements per request, by endpoint.',
+                                         ('endpoint',))
+        self.queries = Counter('bookswap_db_queries_total', 'SQL statements executed, by endpoint.', ('endpoint',))
+        self.slow_queries = Counter('bookswap_db_slow_queries_total',
+                                    'SQL statements slower than SLOW_QUERY_MS, by endpoint.', ('endpoint',))
+
+    def observe_request(self, endpoint, method, status, duration, db_time, queries):
+        with self._lock:
+            self.request_duration.observe((endpoint, method, str(status)), duration)
+            self.request_db_time.observe((endpoint,), db_time)
+            self.queries.inc((endpoint,), queries)
+
+    def observe_slow_query(self, endpoint):
+        with self._lock:
+            self.slow_queries.inc((endpoint,))
+
+    def render(self, pool_stats=None):
+        with self._lock:
+            lines = []
+            for metric in (self.request_duration, self.request_db_time, self.queries, self.slow_queries):
+                lines.extend(metric.render())
+        if pool_stats is not None:
+            lines.extend(_render_pool(pool_stats))
+        return '\n'.join(lines) + '\n'
+
+
+def _render_pool(stats):
+    lines = ['# HELP bookswap_db_pool_connections Pooled connections by state.',
+             '# TYPE bookswap_db_pool_connections gauge',
+             'bookswap_db_pool_connections{state="idle"} %d' % stats['idle'],
+             'bookswap_db_pool_connections{state="in_use"} %d' % stats['in_use']]
+    for name, key, kind, help in (
+            ('bookswap_db_pool_max_connections', 'max_size', 'gauge', 'Pool size limit.'),
+            ('bookswap_db_pool_waiting', 'waiting', 'gauge', 'Requests waiting for a connection.'),
+            ('bookswap_db_pool_checkouts_total', 'checkouts', 'counter', 'Connections handed out.'),
+            ('bookswap_db_pool_timeouts_total', 'timeouts', 'counter', 'Checkouts that timed out.'),
+            ('bookswap_db_pool_discarded_total', 'discarded', 'counter', 'Broken connections replaced.'),
+            ('bookswap_db_pool_wait_seconds_total', 'wait_time_total', 'counter', 'Time spent waiting for a connection.')):
+        lines.extend(['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind), '%s %s' % (name, stats[key])])
+    return lines
+
+
+metrics = Metrics()
+
+
+# -----------------------------
+# Instrumented Connections
+# -----------------------------
+def params_shape(vars):
+    """Describe query parameters by type only, so the slow-query log never holds user data"""
+    if vars is None:
+        return None
+    if isinstance(vars, dict):
+        return '{%s}' % ', '.join('%s: %s' % (k, _shape(v)) for k, v in vars.items())
+    if isinstance(vars, (list, tuple)):
+        return '(%s)' % ', '.join(_shape(v) for v in vars)
+    return _shape(vars)
+
+
+def _shape(value):
+    if isinstance(value, (list, tuple)):
+        return '%s[%d]' % (type(value).__name__, len(value))
+    return type(value).__name__
+
+
+def record_query(query, vars, elapsed):
+    """Account one statement to the current request and the slow-query log"""
+    endpoint = '-'
+    if has_request_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        g.sql_time = g.get('sql_time', 0.0) + elapsed
+        endpoint = request.endpoint or '-'
+    if elapsed * 1000 >= _slow_query_ms:
+        metrics.observe_slow_query(endpoint)
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        log.warning("Slow query (%.1f ms) in %s: %s params=%s",
+                    elapsed * 1000, endpoint, re.sub(r'\s+', ' ', str(query)).strip(), params_shape(vars))
+
+
+_instrumented_cursors = {}
+
+
+def _instrumented_cursor(base):
+    cls = _instrumented_cursors.get(base)
+    if cls is None:
+        class InstrumentedCursor(base):
+            def execute(self, query, vars=None):
+                start = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    record_query(query, vars, time.perf_counter() - start)
+
+            def executemany(self, query, vars_list):
+                start = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    record_query(query, None, time.perf_counter() - start)
+
+            def copy_expert(self, sql, file, size=8192):
+                start = time.perf_counter()
+                try:
+                    return super().copy_expert(sql, file, size)
+                finally:
+                    record_query(sql, None, time.perf_counter() - start)
+
+        cls = _instrumented_cursors[base] = InstrumentedCursor
+    return cls
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Connection whose cursors time every statement for the current request"""
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _instrumented_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+
+# -----------------------------
+# Flask Integration
+# -----------------------------
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+def _finish(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    duration = time.perf_counter() - start
+    queries = g.get('sql_queries', 0)
+    db_time = g.get('sql_time', 0.0)
+    response.headers['Server-Timing'] = 'db;dur=%.1f;desc="%d queries", app;dur=%.1f' % (
+        db_time * 1000, queries, (duration - db_time) * 1000)
+    endpoint = request.endpoint
+    if endpoint is not None and endpoint not in UNTRACKED_ENDPOINTS:
+        metrics.observe_request(endpoint, request.method, response.status_code, duration, db_time, queries)
+    return response
+
+
+def init_app(app):
+    global _slow_query_ms
+    app.config.setdefault('SLOW_QUERY_MS', float(os.environ.get('SLOW_QUERY_MS', 200)))
+    _slow_query_ms = app.config['SLOW_QUERY_MS']
+    if app.config.get('DB_CONNECTION_FACTORY') is None:
+        app.config['DB_CONNECTION_FACTORY'] = InstrumentedConnection
+    app.before_request(_start_timer)
+    app.after_request(_finish)
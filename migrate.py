@@ -0,0 +1,135 @@
+import os
+import re
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE_RE = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+# Files starting with this line run outside a transaction, one statement at a
+# time (needed for CREATE INDEX CONCURRENTLY). Keep such files to plain
+# statements separated by semicolons.
+NO_TRANSACTION_MARKER = '-- migrate:no-transaction'
+
+# A CREATE INDEX CONCURRENTLY that fails part-way leaves an INVALID index
+# behind, which `IF NOT EXISTS` would then happily skip on the next attempt.
+CONCURRENT_INDEX_RE = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w.]+)',
+                                 re.IGNORECASE)
+
+# Arbitrary key so two workers running migrations at once don't race
+ADVISORY_LOCK_KEY = 7438201
+
+
+class MigrationError(Exception):
+    pass
+
+
+def discover_migrations(directory=MIGRATIONS_DIR):
+    """Return [(version, name, path)] for the migration files, in version order"""
+    migrations = []
+    seen = {}
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE_RE.match(filename)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in seen:
+            raise MigrationError("duplicate migration version %d: %s and %s" % (version, seen[version], filename))
+        seen[version] = filename
+        migrations.append((version, match.group(2), os.path.join(directory, filename)))
+    return sorted(migrations)
+
+
+def ensure_version_table(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS public.schema_migrations (
+            version integer PRIMARY KEY,
+            name text NOT NULL,
+            applied_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+    cursor.close()
+
+
+def applied_versions(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT version FROM public.schema_migrations")
+    versions = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    conn.commit()
+    return versions
+
+
+def _split_statements(sql):
+    lines = [line for line in sql.splitlines() if not line.lstrip().startswith('--')]
+    return [stmt.strip() for stmt in '\n'.join(lines).split(';') if stmt.strip()]
+
+
+def _invalid_indexes(cursor, names):
+    cursor.execute("""
+        SELECT i.indexrelid::regclass::text
+        FROM pg_index i
+        WHERE NOT i.indisvalid
+          AND i.indexrelid = ANY (ARRAY(SELECT to_regclass(n)::oid FROM unnest(%s::text[]) n))
+    """, (names,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _drop_indexes(cursor, names):
+    for name in names:
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % name)
+
+
+def apply_migration(conn, version, name, path):
+    with open(path) as f:
+        sql = f.read()
+    cursor = conn.cursor()
+    if sql.startswith(NO_TRANSACTION_MARKER):
+        statements = _split_statements(sql)
+        indexes = [m.group(1) for m in map(CONCURRENT_INDEX_RE.match, statements) if m]
+        conn.autocommit = True
+        try:
+            # Left over from an earlier attempt that failed: build them again
+            _drop_indexes(cursor, _invalid_indexes(cursor, indexes))
+            for statement in statements:
+                cursor.execute(statement)
+            invalid = _invalid_indexes(cursor, indexes)
+            if invalid:
+                _drop_indexes(cursor, invalid)
+                raise MigrationError("%04d_%s left invalid indexes: %s" % (version, name, ', '.join(invalid)))
+            cursor.execute("INSERT INTO public.schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+        finally:
+            conn.autocommit = False
+    else:
+        try:
+            cursor.execute(sql)
+            cursor.execute("INSERT INTO public.schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    cursor.close()
+
+
+def apply_migrations(conn, directory=MIGRATIONS_DIR, log=print):
+    """Apply every migration newer than what the database has; returns the versions applied"""
+    ensure_version_table(conn)
+    cursor = conn.cursor()
+    conn.autocommit = True
+    cursor.execute("SELECT pg_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+    conn.autocommit = False
+    applied = []
+    try:
+        done = applied_versions(conn)
+        for version, name, path in discover_migrations(directory):
+            if version in done:
+                continue
+            log("Applying migration %04d_%s" % (version, name))
+            apply_migration(conn, version, name, path)
+            applied.append(version)
+    finally:
+        conn.autocommit = True
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+        conn.autocommit = False
+        cursor.close()
+    return applied
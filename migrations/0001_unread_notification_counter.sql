@@ -0,0 +1,9 @@
+-- Per-user unread counter read by the navbar badge (see add_notification in app.py)
+ALTER TABLE public.users
+    ADD COLUMN IF NOT EXISTS unread_notifications integer DEFAULT 0 NOT NULL;
+
+UPDATE public.users u
+SET unread_notifications = (
+    SELECT COUNT(*) FROM public.notifications n
+    WHERE n.user_id = u.user_id AND n.status = 'unread'
+);
@@ -0,0 +1,46 @@
+-- migrate:no-transaction
+-- Indexes for the per-route lookups in app.py. Built CONCURRENTLY so they can
+-- be added to a live database without blocking writes.
+
+-- available_books: only available rows, walked in (created_at, book_id) order
+CREATE INDEX CONCURRENTLY IF NOT EXISTS books_available_created_idx
+    ON public.books (created_at, book_id) WHERE status = 'available';
+
+-- my_books, profile
+CREATE INDEX CONCURRENTLY IF NOT EXISTS books_user_id_idx
+    ON public.books (user_id);
+
+-- available_books / book_details "request_sent" EXISTS probe
+CREATE INDEX CONCURRENTLY IF NOT EXISTS swap_requests_pending_book_sender_idx
+    ON public.swap_requests (book_id, sender_id) WHERE status = 'pending';
+
+-- swap_requests inbox (received / sent), profile swap count
+CREATE INDEX CONCURRENTLY IF NOT EXISTS swap_requests_receiver_id_idx
+    ON public.swap_requests (receiver_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS swap_requests_sender_id_idx
+    ON public.swap_requests (sender_id);
+
+-- notifications page, newest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notifications_user_created_idx
+    ON public.notifications (user_id, created_at DESC);
+
+-- unread lookups and the "mark read" update only touch unread rows
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notifications_user_unread_idx
+    ON public.notifications (user_id) WHERE status = 'unread';
+
+-- return_requests page (sent as owner / received as holder), newest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS return_requests_owner_created_idx
+    ON public.return_requests (owner_id, created_at DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS return_requests_holder_created_idx
+    ON public.return_requests (holder_id, created_at DESC);
+
+-- reviews page (received / given), profile rating
+CREATE INDEX CONCURRENTLY IF NOT EXISTS reviews_reviewed_created_idx
+    ON public.reviews (reviewed_id, created_at DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS reviews_reviewer_created_idx
+    ON public.reviews (reviewer_id, created_at DESC);
+
+-- book_details review list and the return_requests "already reviewed" EXISTS probe
+CREATE INDEX CONCURRENTLY IF NOT EXISTS reviews_book_reviewer_idx
+    ON public.reviews (book_id, reviewer_id);
+
@@ -0,0 +1,10 @@
+-- available_books pages on (created_at, book_id); a NULL created_at would
+-- drop out of the row comparison, so make the column mandatory.
+UPDATE public.books SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE public.books ALTER COLUMN created_at SET NOT NULL;
+
+-- Filtered listings keep walking in page order within the chosen genre / author
+CREATE INDEX IF NOT EXISTS books_available_genre_created_idx
+    ON public.books (genre, created_at, book_id) WHERE status = 'available';
+CREATE INDEX IF NOT EXISTS books_available_author_created_idx
+    ON public.books (lower(author), created_at, book_id) WHERE status = 'available';
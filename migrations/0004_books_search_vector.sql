@@ -0,0 +1,13 @@
+-- Full-text search over the catalogue (/search). The generated column keeps
+-- itself current on every insert/update; titles weigh more than authors,
+-- authors more than genre.
+ALTER TABLE public.books
+    ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(author, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(genre, '')), 'C')
+    ) STORED;
+
+-- Only available books are ever searched
+CREATE INDEX IF NOT EXISTS books_search_vector_idx
+    ON public.books USING gin (search_vector) WHERE status = 'available';
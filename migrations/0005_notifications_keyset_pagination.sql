@@ -0,0 +1,9 @@
+-- /notifications pages on (created_at, notification_id) newest first
+UPDATE public.notifications SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE public.notifications ALTER COLUMN created_at SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS notifications_user_created_id_idx
+    ON public.notifications (user_id, created_at DESC, notification_id DESC);
+
+-- Superseded by the index above
+DROP INDEX IF EXISTS public.notifications_user_created_idx;
@@ -0,0 +1,24 @@
+-- Publish every new notification on the "notifications" channel for the
+-- server-sent-events stream (realtime.py). add_notification() bumps the
+-- recipient's counter before inserting, so the count read here is current.
+-- pg_notify payloads are capped at 8000 bytes, hence the truncated content.
+CREATE OR REPLACE FUNCTION public.notify_notification_inserted() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    PERFORM pg_notify('notifications', json_build_object(
+        'user_id', NEW.user_id,
+        'notification_id', NEW.notification_id,
+        'type', NEW.type,
+        'content', left(NEW.content, 1000),
+        'created_at', NEW.created_at,
+        'unread_count', (SELECT unread_notifications FROM public.users WHERE user_id = NEW.user_id)
+    )::text);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS notifications_notify_insert ON public.notifications;
+CREATE TRIGGER notifications_notify_insert
+    AFTER INSERT ON public.notifications
+    FOR EACH ROW EXECUTE FUNCTION public.notify_notification_inserted();
@@ -0,0 +1,204 @@
+-- Per-user aggregates behind /profile, served with one primary-key lookup.
+-- Maintained by statement-level triggers on users, books, swap_requests and
+-- reviews (so bulk INSERT/COPY pays once per statement, not per row);
+-- rebuild_user_stats() recomputes everything from the base tables.
+CREATE TABLE IF NOT EXISTS public.user_stats (
+    user_id integer PRIMARY KEY REFERENCES public.users(user_id) ON DELETE CASCADE,
+    book_count integer DEFAULT 0 NOT NULL,
+    swap_count integer DEFAULT 0 NOT NULL,    -- accepted swap requests, as sender or receiver
+    rating_sum bigint DEFAULT 0 NOT NULL,     -- ratings received
+    rating_count integer DEFAULT 0 NOT NULL,  -- reviews received
+    review_count integer DEFAULT 0 NOT NULL,  -- reviews written
+    updated_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Only updates existing rows: a stats row appears with its user and goes away
+-- with it, so cascaded deletes never try to recreate one.
+CREATE OR REPLACE FUNCTION public.user_stats_add(
+    p_user_id integer, p_books bigint, p_swaps bigint,
+    p_rating_sum bigint, p_rating_count bigint, p_reviews bigint
+) RETURNS void
+    LANGUAGE sql
+    AS $$
+    UPDATE public.user_stats
+    SET book_count = book_count + p_books,
+        swap_count = swap_count + p_swaps,
+        rating_sum = rating_sum + p_rating_sum,
+        rating_count = rating_count + p_rating_count,
+        review_count = review_count + p_reviews,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE user_id = p_user_id;
+$$;
+
+-- Rows affected by the firing statement, each tagged +1 (new) or -1 (old)
+CREATE OR REPLACE FUNCTION public.transition_rows_sql(op text) RETURNS text
+    LANGUAGE sql IMMUTABLE
+    AS $$
+    SELECT CASE op
+        WHEN 'INSERT' THEN 'SELECT n.*, 1 AS sign FROM new_rows n'
+        WHEN 'DELETE' THEN 'SELECT o.*, -1 AS sign FROM old_rows o'
+        ELSE 'SELECT n.*, 1 AS sign FROM new_rows n UNION ALL SELECT o.*, -1 AS sign FROM old_rows o'
+    END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.user_stats_users_inserted() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    INSERT INTO public.user_stats (user_id)
+    SELECT user_id FROM new_rows
+    ON CONFLICT (user_id) DO NOTHING;
+    RETURN NULL;
+END;
+$$;
+
+-- Deltas are applied in user_id order so concurrent statements lock stats rows consistently
+CREATE OR REPLACE FUNCTION public.user_stats_books_changed() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    EXECUTE format($q$
+        SELECT public.user_stats_add(user_id, sum(sign), 0, 0, 0, 0)
+        FROM (%s) r
+        GROUP BY user_id HAVING sum(sign) <> 0
+        ORDER BY user_id
+    $q$, public.transition_rows_sql(TG_OP));
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.user_stats_swaps_changed() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    EXECUTE format($q$
+        SELECT public.user_stats_add(user_id, 0, sum(sign), 0, 0, 0)
+        FROM (
+            SELECT r.sender_id AS user_id, r.sign FROM (%1$s) r WHERE r.status = 'accepted'
+            UNION ALL
+            SELECT r.receiver_id, r.sign FROM (%1$s) r WHERE r.status = 'accepted'
+        ) c
+        GROUP BY user_id HAVING sum(sign) <> 0
+        ORDER BY user_id
+    $q$, public.transition_rows_sql(TG_OP));
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.user_stats_reviews_changed() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    EXECUTE format($q$
+        SELECT public.user_stats_add(user_id, 0, 0, sum(rating_delta), sum(received), sum(written))
+        FROM (
+            SELECT r.reviewed_id AS user_id, r.rating * r.sign AS rating_delta, r.sign AS received, 0 AS written
+            FROM (%1$s) r
+            UNION ALL
+            SELECT r.reviewer_id, 0, 0, r.sign FROM (%1$s) r
+        ) c
+        GROUP BY user_id
+        ORDER BY user_id
+    $q$, public.transition_rows_sql(TG_OP));
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS user_stats_users_insert ON public.users;
+CREATE TRIGGER user_stats_users_insert AFTER INSERT ON public.users
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_users_inserted();
+
+DROP TRIGGER IF EXISTS user_stats_books_insert ON public.books;
+CREATE TRIGGER user_stats_books_insert AFTER INSERT ON public.books
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_books_changed();
+DROP TRIGGER IF EXISTS user_stats_books_update ON public.books;
+CREATE TRIGGER user_stats_books_update AFTER UPDATE ON public.books
+    REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_books_changed();
+DROP TRIGGER IF EXISTS user_stats_books_delete ON public.books;
+CREATE TRIGGER user_stats_books_delete AFTER DELETE ON public.books
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_books_changed();
+
+DROP TRIGGER IF EXISTS user_stats_swaps_insert ON public.swap_requests;
+CREATE TRIGGER user_stats_swaps_insert AFTER INSERT ON public.swap_requests
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_swaps_changed();
+DROP TRIGGER IF EXISTS user_stats_swaps_update ON public.swap_requests;
+CREATE TRIGGER user_stats_swaps_update AFTER UPDATE ON public.swap_requests
+    REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_swaps_changed();
+DROP TRIGGER IF EXISTS user_stats_swaps_delete ON public.swap_requests;
+CREATE TRIGGER user_stats_swaps_delete AFTER DELETE ON public.swap_requests
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_swaps_changed();
+
+DROP TRIGGER IF EXISTS user_stats_reviews_insert ON public.reviews;
+CREATE TRIGGER user_stats_reviews_insert AFTER INSERT ON public.reviews
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_reviews_changed();
+DROP TRIGGER IF EXISTS user_stats_reviews_update ON public.reviews;
+CREATE TRIGGER user_stats_reviews_update AFTER UPDATE ON public.reviews
+    REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_reviews_changed();
+DROP TRIGGER IF EXISTS user_stats_reviews_delete ON public.reviews;
+CREATE TRIGGER user_stats_reviews_delete AFTER DELETE ON public.reviews
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.user_stats_reviews_changed();
+
+-- Recompute every user's stats from scratch; returns how many rows were wrong.
+-- Writers to the source tables are blocked for the duration so nothing is
+-- counted twice or missed.
+CREATE OR REPLACE FUNCTION public.rebuild_user_stats() RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    corrected integer;
+BEGIN
+    LOCK TABLE public.users, public.books, public.swap_requests, public.reviews IN SHARE MODE;
+
+    WITH fresh AS (
+        SELECT u.user_id,
+               coalesce(b.n, 0) AS book_count,
+               coalesce(s.n, 0) AS swap_count,
+               coalesce(rr.rating_sum, 0) AS rating_sum,
+               coalesce(rr.n, 0) AS rating_count,
+               coalesce(rw.n, 0) AS review_count
+        FROM public.users u
+        LEFT JOIN (SELECT user_id, count(*) AS n FROM public.books GROUP BY user_id) b
+               ON b.user_id = u.user_id
+        LEFT JOIN (SELECT user_id, count(*) AS n FROM (
+                       SELECT sender_id AS user_id FROM public.swap_requests WHERE status = 'accepted'
+                       UNION ALL
+                       SELECT receiver_id FROM public.swap_requests WHERE status = 'accepted'
+                   ) x GROUP BY user_id) s
+               ON s.user_id = u.user_id
+        LEFT JOIN (SELECT reviewed_id, sum(rating) AS rating_sum, count(*) AS n
+                   FROM public.reviews GROUP BY reviewed_id) rr
+               ON rr.reviewed_id = u.user_id
+        LEFT JOIN (SELECT reviewer_id, count(*) AS n FROM public.reviews GROUP BY reviewer_id) rw
+               ON rw.reviewer_id = u.user_id
+    ), upserted AS (
+        INSERT INTO public.user_stats AS st
+            (user_id, book_count, swap_count, rating_sum, rating_count, review_count)
+        SELECT * FROM fresh
+        ON CONFLICT (user_id) DO UPDATE
+        SET book_count = EXCLUDED.book_count,
+            swap_count = EXCLUDED.swap_count,
+            rating_sum = EXCLUDED.rating_sum,
+            rating_count = EXCLUDED.rating_count,
+            review_count = EXCLUDED.review_count,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (st.book_count, st.swap_count, st.rating_sum, st.rating_count, st.review_count)
+              IS DISTINCT FROM
+              (EXCLUDED.book_count, EXCLUDED.swap_count, EXCLUDED.rating_sum, EXCLUDED.rating_count, EXCLUDED.review_count)
+        RETURNING 1
+    )
+    SELECT count(*) INTO corrected FROM upserted;
+    RETURN corrected;
+END;
+$$;
+
+SELECT public.rebuild_user_stats();
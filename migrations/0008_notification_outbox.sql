@@ -0,0 +1,34 @@
+-- Transactional outbox for notifications. Write routes enqueue here in the
+-- same transaction as their main change; outbox_worker.py moves rows into
+-- notifications in batches and maintains the unread counters.
+CREATE TABLE IF NOT EXISTS public.notification_outbox (
+    outbox_id bigserial PRIMARY KEY,
+    idempotency_key text NOT NULL UNIQUE,
+    user_id integer NOT NULL,
+    type character varying(20) NOT NULL,
+    content text NOT NULL,
+    created_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    available_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    attempts integer DEFAULT 0 NOT NULL,
+    last_error text
+);
+
+-- Delivered notifications remember their key so a redelivery is a no-op
+ALTER TABLE public.notifications ADD COLUMN IF NOT EXISTS idempotency_key text;
+CREATE UNIQUE INDEX IF NOT EXISTS notifications_idempotency_key_idx
+    ON public.notifications (idempotency_key);
+
+-- Wake the worker once per enqueueing statement
+CREATE OR REPLACE FUNCTION public.notify_outbox_enqueued() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    PERFORM pg_notify('notification_outbox', '');
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS notification_outbox_notify_insert ON public.notification_outbox;
+CREATE TRIGGER notification_outbox_notify_insert
+    AFTER INSERT ON public.notification_outbox
+    FOR EACH STATEMENT EXECUTE FUNCTION public.notify_outbox_enqueued();
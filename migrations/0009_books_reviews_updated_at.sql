@@ -0,0 +1,38 @@
+-- Last-change timestamps behind the ETag / Last-Modified of book_details and
+-- /reviews. Existing rows start from their creation time.
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS updated_at timestamp without time zone;
+UPDATE public.books SET updated_at = created_at WHERE updated_at IS NULL;
+ALTER TABLE public.books ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE public.books ALTER COLUMN updated_at SET NOT NULL;
+
+ALTER TABLE public.reviews ADD COLUMN IF NOT EXISTS updated_at timestamp without time zone;
+UPDATE public.reviews SET updated_at = coalesce(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+ALTER TABLE public.reviews ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE public.reviews ALTER COLUMN updated_at SET NOT NULL;
+
+-- clock_timestamp(), not the transaction start: a long transaction that
+-- commits late must still move the version past what readers already saw.
+-- Updates that change nothing leave the timestamp (and cached pages) alone;
+-- books lists its columns because a BEFORE trigger's WHEN can't see the
+-- generated search_vector.
+CREATE OR REPLACE FUNCTION public.touch_updated_at() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    NEW.updated_at := clock_timestamp();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS books_touch_updated_at ON public.books;
+CREATE TRIGGER books_touch_updated_at
+    BEFORE UPDATE ON public.books
+    FOR EACH ROW WHEN ((OLD.user_id, OLD.title, OLD.author, OLD.genre, OLD.status)
+                       IS DISTINCT FROM (NEW.user_id, NEW.title, NEW.author, NEW.genre, NEW.status))
+    EXECUTE FUNCTION public.touch_updated_at();
+
+DROP TRIGGER IF EXISTS reviews_touch_updated_at ON public.reviews;
+CREATE TRIGGER reviews_touch_updated_at
+    BEFORE UPDATE ON public.reviews
+    FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*)
+    EXECUTE FUNCTION public.touch_updated_at();
@@ -0,0 +1,66 @@
+-- "Books you might like": recommend.py fills these tables. A full rebuild
+-- recomputes item-item similarity and every user's list; in between, users
+-- whose reviews or swaps changed are queued in recommendation_dirty_users and
+-- only their lists are recomputed from the stored similarities.
+
+-- Top-K per user; available_books reads one user's rows off the primary key
+CREATE TABLE IF NOT EXISTS public.book_recommendations (
+    user_id integer NOT NULL REFERENCES public.users(user_id) ON DELETE CASCADE,
+    rank smallint NOT NULL,
+    book_id integer NOT NULL REFERENCES public.books(book_id) ON DELETE CASCADE,
+    score real NOT NULL,
+    computed_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, rank)
+);
+CREATE INDEX IF NOT EXISTS book_recommendations_book_id_idx
+    ON public.book_recommendations (book_id);
+
+-- Nearest neighbours of each book by co-interaction (cosine), from the last rebuild
+CREATE TABLE IF NOT EXISTS public.book_similarities (
+    book_id integer NOT NULL REFERENCES public.books(book_id) ON DELETE CASCADE,
+    similar_book_id integer NOT NULL REFERENCES public.books(book_id) ON DELETE CASCADE,
+    score real NOT NULL,
+    PRIMARY KEY (book_id, similar_book_id)
+);
+CREATE INDEX IF NOT EXISTS book_similarities_similar_book_id_idx
+    ON public.book_similarities (similar_book_id);
+
+-- marked_at moves on every re-mark, so a rebuild that read an older mark
+-- leaves the newer one queued
+CREATE TABLE IF NOT EXISTS public.recommendation_dirty_users (
+    user_id integer PRIMARY KEY REFERENCES public.users(user_id) ON DELETE CASCADE,
+    marked_at timestamp without time zone DEFAULT clock_timestamp() NOT NULL
+);
+
+-- The incremental update looks up a user's held books
+CREATE INDEX IF NOT EXISTS active_swaps_holder_id_idx
+    ON public.active_swaps (holder_id);
+
+CREATE OR REPLACE FUNCTION public.recommendations_mark_dirty() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    -- TG_ARGV[0] names the column holding the user whose interests changed
+    EXECUTE format($q$
+        INSERT INTO public.recommendation_dirty_users (user_id)
+        SELECT DISTINCT %1$I FROM new_rows ORDER BY 1
+        ON CONFLICT (user_id) DO UPDATE SET marked_at = clock_timestamp()
+    $q$, TG_ARGV[0]);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS recommendations_reviews_insert ON public.reviews;
+CREATE TRIGGER recommendations_reviews_insert AFTER INSERT ON public.reviews
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.recommendations_mark_dirty('reviewer_id');
+
+DROP TRIGGER IF EXISTS recommendations_swaps_insert ON public.swap_requests;
+CREATE TRIGGER recommendations_swaps_insert AFTER INSERT ON public.swap_requests
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.recommendations_mark_dirty('sender_id');
+
+DROP TRIGGER IF EXISTS recommendations_active_swaps_insert ON public.active_swaps;
+CREATE TRIGGER recommendations_active_swaps_insert AFTER INSERT ON public.active_swaps
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.recommendations_mark_dirty('holder_id');
@@ -0,0 +1,59 @@
+-- Swap circles: swap_matcher.py looks for cycles of pending swap requests
+-- (A wants B's book, B wants C's, C wants A's) and offers them to everyone
+-- in the cycle. Once all members accept, every request in it is accepted in
+-- one transaction.
+CREATE TABLE IF NOT EXISTS public.swap_cycles (
+    cycle_id bigserial PRIMARY KEY,
+    status character varying(20) DEFAULT 'offered'::character varying NOT NULL,
+    created_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    expires_at timestamp without time zone NOT NULL,
+    CONSTRAINT swap_cycles_status_check CHECK (((status)::text = ANY ((ARRAY['offered'::character varying, 'completed'::character varying, 'declined'::character varying, 'expired'::character varying, 'cancelled'::character varying])::text[])))
+);
+CREATE INDEX IF NOT EXISTS swap_cycles_offered_expires_idx
+    ON public.swap_cycles (expires_at) WHERE status = 'offered';
+
+-- One row per request in the cycle; user_id is its sender, who gets book_id.
+-- declined_at marks a request its sender doesn't want matched again.
+CREATE TABLE IF NOT EXISTS public.swap_cycle_members (
+    cycle_id bigint NOT NULL REFERENCES public.swap_cycles(cycle_id) ON DELETE CASCADE,
+    request_id integer NOT NULL REFERENCES public.swap_requests(request_id) ON DELETE CASCADE,
+    user_id integer NOT NULL,
+    book_id integer NOT NULL,
+    accepted_at timestamp without time zone,
+    declined_at timestamp without time zone,
+    PRIMARY KEY (cycle_id, request_id)
+);
+CREATE INDEX IF NOT EXISTS swap_cycle_members_user_idx
+    ON public.swap_cycle_members (user_id, cycle_id);
+CREATE INDEX IF NOT EXISTS swap_cycle_members_request_idx
+    ON public.swap_cycle_members (request_id);
+CREATE INDEX IF NOT EXISTS swap_cycle_members_book_idx
+    ON public.swap_cycle_members (book_id);
+
+-- Requests the matcher still has to look at. A new cycle must contain a new
+-- edge, so only cycles through queued requests are searched for.
+CREATE TABLE IF NOT EXISTS public.swap_match_queue (
+    request_id integer PRIMARY KEY REFERENCES public.swap_requests(request_id) ON DELETE CASCADE,
+    queued_at timestamp without time zone DEFAULT clock_timestamp() NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION public.swap_match_enqueue() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    INSERT INTO public.swap_match_queue (request_id)
+    SELECT request_id FROM new_rows WHERE status = 'pending' ORDER BY request_id
+    ON CONFLICT (request_id) DO NOTHING;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS swap_match_swaps_insert ON public.swap_requests;
+CREATE TRIGGER swap_match_swaps_insert AFTER INSERT ON public.swap_requests
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.swap_match_enqueue();
+
+-- Requests already pending when this was installed
+INSERT INTO public.swap_match_queue (request_id)
+SELECT request_id FROM public.swap_requests WHERE status = 'pending'
+ON CONFLICT (request_id) DO NOTHING;
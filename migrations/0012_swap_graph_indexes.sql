@@ -0,0 +1,8 @@
+-- migrate:no-transaction
+-- The matcher walks the graph of pending requests one hop at a time, in both
+-- directions; these cover each hop with an index-only scan.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS swap_requests_pending_sender_receiver_idx
+    ON public.swap_requests (sender_id, receiver_id, request_id, book_id) WHERE status = 'pending';
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS swap_requests_pending_receiver_sender_idx
+    ON public.swap_requests (receiver_id, sender_id, request_id, book_id) WHERE status = 'pending';
@@ -0,0 +1,164 @@
+-- Range-partition notifications, swap_requests and return_requests by month
+-- of created_at. partitions.py creates months ahead of time and moves months
+-- past their retention into the archive schema, so the pages only ever read
+-- the recent partitions still attached to the public tables.
+--
+-- No rows are copied: each table is renamed to <table>_legacy and attached
+-- as the partition for everything up to the end of the current month; the
+-- next three months (PARTITION_MONTHS_AHEAD's default) get their own
+-- partitions here, later ones from partitions.py. Attaching scans each
+-- table once under an exclusive lock, so run this in a quiet window.
+
+-- Primary and unique keys of a partitioned table must include created_at.
+-- Foreign keys can't point at a key that doesn't, so those are dropped
+-- (swap_cycle_members and swap_match_queue -> swap_requests; migration 0017
+-- replaces them).
+CREATE OR REPLACE FUNCTION public.partition_by_created_at(tbl text, key_column text) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    legacy text := tbl || '_legacy';
+    boundary timestamp := date_trunc('month', CURRENT_TIMESTAMP) + interval '1 month';
+    month_start timestamp;
+    index_defs text[];
+    trigger_defs text[];
+    r record;
+    def text;
+BEGIN
+    EXECUTE format('LOCK TABLE public.%I IN ACCESS EXCLUSIVE MODE', tbl);
+    EXECUTE format('UPDATE public.%I SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL', tbl);
+    EXECUTE format('ALTER TABLE public.%I ALTER COLUMN created_at SET NOT NULL', tbl);
+
+    -- Definitions as they read on the original table, replayed on the new parent
+    SELECT coalesce(array_agg(CASE WHEN i.indisunique
+                                   THEN regexp_replace(pg_get_indexdef(i.indexrelid), '\)( WHERE .*)?$', ', created_at)\1')
+                                   ELSE pg_get_indexdef(i.indexrelid) END), '{}')
+    INTO index_defs
+    FROM pg_index i
+    WHERE i.indrelid = format('public.%I', tbl)::regclass AND NOT i.indisprimary;
+
+    SELECT coalesce(array_agg(pg_get_triggerdef(t.oid)), '{}')
+    INTO trigger_defs
+    FROM pg_trigger t
+    WHERE t.tgrelid = format('public.%I', tbl)::regclass AND NOT t.tgisinternal;
+
+    FOR r IN SELECT conname, conrelid::regclass AS referencing FROM pg_constraint
+             WHERE confrelid = format('public.%I', tbl)::regclass AND contype = 'f' LOOP
+        RAISE NOTICE 'dropping foreign key % on % (it references %)', r.conname, r.referencing, tbl;
+        EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', r.referencing, r.conname);
+    END LOOP;
+
+    EXECUTE format('ALTER TABLE public.%I RENAME TO %I', tbl, legacy);
+    FOR r IN SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+             WHERE i.indrelid = format('public.%I', legacy)::regclass LOOP
+        EXECUTE format('ALTER INDEX public.%I RENAME TO %I', r.relname, left(r.relname, 56) || '_legacy');
+    END LOOP;
+    FOR r IN SELECT tgname FROM pg_trigger
+             WHERE tgrelid = format('public.%I', legacy)::regclass AND NOT tgisinternal LOOP
+        EXECUTE format('DROP TRIGGER %I ON public.%I', r.tgname, legacy);
+    END LOOP;
+
+    EXECUTE format('CREATE TABLE public.%I (LIKE public.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) '
+                   'PARTITION BY RANGE (created_at)', tbl, legacy);
+    EXECUTE format('ALTER TABLE public.%I ADD PRIMARY KEY (%I, created_at)', tbl, key_column);
+    FOR r IN SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+             WHERE conrelid = format('public.%I', legacy)::regclass AND contype = 'f' LOOP
+        EXECUTE format('ALTER TABLE public.%I ADD CONSTRAINT %I %s', tbl, r.conname, r.def);
+    END LOOP;
+    FOREACH def IN ARRAY index_defs LOOP
+        EXECUTE def;
+    END LOOP;
+    FOREACH def IN ARRAY trigger_defs LOOP
+        EXECUTE def;
+    END LOOP;
+
+    -- The id sequence must outlive the legacy partition
+    FOR r IN SELECT a.attname, pg_get_serial_sequence(format('public.%I', legacy), a.attname) AS seq
+             FROM pg_attribute a
+             WHERE a.attrelid = format('public.%I', legacy)::regclass AND a.attnum > 0 AND NOT a.attisdropped LOOP
+        IF r.seq IS NOT NULL THEN
+            EXECUTE format('ALTER SEQUENCE %s OWNED BY public.%I.%I', r.seq, tbl, r.attname);
+        END IF;
+    END LOOP;
+
+    -- Matching indexes on the legacy table are adopted rather than rebuilt
+    EXECUTE format('ALTER TABLE public.%I ATTACH PARTITION public.%I FOR VALUES FROM (MINVALUE) TO (%L)',
+                   tbl, legacy, boundary);
+    -- Named as partitions.py names them, which carries on from the last one
+    FOR i IN 0..2 LOOP
+        month_start := boundary + i * interval '1 month';
+        EXECUTE format('CREATE TABLE public.%I PARTITION OF public.%I FOR VALUES FROM (%L) TO (%L)',
+                       tbl || to_char(month_start, '"_p"YYYY_MM'), tbl, month_start, month_start + interval '1 month');
+    END LOOP;
+    -- Rows past the last month created land here; partitions.py moves them
+    -- into their month's partition when it creates it
+    EXECUTE format('CREATE TABLE public.%I PARTITION OF public.%I DEFAULT', tbl || '_default', tbl);
+
+    -- Parent for partitions past retention; they keep their own indexes
+    EXECUTE format('CREATE TABLE archive.%I (LIKE public.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+                   'PARTITION BY RANGE (created_at)', tbl, tbl);
+END;
+$$;
+
+CREATE SCHEMA IF NOT EXISTS archive;
+
+SELECT public.partition_by_created_at('notifications', 'notification_id');
+SELECT public.partition_by_created_at('swap_requests', 'request_id');
+SELECT public.partition_by_created_at('return_requests', 'return_request_id');
+
+DROP FUNCTION public.partition_by_created_at(text, text);
+
+-- Accepted swaps that have been archived still count towards swap_count
+CREATE OR REPLACE FUNCTION public.rebuild_user_stats() RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    corrected integer;
+BEGIN
+    LOCK TABLE public.users, public.books, public.swap_requests, archive.swap_requests, public.reviews IN SHARE MODE;
+
+    WITH accepted AS (
+        SELECT sender_id, receiver_id FROM public.swap_requests WHERE status = 'accepted'
+        UNION ALL
+        SELECT sender_id, receiver_id FROM archive.swap_requests WHERE status = 'accepted'
+    ), fresh AS (
+        SELECT u.user_id,
+               coalesce(b.n, 0) AS book_count,
+               coalesce(s.n, 0) AS swap_count,
+               coalesce(rr.rating_sum, 0) AS rating_sum,
+               coalesce(rr.n, 0) AS rating_count,
+               coalesce(rw.n, 0) AS review_count
+        FROM public.users u
+        LEFT JOIN (SELECT user_id, count(*) AS n FROM public.books GROUP BY user_id) b
+               ON b.user_id = u.user_id
+        LEFT JOIN (SELECT user_id, count(*) AS n FROM (
+                       SELECT sender_id AS user_id FROM accepted
+                       UNION ALL
+                       SELECT receiver_id FROM accepted
+                   ) x GROUP BY user_id) s
+               ON s.user_id = u.user_id
+        LEFT JOIN (SELECT reviewed_id, sum(rating) AS rating_sum, count(*) AS n
+                   FROM public.reviews GROUP BY reviewed_id) rr
+               ON rr.reviewed_id = u.user_id
+        LEFT JOIN (SELECT reviewer_id, count(*) AS n FROM public.reviews GROUP BY reviewer_id) rw
+               ON rw.reviewer_id = u.user_id
+    ), upserted AS (
+        INSERT INTO public.user_stats AS st
+            (user_id, book_count, swap_count, rating_sum, rating_count, review_count)
+        SELECT * FROM fresh
+        ON CONFLICT (user_id) DO UPDATE
+        SET book_count = EXCLUDED.book_count,
+            swap_count = EXCLUDED.swap_count,
+            rating_sum = EXCLUDED.rating_sum,
+            rating_count = EXCLUDED.rating_count,
+            review_count = EXCLUDED.review_count,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (st.book_count, st.swap_count, st.rating_sum, st.rating_count, st.review_count)
+              IS DISTINCT FROM
+              (EXCLUDED.book_count, EXCLUDED.swap_count, EXCLUDED.rating_sum, EXCLUDED.rating_count, EXCLUDED.review_count)
+        RETURNING 1
+    )
+    SELECT count(*) INTO corrected FROM upserted;
+    RETURN corrected;
+END;
+$$;
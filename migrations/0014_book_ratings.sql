@@ -0,0 +1,107 @@
+-- Per-book rating aggregates, so available_books can sort and filter by
+-- rating off an index instead of grouping reviews on every request. Kept
+-- current by statement-level triggers on reviews, in the same transaction
+-- as the review itself; per-owner totals are already on user_stats.
+-- Adding the generated rating_avg rewrites books once.
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS rating_sum bigint DEFAULT 0 NOT NULL;
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS rating_count integer DEFAULT 0 NOT NULL;
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS last_reviewed_at timestamp without time zone;
+-- Unrated books sort after every rated one
+ALTER TABLE public.books ADD COLUMN IF NOT EXISTS rating_avg numeric(3,2)
+    GENERATED ALWAYS AS (CASE WHEN rating_count > 0 THEN round(rating_sum::numeric / rating_count, 2) ELSE 0 END) STORED;
+
+ALTER TABLE public.user_stats ADD COLUMN IF NOT EXISTS last_reviewed_at timestamp without time zone;
+
+-- available_books?sort=rating, best first; min_rating is a range on the same index
+CREATE INDEX IF NOT EXISTS books_available_rating_idx
+    ON public.books (rating_avg, book_id) WHERE status = 'available';
+
+-- Like user_stats_add: only touches existing rows, called in book_id order
+CREATE OR REPLACE FUNCTION public.book_ratings_add(
+    p_book_id integer, p_rating_sum bigint, p_rating_count bigint, p_reviewed_at timestamp without time zone
+) RETURNS void
+    LANGUAGE sql
+    AS $$
+    UPDATE public.books
+    SET rating_sum = rating_sum + p_rating_sum,
+        rating_count = rating_count + p_rating_count,
+        last_reviewed_at = greatest(last_reviewed_at, p_reviewed_at)
+    WHERE book_id = p_book_id;
+$$;
+
+-- last_reviewed_at only moves forward: deleting the newest review leaves it be
+CREATE OR REPLACE FUNCTION public.book_ratings_reviews_changed() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    EXECUTE format($q$
+        SELECT public.book_ratings_add(book_id, sum(rating * sign), sum(sign), max(created_at) FILTER (WHERE sign > 0))
+        FROM (%1$s) r
+        GROUP BY book_id
+        ORDER BY book_id
+    $q$, public.transition_rows_sql(TG_OP));
+    IF TG_OP <> 'DELETE' THEN
+        EXECUTE $q$
+            UPDATE public.user_stats s
+            SET last_reviewed_at = greatest(s.last_reviewed_at, n.reviewed_at)
+            FROM (SELECT reviewed_id, max(created_at) AS reviewed_at FROM new_rows GROUP BY reviewed_id) n
+            WHERE s.user_id = n.reviewed_id
+        $q$;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS book_ratings_reviews_insert ON public.reviews;
+CREATE TRIGGER book_ratings_reviews_insert AFTER INSERT ON public.reviews
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.book_ratings_reviews_changed();
+DROP TRIGGER IF EXISTS book_ratings_reviews_update ON public.reviews;
+CREATE TRIGGER book_ratings_reviews_update AFTER UPDATE ON public.reviews
+    REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.book_ratings_reviews_changed();
+DROP TRIGGER IF EXISTS book_ratings_reviews_delete ON public.reviews;
+CREATE TRIGGER book_ratings_reviews_delete AFTER DELETE ON public.reviews
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.book_ratings_reviews_changed();
+
+-- Recompute every book's aggregates and owners' last review time; returns how many books were wrong
+CREATE OR REPLACE FUNCTION public.rebuild_book_ratings() RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    corrected integer;
+BEGIN
+    LOCK TABLE public.books, public.reviews, public.user_stats IN SHARE MODE;
+
+    WITH fresh AS (
+        SELECT b.book_id,
+               coalesce(r.rating_sum, 0) AS rating_sum,
+               coalesce(r.rating_count, 0) AS rating_count,
+               r.last_reviewed_at
+        FROM public.books b
+        LEFT JOIN (SELECT book_id, sum(rating) AS rating_sum, count(*) AS rating_count,
+                          max(created_at) AS last_reviewed_at
+                   FROM public.reviews GROUP BY book_id) r
+               ON r.book_id = b.book_id
+    ), updated AS (
+        UPDATE public.books b
+        SET rating_sum = f.rating_sum, rating_count = f.rating_count, last_reviewed_at = f.last_reviewed_at
+        FROM fresh f
+        WHERE b.book_id = f.book_id
+          AND (b.rating_sum, b.rating_count, b.last_reviewed_at)
+              IS DISTINCT FROM (f.rating_sum, f.rating_count, f.last_reviewed_at)
+        RETURNING 1
+    )
+    SELECT count(*) INTO corrected FROM updated;
+
+    UPDATE public.user_stats s
+    SET last_reviewed_at = r.last_reviewed_at
+    FROM (SELECT reviewed_id, max(created_at) AS last_reviewed_at FROM public.reviews GROUP BY reviewed_id) r
+    WHERE s.user_id = r.reviewed_id AND s.last_reviewed_at IS DISTINCT FROM r.last_reviewed_at;
+
+    RETURN corrected;
+END;
+$$;
+
+SELECT public.rebuild_book_ratings();
@@ -0,0 +1,44 @@
+-- Messages between the two people on a swap or return request. Each request
+-- gets at most one conversation; swap_requests and return_requests are
+-- partitioned (0013), so the request is referenced by kind and id without a
+-- foreign key.
+CREATE TABLE IF NOT EXISTS public.conversations (
+    conversation_id serial PRIMARY KEY,
+    request_kind character varying(10) NOT NULL,
+    request_id integer NOT NULL,
+    created_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    last_message_id bigint DEFAULT 0 NOT NULL,
+    last_message_at timestamp without time zone,
+    CONSTRAINT conversations_request_kind_check CHECK (((request_kind)::text = ANY ((ARRAY['swap'::character varying, 'return'::character varying])::text[]))),
+    CONSTRAINT conversations_request_key UNIQUE (request_kind, request_id)
+);
+
+-- Unread tracking: a member has read everything up to last_read_message_id,
+-- so reading a thread moves one marker instead of updating every message
+CREATE TABLE IF NOT EXISTS public.conversation_members (
+    conversation_id integer NOT NULL REFERENCES public.conversations(conversation_id) ON DELETE CASCADE,
+    user_id integer NOT NULL REFERENCES public.users(user_id) ON DELETE CASCADE,
+    last_read_message_id bigint DEFAULT 0 NOT NULL,
+    PRIMARY KEY (conversation_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS conversation_members_user_idx
+    ON public.conversation_members (user_id, conversation_id);
+
+-- message_id only grows, so it orders a thread and doubles as its page cursor.
+-- The octet_length cap keeps a whole message inside an index entry.
+CREATE TABLE IF NOT EXISTS public.messages (
+    message_id bigserial PRIMARY KEY,
+    conversation_id integer NOT NULL REFERENCES public.conversations(conversation_id) ON DELETE CASCADE,
+    sender_id integer NOT NULL REFERENCES public.users(user_id) ON DELETE CASCADE,
+    body text NOT NULL,
+    created_at timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    CONSTRAINT messages_body_check CHECK ((octet_length(body) >= 1 AND octet_length(body) <= 2000))
+);
+
+-- A page of a thread is one index-only range scan, however long the thread
+CREATE INDEX IF NOT EXISTS messages_thread_idx
+    ON public.messages (conversation_id, message_id DESC) INCLUDE (sender_id, created_at, body);
+
+-- Index-only scans need an up-to-date visibility map; messages are only ever
+-- appended, so let autovacuum visit the table after inserts, not just updates
+ALTER TABLE public.messages SET (autovacuum_vacuum_insert_scale_factor = 0.02);
@@ -0,0 +1,5 @@
+-- migrate:no-transaction
+-- Each worker's suggest index (suggest.py) polls for books changed since its
+-- last look; this keeps that a short range scan instead of a full table scan.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS books_updated_at_idx
+    ON public.books (updated_at);
@@ -0,0 +1,19 @@
+-- In place of the swap_cycle_members.request_id and
+-- swap_match_queue.request_id foreign keys (both ON DELETE CASCADE) that
+-- partitioning swap_requests dropped (0013):
+-- deleting requests still deletes their queue and circle rows. Detaching a
+-- month deletes nothing, so partitions.apply_retention clears them then.
+CREATE OR REPLACE FUNCTION public.swap_requests_delete_dependents() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    DELETE FROM public.swap_match_queue WHERE request_id IN (SELECT request_id FROM old_rows);
+    DELETE FROM public.swap_cycle_members WHERE request_id IN (SELECT request_id FROM old_rows);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS swap_requests_delete_dependents ON public.swap_requests;
+CREATE TRIGGER swap_requests_delete_dependents AFTER DELETE ON public.swap_requests
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.swap_requests_delete_dependents();
@@ -0,0 +1,147 @@
+import logging
+import select
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+log = logging.getLogger(__name__)
+
+# Channel the outbox insert trigger wakes the worker on (migrations/0008)
+CHANNEL = 'notification_outbox'
+
+
+# -----------------------------
+# Outbox Insert
+# -----------------------------
+def enqueue(cursor, notifications):
+    """Queue (user_id, type, content, idempotency_key) notifications on the outbox.
+
+    Runs inside the caller's transaction as one multi-row insert, so the
+    notifications exist exactly when the change that caused them commits.
+    The worker below delivers them and bumps the unread counters; a key that
+    was already queued or delivered is ignored.
+    """
+    if not notifications:
+        return
+    psycopg2.extras.execute_values(cursor, """
+        INSERT INTO notification_outbox (user_id, type, content, idempotency_key) VALUES %s
+        ON CONFLICT (idempotency_key) DO NOTHING
+    """, notifications, page_size=len(notifications))
+
+
+# -----------------------------
+# Outbox Drain
+# -----------------------------
+def _deliver(cursor, outbox_ids):
+    """Move the given outbox rows into notifications. Rows whose idempotency
+    key was already delivered are dropped without bumping any counter."""
+    # Counters first, so the pg_notify payload of each inserted row carries
+    # the recipient's final unread count. Recipients are locked in id order.
+    cursor.execute("""
+        SELECT o.user_id, count(*) AS n
+        FROM notification_outbox o
+        WHERE o.outbox_id = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM notifications n WHERE n.idempotency_key = o.idempotency_key)
+        GROUP BY o.user_id
+        ORDER BY o.user_id
+    """, (outbox_ids,))
+    counts = cursor.fetchall()
+    if counts:
+        user_ids = [row[0] for row in counts]
+        cursor.execute("SELECT user_id FROM users WHERE user_id = ANY(%s) ORDER BY user_id FOR UPDATE", (user_ids,))
+        cursor.execute("""
+            UPDATE users u SET unread_notifications = u.unread_notifications + d.n
+            FROM unnest(%s::int[], %s::int[]) AS d(user_id, n)
+            WHERE u.user_id = d.user_id
+        """, (user_ids, [row[1] for row in counts]))
+    # notifications is partitioned by created_at, so its unique key is
+    # (idempotency_key, created_at); the NOT EXISTS keeps keys unique across months
+    cursor.execute("""
+        INSERT INTO notifications (user_id, type, content, status, idempotency_key, created_at)
+        SELECT o.user_id, o.type, o.content, 'unread', o.idempotency_key, o.created_at
+        FROM notification_outbox o
+        WHERE o.outbox_id = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM notifications n WHERE n.idempotency_key = o.idempotency_key)
+        ORDER BY o.outbox_id
+        ON CONFLICT (idempotency_key, created_at) DO NOTHING
+    """, (outbox_ids,))
+    delivered = cursor.rowcount
+    cursor.execute("DELETE FROM notification_outbox WHERE outbox_id = ANY(%s)", (outbox_ids,))
+    return delivered
+
+
+def drain_once(conn, batch_size=500, max_attempts=5):
+    """Deliver one batch from the outbox; returns the number of rows taken off it.
+
+    Batches are claimed with SKIP LOCKED, so several workers can drain side by
+    side. If a batch fails it is retried row by row; a row that keeps failing
+    is backed off exponentially and parked after ``max_attempts``.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT outbox_id FROM notification_outbox
+        WHERE available_at <= CURRENT_TIMESTAMP AND attempts < %s
+        ORDER BY outbox_id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (max_attempts, batch_size))
+    outbox_ids = [row[0] for row in cursor.fetchall()]
+    if not outbox_ids:
+        conn.rollback()
+        return 0
+
+    cursor.execute("SAVEPOINT batch")
+    try:
+        _deliver(cursor, outbox_ids)
+        conn.commit()
+        return len(outbox_ids)
+    except psycopg2.Error:
+        log.exception("Outbox batch of %d failed; retrying row by row", len(outbox_ids))
+        cursor.execute("ROLLBACK TO SAVEPOINT batch")
+
+    taken = 0
+    for outbox_id in outbox_ids:
+        cursor.execute("SAVEPOINT row")
+        try:
+            _deliver(cursor, [outbox_id])
+            taken += 1
+        except psycopg2.Error as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT row")
+            cursor.execute("""
+                UPDATE notification_outbox
+                SET attempts = attempts + 1,
+                    available_at = CURRENT_TIMESTAMP + make_interval(secs => power(2, attempts + 1)),
+                    last_error = %s
+                WHERE outbox_id = %s
+            """, (str(e), outbox_id))
+    conn.commit()
+    return taken
+
+
+def run(connect_kwargs, batch_size=500, max_attempts=5, poll_interval=5.0):
+    """Drain the outbox forever, waking on pg_notify and polling as a fallback"""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**connect_kwargs)
+            listener = psycopg2.connect(**connect_kwargs)
+            listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            listener.cursor().execute("LISTEN %s" % CHANNEL)
+            try:
+                while True:
+                    while drain_once(conn, batch_size, max_attempts) == batch_size:
+                        pass
+                    # Sleep until something is queued; the timeout also picks up rows whose backoff expired
+                    if select.select([listener], [], [], poll_interval) != ([], [], []):
+                        listener.poll()
+                        del listener.notifies[:]
+            finally:
+                listener.close()
+        except (psycopg2.Error, OSError):
+            log.exception("Outbox worker lost its connection; reconnecting")
+            time.sleep(poll_interval)
+        finally:
+            if conn is not None:
+                conn.close()
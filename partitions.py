@@ -0,0 +1,198 @@
+import logging
+import re
+from datetime import date, datetime
+
+import psycopg2.errors
+
+log = logging.getLogger(__name__)
+
+# Tables partitioned by month of created_at (migrations/0013)
+TABLES = ('notifications', 'swap_requests', 'return_requests')
+
+# Rows that are still live; a month holding any stays attached past its retention
+LIVE_ROWS = {
+    'swap_requests': "status = 'pending'",
+    'return_requests': "status = 'pending'",
+}
+
+# Rows elsewhere that point at a table's rows: (table, column). The foreign
+# keys that used to delete them went with the partitioning (migrations/0013),
+# so a month's dependents are deleted before it is detached
+DEPENDENTS = {
+    'swap_requests': (('swap_match_queue', 'request_id'), ('swap_cycle_members', 'request_id')),
+}
+
+# Months attached to each table, and what happens to older months:
+# 'archive' moves them under archive.<table>, 'drop' deletes them
+DEFAULT_RETENTION = {
+    'notifications': (6, 'archive'),
+    'swap_requests': (24, 'archive'),
+    'return_requests': (24, 'archive'),
+}
+
+_BOUND = re.compile(r"FOR VALUES FROM \((.+)\) TO \((.+)\)")
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def _bound(value):
+    """A partition bound as printed by pg_get_expr: MINVALUE or a quoted timestamp"""
+    if value == 'MINVALUE':
+        return None
+    return datetime.strptime(value.strip("'")[:10], '%Y-%m-%d').date()
+
+
+def list_partitions(cursor, table):
+    """[(name, lower, upper)] for the table's range partitions, oldest first;
+    lower is None for the partition that starts at MINVALUE. The default
+    partition is left out."""
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = format('public.%%I', %s::text)::regclass
+    """, (table,))
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = _BOUND.match(bound)
+        if match:
+            partitions.append((name, _bound(match.group(1)), _bound(match.group(2))))
+    return sorted(partitions, key=lambda p: p[2])
+
+
+# -----------------------------
+# Future Partitions
+# -----------------------------
+def _create_month(cursor, table, name, start, end):
+    """Create one month's partition; returns how many rows it took over from
+    the default partition, which a month can't be attached next to while the
+    default holds any of its rows"""
+    default = '%s_default' % table
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", ('public.' + default,))
+    if cursor.fetchone()[0]:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM public.%s WHERE created_at >= %%s AND created_at < %%s)"
+                       % default, (start, end))
+        if cursor.fetchone()[0]:
+            # Statements on a partition don't fire the parent's statement
+            # triggers, so the move leaves counters and the match queue alone
+            cursor.execute("CREATE TABLE public.%s (LIKE public.%s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                           % (name, table))
+            cursor.execute("""
+                WITH moved AS (
+                    DELETE FROM public.%s WHERE created_at >= %%s AND created_at < %%s RETURNING *
+                )
+                INSERT INTO public.%s SELECT * FROM moved
+            """ % (default, name), (start, end))
+            moved = cursor.rowcount
+            cursor.execute("ALTER TABLE public.%s ATTACH PARTITION public.%s FOR VALUES FROM ('%s') TO ('%s')"
+                           % (table, name, start, end))
+            log.warning("moved %d row(s) from %s into %s; run maintain-partitions before each month starts",
+                        moved, default, name)
+            return moved
+    cursor.execute("CREATE TABLE public.%s PARTITION OF public.%s FOR VALUES FROM ('%s') TO ('%s')"
+                   % (name, table, start, end))
+    return 0
+
+
+def ensure_partitions(conn, months_ahead=3, today=None):
+    """Create monthly partitions through `months_ahead` months past this one;
+    returns the names created. Safe to run as often as you like, and catches
+    up on months missed meanwhile, including rows the default partition took."""
+    first_of_month = (today or date.today()).replace(day=1)
+    until = _add_months(first_of_month, months_ahead + 1)
+    cursor = conn.cursor()
+    created = []
+    try:
+        for table in TABLES:
+            partitions = list_partitions(cursor, table)
+            start = partitions[-1][2] if partitions else first_of_month
+            while start < until:
+                end = _add_months(start, 1)
+                name = '%s_p%04d_%02d' % (table, start.year, start.month)
+                _create_month(cursor, table, name, start, end)
+                created.append(name)
+                start = end
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return created
+
+
+# -----------------------------
+# Retention
+# -----------------------------
+def _mark_read(cursor, partition):
+    """Mark a month's unread notifications read, taking them off the unread counters"""
+    cursor.execute("""
+        SELECT user_id, count(*) FROM public.%s WHERE status = 'unread' GROUP BY user_id ORDER BY user_id
+    """ % partition)
+    counts = cursor.fetchall()
+    if not counts:
+        return
+    user_ids = [row[0] for row in counts]
+    cursor.execute("SELECT user_id FROM users WHERE user_id = ANY(%s) ORDER BY user_id FOR UPDATE", (user_ids,))
+    cursor.execute("""
+        UPDATE users u SET unread_notifications = greatest(u.unread_notifications - d.n, 0)
+        FROM unnest(%s::int[], %s::int[]) AS d(user_id, n)
+        WHERE u.user_id = d.user_id
+    """, (user_ids, [row[1] for row in counts]))
+    cursor.execute("UPDATE public.%s SET status = 'read' WHERE status = 'unread'" % partition)
+
+
+def apply_retention(conn, retention=None, today=None, lock_timeout='5s'):
+    """Detach every month older than its table's retention and archive or drop
+    it; returns [(partition, action)]. Each month is handled in its own short
+    transaction. Detaching briefly locks the parent table, so a lock that
+    can't be had within lock_timeout skips the month until the next run."""
+    retention = dict(DEFAULT_RETENTION, **(retention or {}))
+    first_of_month = (today or date.today()).replace(day=1)
+    cursor = conn.cursor()
+    done = []
+    try:
+        for table in TABLES:
+            months, action = retention[table]
+            cutoff = _add_months(first_of_month, -months)
+            for name, lower, upper in list_partitions(cursor, table):
+                if upper > cutoff:
+                    break
+                live = LIVE_ROWS.get(table)
+                if live:
+                    cursor.execute("SELECT EXISTS (SELECT 1 FROM public.%s WHERE %s)" % (name, live))
+                    if cursor.fetchone()[0]:
+                        log.warning("keeping %s past its retention: it still has rows where %s", name, live)
+                        conn.rollback()
+                        continue
+                cursor.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+                try:
+                    if table == 'notifications':
+                        _mark_read(cursor, name)
+                    for dependent, column in DEPENDENTS.get(table, ()):
+                        cursor.execute("DELETE FROM public.%s WHERE %s IN (SELECT %s FROM public.%s)"
+                                       % (dependent, column, column, name))
+                    cursor.execute("ALTER TABLE public.%s DETACH PARTITION public.%s" % (table, name))
+                    if action == 'drop':
+                        cursor.execute("DROP TABLE public.%s" % name)
+                    else:
+                        cursor.execute("ALTER TABLE public.%s SET SCHEMA archive" % name)
+                        bounds = "FROM (MINVALUE)" if lower is None else "FROM ('%s')" % lower
+                        cursor.execute("ALTER TABLE archive.%s ATTACH PARTITION archive.%s FOR VALUES %s TO ('%s')"
+                                       % (table, name, bounds, upper))
+                    conn.commit()
+                except psycopg2.errors.LockNotAvailable as e:
+                    conn.rollback()
+                    log.warning("skipping %s this run: %s", name, e)
+                    continue
+                log.info("%s %s", 'dropped' if action == 'drop' else 'archived', name)
+                done.append((name, action))
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return done
@@ -0,0 +1,69 @@
+import json
+from datetime import datetime
+
+import repository
+
+# Every repository statement, plus the inline queries the write routes in
+# app.py look rows up with (keep those in sync when a route's SQL changes).
+ROUTE_QUERIES = [(stmt.name, stmt.sql) for stmt in repository.STATEMENTS] + [
+    ('notifications: mark all read',
+     "UPDATE notifications SET status='read' WHERE user_id=%(user_id)s AND status='unread'"),
+    ('request_return: active swap', """
+        SELECT acs.holder_id, b.title, u.name as holder_name
+        FROM active_swaps acs JOIN books b ON acs.book_id = b.book_id
+        JOIN users u ON acs.holder_id = u.user_id
+        WHERE acs.book_id = %(book_id)s AND acs.owner_id = %(user_id)s
+    """),
+]
+
+DEFAULT_PARAMS = {
+    'user_id': 1,
+    'book_id': 1,
+    'notification_id': 1,
+    'email': 'someone@example.com',
+    'genre': 'Fiction',
+    'author': 'Jane Austen',
+    'query': 'pride prejudice',
+    'created_at': datetime(2030, 1, 1),
+    'rating': 4.5,
+    'min_rating': 4,
+    'kind': 'swap',
+    'request_id': 1,
+    'conversation_id': 1,
+    'before': 1000,
+    'limit': 21,
+    'offset': 0,
+}
+
+
+def _seq_scans(plan, found):
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        _seq_scans(child, found)
+    return found
+
+
+def find_seq_scans(conn, queries=ROUTE_QUERIES, params=DEFAULT_PARAMS):
+    """EXPLAIN each query and return {name: [tables scanned sequentially]} for the offenders.
+
+    Sequential scans are disabled for the check, so the planner only falls
+    back to one when no index can serve the query at all. That keeps the
+    result independent of how much data happens to be seeded.
+    """
+    failures = {}
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        for name, sql in queries:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            tables = _seq_scans(plan[0]['Plan'], [])
+            if tables:
+                failures[name] = tables
+    finally:
+        cursor.close()
+        conn.rollback()
+    return failures
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from flask import current_app
+
+import db
+
+log = logging.getLogger(__name__)
+
+# Channel the notifications insert trigger publishes on (migrations/0006)
+CHANNEL = 'notifications'
+
+
+# -----------------------------
+# Notification Hub
+# -----------------------------
+class NotificationHub:
+    """Fans pg_notify events out to in-process subscribers.
+
+    One background thread per worker holds a dedicated LISTEN connection
+    (outside the request pool) and pushes each event onto the queues of the
+    subscribers registered for the event's user_id. The thread starts with
+    the first subscriber and reconnects with backoff if the connection drops.
+    """
+
+    def __init__(self, connect_kwargs, channel=CHANNEL, ping_interval=15.0, queue_size=100):
+        self._connect_kwargs = connect_kwargs
+        self.channel = channel
+        self.ping_interval = ping_interval
+        self.queue_size = queue_size
+        self._subscribers = {}  # user_id -> set of queues
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, user_id):
+        q = queue.Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(q)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='notification-hub', daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, user_id, q):
+        with self._lock:
+            queues = self._subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(q)
+                if not queues:
+                    del self._subscribers[user_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(queues) for queues in self._subscribers.values())
+
+    def _dispatch(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            log.warning("Ignoring malformed %s payload: %r", self.channel, payload)
+            return
+        with self._lock:
+            queues = list(self._subscribers.get(event.get('user_id'), ()))
+        for q in queues:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # A stalled client must not hold up everyone else; it catches up on reload
+                pass
+
+    def _listen(self):
+        conn = psycopg2.connect(**self._connect_kwargs)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            cursor.execute("LISTEN %s" % self.channel)
+            while True:
+                if select.select([conn], [], [], self.ping_interval) == ([], [], []):
+                    # Quiet period: make sure the server is still there
+                    cursor.execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._dispatch(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def _run(self):
+        backoff = 1
+        while True:
+            started = time.monotonic()
+            try:
+                self._listen()
+            except (psycopg2.Error, OSError):
+                log.exception("Notification listener lost its connection; reconnecting in %ss", backoff)
+            if time.monotonic() - started > 60:
+                backoff = 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+
+_hub = None
+_hub_pid = None
+_hub_lock = threading.Lock()
+
+
+def get_hub():
+    """Return this worker's hub, creating it on first use (and after a fork)"""
+    global _hub, _hub_pid
+    if _hub is None or _hub_pid != os.getpid():
+        with _hub_lock:
+            if _hub is None or _hub_pid != os.getpid():
+                _hub = NotificationHub(db.connect_kwargs(current_app.config))
+                _hub_pid = os.getpid()
+    return _hub
+
+
+def format_sse(event, data):
+    """Encode one server-sent event"""
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(data, default=str))
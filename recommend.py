@@ -0,0 +1,290 @@
+import io
+import logging
+
+try:
+    import numpy as np
+    import scipy.sparse as sp
+except ImportError:  # only the full rebuild needs them
+    np = sp = None
+
+log = logging.getLogger(__name__)
+
+# How strongly each kind of interaction says "this user likes this book".
+# A review is scaled by its rating: it rates the swap, but the reviewer did read the book.
+WEIGHTS = {'requested': 1.0, 'accepted': 2.0, 'held': 2.0, 'reviewed': 1.5}
+# Books a user owns count towards their genre taste, not towards similarity
+OWNED_GENRE_WEIGHT = 0.5
+
+# Rebuild and incremental updates must not interleave (arbitrary key)
+ADVISORY_LOCK_KEY = 7438202
+
+# Dense score cells per chunk of users during a rebuild (float32: ~20 MB)
+CHUNK_CELLS = 5000000
+
+
+def _interactions_sql(filtered):
+    """(user_id, book_id, weight) summed over every interaction; filtered
+    takes a %(user_ids)s array so each branch can use its user index"""
+    def where(column):
+        return " WHERE %s = ANY(%%(user_ids)s)" % column if filtered else ""
+    return """
+        SELECT user_id, book_id, sum(weight)::float8 AS weight FROM (
+            SELECT sender_id AS user_id, book_id,
+                   CASE status WHEN 'accepted' THEN %(accepted)s ELSE %(requested)s END AS weight
+            FROM swap_requests""" + where('sender_id') + """
+            UNION ALL
+            SELECT holder_id, book_id, %(held)s FROM active_swaps""" + where('holder_id') + """
+            UNION ALL
+            SELECT reviewer_id, book_id, %(reviewed)s * rating / 5.0 FROM reviews""" + where('reviewer_id') + """
+        ) i
+        GROUP BY user_id, book_id
+    """
+
+
+def _copy(cursor, table, columns, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(map(str, row)))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_expert("COPY %s (%s) FROM STDIN" % (table, ', '.join(columns)), buf)
+
+
+# -----------------------------
+# Full Rebuild
+# -----------------------------
+def _top_n_per_row(m, n):
+    """Keep the n largest entries of every row of a CSR matrix"""
+    row = np.repeat(np.arange(m.shape[0]), np.diff(m.indptr))
+    # Sort by row, then by value descending; the row blocks stay where indptr says
+    order = np.lexsort((-m.data, row))
+    position = np.arange(len(order)) - m.indptr[row[order]]
+    keep = order[position < n]
+    return sp.csr_matrix((m.data[keep], (row[keep], m.indices[keep])), shape=m.shape)
+
+
+def _load(cursor):
+    cursor.execute("SELECT book_id, user_id, genre, status = 'available' FROM books ORDER BY book_id")
+    books = cursor.fetchall()
+    cursor.execute(_interactions_sql(False), WEIGHTS)
+    interactions = cursor.fetchall()
+    cursor.execute("SELECT user_id, marked_at FROM recommendation_dirty_users")
+    dirty = cursor.fetchall()
+    return books, interactions, dirty
+
+
+def compute(books, interactions, top_k=20, neighbours=50, genre_weight=0.3):
+    """Return (similarities, recommendations) as lists of id tuples.
+
+    R is the users x books interaction matrix. Item-item similarity is the
+    cosine of R's columns, trimmed to each book's nearest `neighbours`. A user's
+    score for an available book is their interactions times its similarities,
+    plus `genre_weight` times their share of interest in its genre (which
+    also covers books nobody has touched yet). Users are scored in chunks so
+    the dense block stays bounded.
+    """
+    book_ids = np.array([b[0] for b in books], dtype=np.int64)
+    owners = np.array([b[1] for b in books], dtype=np.int64)
+    available = np.array([b[3] for b in books], dtype=bool)
+    genres = [b[2] for b in books]
+    book_index = {book_id: i for i, book_id in enumerate(book_ids.tolist())}
+    interactions = [row for row in interactions if row[1] in book_index]
+
+    user_ids = np.unique(np.concatenate([owners, np.array([row[0] for row in interactions], dtype=np.int64)]))
+    user_index = {user_id: i for i, user_id in enumerate(user_ids.tolist())}
+    shape = (len(user_ids), len(book_ids))
+
+    R = sp.csr_matrix((np.array([row[2] for row in interactions], dtype=np.float32),
+                       ([user_index[row[0]] for row in interactions], [book_index[row[1]] for row in interactions])),
+                      shape=shape)
+    O = sp.csr_matrix((np.ones(len(book_ids), dtype=np.float32),
+                       ([user_index[o] for o in owners.tolist()], np.arange(len(book_ids)))), shape=shape)
+
+    # Item-item cosine similarity over co-interacting users
+    norms = np.sqrt(np.asarray(R.multiply(R).sum(axis=0)).ravel())
+    inverse = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    Rn = R @ sp.diags(inverse.astype(np.float32))
+    S = (Rn.T @ Rn).tocsr()
+    S = (S - sp.diags(S.diagonal())).tocsr()
+    S.eliminate_zeros()
+    S = _top_n_per_row(S, neighbours)
+
+    # Users x genres, each row a share of that user's interest
+    genre_names = sorted({g for g in genres if g})
+    genre_index = {g: i for i, g in enumerate(genre_names)}
+    tagged = [i for i, g in enumerate(genres) if g]
+    G = sp.csr_matrix((np.ones(len(tagged), dtype=np.float32), (tagged, [genre_index[genres[i]] for i in tagged])),
+                      shape=(len(book_ids), len(genre_names)))
+    UG = (R + OWNED_GENRE_WEIGHT * O) @ G
+    totals = np.asarray(UG.sum(axis=1)).ravel()
+    UG = sp.diags(np.divide(1.0, totals, out=np.zeros_like(totals), where=totals > 0)) @ UG
+
+    candidates = np.flatnonzero(available)
+    recommendations = []
+    if len(candidates):
+        S_candidates = S.tocsc()[:, candidates].tocsr()
+        G_candidates = G[candidates].T.tocsr()
+        seen = (R + O).tocsc()[:, candidates].tocsr()
+        k = min(top_k, len(candidates))
+        chunk = max(1, CHUNK_CELLS // len(candidates))
+        for start in range(0, len(user_ids), chunk):
+            rows = slice(start, start + chunk)
+            scores = (R[rows] @ S_candidates).toarray()
+            scores += genre_weight * (UG[rows] @ G_candidates).toarray()
+            # Nothing the user owns or has already requested, held or reviewed
+            scores[seen[rows].nonzero()] = 0
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            for offset, user_id in enumerate(user_ids[rows].tolist()):
+                rank = 0
+                for column, score in zip(top[offset].tolist(), top_scores[offset].tolist()):
+                    if score <= 0:
+                        break
+                    rank += 1
+                    recommendations.append((user_id, rank, int(book_ids[candidates[column]]), score))
+
+    S = S.tocoo()
+    similarities = list(zip(book_ids[S.row].tolist(), book_ids[S.col].tolist(), S.data.tolist()))
+    return similarities, recommendations
+
+
+def rebuild(conn, top_k=20, neighbours=50, genre_weight=0.3):
+    """Recompute similarities and every user's recommendations; returns the number of users with any"""
+    if sp is None:
+        raise RuntimeError("the recommendation rebuild needs NumPy and SciPy: pip install numpy scipy")
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+    conn.commit()
+    try:
+        # One snapshot for all three reads
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        books, interactions, dirty = _load(cursor)
+        conn.commit()
+        log.info("rebuilding recommendations: %d books, %d interactions", len(books), len(interactions))
+        similarities, recommendations = compute(books, interactions, top_k, neighbours, genre_weight)
+
+        # DELETE rather than TRUNCATE: readers keep the old lists until this commits
+        cursor.execute("DELETE FROM book_similarities")
+        _copy(cursor, 'book_similarities', ('book_id', 'similar_book_id', 'score'), similarities)
+        cursor.execute("DELETE FROM book_recommendations")
+        _copy(cursor, 'book_recommendations', ('user_id', 'rank', 'book_id', 'score'), recommendations)
+        # Marks made after the snapshot stay queued for the next incremental update
+        if dirty:
+            cursor.execute("""
+                DELETE FROM recommendation_dirty_users d
+                USING unnest(%s::int[], %s::timestamp[]) AS seen(user_id, marked_at)
+                WHERE d.user_id = seen.user_id AND d.marked_at = seen.marked_at
+            """, ([row[0] for row in dirty], [row[1] for row in dirty]))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+        conn.commit()
+        cursor.close()
+    return len({row[0] for row in recommendations})
+
+
+# -----------------------------
+# Incremental Update
+# -----------------------------
+# The rebuild's scoring, in SQL, for a handful of users: similarity from the
+# stored neighbours of what they interacted with, genre share from their
+# interactions and shelf. Books that only match on genre are drawn from the
+# newest available ones in each of their genres.
+_UPDATE_SQL = """
+    WITH interactions AS (""" + _interactions_sql(True) + """),
+    owned AS (
+        SELECT user_id, book_id, genre FROM books WHERE user_id = ANY(%(user_ids)s)
+    ),
+    genre_weights AS (
+        SELECT user_id, genre, sum(weight) AS weight FROM (
+            SELECT i.user_id, b.genre, i.weight FROM interactions i JOIN books b ON b.book_id = i.book_id
+            UNION ALL
+            SELECT user_id, genre, %(owned_genre_weight)s FROM owned
+        ) g
+        WHERE genre IS NOT NULL
+        GROUP BY user_id, genre
+    ),
+    genre_affinity AS (
+        SELECT user_id, genre, weight / sum(weight) OVER (PARTITION BY user_id) AS affinity FROM genre_weights
+    ),
+    candidates AS (
+        SELECT i.user_id, s.similar_book_id AS book_id, sum(i.weight * s.score) AS score
+        FROM interactions i JOIN book_similarities s ON s.book_id = i.book_id
+        GROUP BY i.user_id, s.similar_book_id
+        UNION ALL
+        SELECT ga.user_id, newest.book_id, 0
+        FROM genre_affinity ga
+        CROSS JOIN LATERAL (
+            SELECT book_id FROM books
+            WHERE status = 'available' AND genre = ga.genre
+            ORDER BY created_at DESC, book_id DESC
+            LIMIT %(top_k)s
+        ) newest
+    ),
+    scored AS (
+        SELECT c.user_id, c.book_id,
+               sum(c.score) + %(genre_weight)s * coalesce(max(ga.affinity), 0) AS score
+        FROM candidates c
+        JOIN books b ON b.book_id = c.book_id AND b.status = 'available' AND b.user_id <> c.user_id
+        LEFT JOIN genre_affinity ga ON ga.user_id = c.user_id AND ga.genre = b.genre
+        WHERE NOT EXISTS (SELECT 1 FROM interactions i WHERE i.user_id = c.user_id AND i.book_id = c.book_id)
+        GROUP BY c.user_id, c.book_id
+    ),
+    ranked AS (
+        SELECT user_id, book_id, score,
+               row_number() OVER (PARTITION BY user_id ORDER BY score DESC, book_id DESC) AS rank
+        FROM scored
+        WHERE score > 0
+    )
+    INSERT INTO book_recommendations (user_id, rank, book_id, score)
+    SELECT user_id, rank, book_id, score FROM ranked WHERE rank <= %(top_k)s
+"""
+
+
+def update_dirty(conn, batch_size=500, top_k=20, genre_weight=0.3):
+    """Recompute the lists of users queued by the review/swap triggers.
+    Returns the number of users updated, or None if a rebuild holds the lock."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_try_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+    locked = cursor.fetchone()[0]
+    conn.commit()
+    if not locked:
+        cursor.close()
+        return None
+    updated = 0
+    try:
+        while True:
+            # A user marked again while we work waits on our row lock, then re-queues
+            cursor.execute("""
+                DELETE FROM recommendation_dirty_users
+                WHERE user_id IN (
+                    SELECT user_id FROM recommendation_dirty_users
+                    ORDER BY marked_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING user_id
+            """, (batch_size,))
+            user_ids = [row[0] for row in cursor.fetchall()]
+            if not user_ids:
+                conn.commit()
+                break
+            cursor.execute("DELETE FROM book_recommendations WHERE user_id = ANY(%s)", (user_ids,))
+            cursor.execute(_UPDATE_SQL, dict(WEIGHTS, user_ids=user_ids, top_k=top_k, genre_weight=genre_weight,
+                                             owned_genre_weight=OWNED_GENRE_WEIGHT))
+            conn.commit()
+            updated += len(user_ids)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+        conn.commit()
+        cursor.close()
+    return updated
@@ -0,0 +1,622 @@
+import itertools
+import re
+import threading
+import weakref
+
+import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+import psycopg2.extras
+
+# Named %(param)s placeholders, as used by psycopg2 and psycopg 3
+_PARAM = re.compile(r'%\((\w+)\)s')
+
+
+# -----------------------------
+# Prepared Statements
+# -----------------------------
+class Statement:
+    """A read query that is prepared on the server once per connection.
+
+    ``sql`` uses %(name)s placeholders; the PREPARE'd form numbers them in
+    order of first appearance, and each call sends only
+    ``EXECUTE name(...)`` with the values, skipping parse and analysis (and,
+    once Postgres settles on a generic plan, planning) on the server.
+    """
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.params = list(dict.fromkeys(_PARAM.findall(sql)))
+        positional = _PARAM.sub(lambda m: '$%d' % (self.params.index(m.group(1)) + 1), sql)
+        self.prepare_sql = 'PREPARE %s AS %s' % (name, positional)
+        if self.params:
+            self.execute_sql = 'EXECUTE %s (%s)' % (name, ', '.join('%%(%s)s' % p for p in self.params))
+        else:
+            self.execute_sql = 'EXECUTE %s' % name
+
+
+STATEMENTS = []
+
+
+def statement(name, sql):
+    stmt = Statement(name, sql)
+    STATEMENTS.append(stmt)
+    return stmt
+
+
+_prepared = weakref.WeakKeyDictionary()  # connection -> names prepared on it
+_prepared_lock = threading.Lock()
+
+# Raised by EXECUTE when a migration changed a table under a prepared
+# statement, or when the server session no longer has it
+_STALE = {psycopg2.errorcodes.FEATURE_NOT_SUPPORTED, psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME}
+
+
+def _prepared_names(conn):
+    with _prepared_lock:
+        return _prepared.setdefault(conn, set())
+
+
+# Marks a connection whose prepared statements must be dropped before the next PREPARE
+_DEALLOCATE = object()
+
+
+def execute(cursor, stmt, params, retry=True):
+    """Run a Statement on cursor, preparing it first on a connection that hasn't seen it"""
+    conn = cursor.connection
+    names = _prepared_names(conn)
+    fresh_transaction = conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    if stmt.name not in names:
+        if _DEALLOCATE in names:
+            cursor.execute("DEALLOCATE ALL")
+            names.clear()
+        cursor.execute(stmt.prepare_sql)
+        names.add(stmt.name)
+    try:
+        cursor.execute(stmt.execute_sql, params)
+    except psycopg2.Error as e:
+        if e.pgcode not in _STALE:
+            raise
+        names.clear()
+        names.add(_DEALLOCATE)
+        if not (retry and fresh_transaction):
+            raise
+        # Nothing else ran in this transaction, so it can be retried with fresh statements
+        conn.rollback()
+        execute(cursor, stmt, params, retry=False)
+
+
+def fetch_one(cursor, stmt, **params):
+    execute(cursor, stmt, params)
+    return cursor.fetchone()
+
+
+def fetch_all(cursor, stmt, **params):
+    execute(cursor, stmt, params)
+    return cursor.fetchall()
+
+
+# -----------------------------
+# Streaming
+# -----------------------------
+_stream_ids = itertools.count()
+
+
+class RowStream:
+    """Rows of a query read through a named (server-side) cursor, `itersize`
+    at a time, while a streamed template loops over them.
+
+    Truthiness peeks at the first row, so ``{% if rows %}`` works, but the
+    rows can only be looped over once. At most `limit` rows are yielded;
+    afterwards `last` is the last of them and `has_more` tells whether the
+    query returned more. Server-side cursors only live as long as their
+    transaction, and can't run an EXECUTE, so the statement's SQL is sent
+    as is rather than prepared.
+    """
+
+    def __init__(self, conn, sql, params, itersize, transform=None, limit=None):
+        self._cursor = conn.cursor(name='row_stream_%d' % next(_stream_ids),
+                                   cursor_factory=psycopg2.extras.RealDictCursor)
+        self._cursor.itersize = itersize
+        self._cursor.execute(sql, params)
+        self._rows = iter(self._cursor)
+        self._peeked = []
+        self._transform = transform
+        self.limit = limit
+        self.last = None
+        self.has_more = False
+
+    def _next(self):
+        if self._peeked:
+            return self._peeked.pop()
+        row = next(self._rows, None)
+        if row is not None and self._transform is not None:
+            row = self._transform(row)
+        return row
+
+    def __bool__(self):
+        if not self._peeked and self.last is None:
+            row = self._next()
+            if row is None:
+                self.close()
+                return False
+            self._peeked.append(row)
+        return bool(self._peeked) or self.last is not None
+
+    def __iter__(self):
+        count = 0
+        while self.limit is None or count < self.limit:
+            row = self._next()
+            if row is None:
+                break
+            count += 1
+            self.last = row
+            yield row
+        else:
+            self.has_more = self._next() is not None
+        self.close()
+
+    def close(self):
+        if not self._cursor.closed:
+            self._cursor.close()
+
+
+def stream(conn, stmt, params, itersize, **kwargs):
+    """RowStream over a Statement's query"""
+    return RowStream(conn, stmt.sql, {k: v for k, v in params.items() if k in stmt.params}, itersize, **kwargs)
+
+
+def _side_sql(stmt):
+    # The side filter reaches into the UNION, so only that side's branch runs
+    return "SELECT * FROM (" + stmt.sql + ") lists WHERE side = %(side)s"
+
+
+# -----------------------------
+# Users
+# -----------------------------
+UNREAD_COUNT = statement('unread_count', """
+    SELECT unread_notifications FROM users WHERE user_id=%(user_id)s
+""")
+
+USER_BY_EMAIL = statement('user_by_email', """
+    SELECT * FROM users WHERE email=%(email)s
+""")
+
+# User row and its precomputed stats (user_stats, kept current by triggers)
+PROFILE = statement('profile', """
+    SELECT u.*,
+           coalesce(s.book_count, 0) AS total_books,
+           coalesce(s.swap_count, 0) AS total_swaps,
+           coalesce(s.rating_count, 0) AS total_reviews,
+           CASE WHEN s.rating_count > 0
+                THEN (s.rating_sum::NUMERIC / s.rating_count)::NUMERIC(3,2)
+           END AS avg_rating
+    FROM users u
+    LEFT JOIN user_stats s ON s.user_id = u.user_id
+    WHERE u.user_id=%(user_id)s
+""")
+
+
+# -----------------------------
+# Reviews
+# -----------------------------
+# Version of both lists: count, newest change and newest id of each side.
+# The counts and averages also head the page, so it needn't hold every review to show them.
+REVIEWS_VERSION = statement('reviews_version', """
+    SELECT count(*) FILTER (WHERE reviewed_id = %(user_id)s) AS received_count,
+           avg(rating) FILTER (WHERE reviewed_id = %(user_id)s) AS received_rating_avg,
+           avg(rating) FILTER (WHERE reviewer_id = %(user_id)s) AS given_rating_avg,
+           max(updated_at) FILTER (WHERE reviewed_id = %(user_id)s) AS received_updated_at,
+           max(review_id) FILTER (WHERE reviewed_id = %(user_id)s) AS last_received_id,
+           count(*) FILTER (WHERE reviewer_id = %(user_id)s) AS given_count,
+           max(updated_at) FILTER (WHERE reviewer_id = %(user_id)s) AS given_updated_at,
+           max(review_id) FILTER (WHERE reviewer_id = %(user_id)s) AS last_given_id
+    FROM reviews
+    WHERE reviewed_id = %(user_id)s OR reviewer_id = %(user_id)s
+""")
+
+REVIEWS_RECEIVED = statement('reviews_received', """
+    SELECT r.rating, r.comment, r.created_at,
+           u.name AS reviewer_name,
+           b.title AS book_title, b.author AS book_author
+    FROM reviews r
+    JOIN users u ON r.reviewer_id = u.user_id
+    JOIN books b ON r.book_id = b.book_id
+    WHERE r.reviewed_id=%(user_id)s
+    ORDER BY r.created_at DESC
+""")
+
+REVIEWS_GIVEN = statement('reviews_given', """
+    SELECT r.rating, r.comment, r.created_at,
+           u.name AS reviewed_user_name,
+           b.title AS book_title, b.author AS book_author
+    FROM reviews r
+    JOIN users u ON r.reviewed_id = u.user_id
+    JOIN books b ON r.book_id = b.book_id
+    WHERE r.reviewer_id=%(user_id)s
+    ORDER BY r.created_at DESC
+""")
+
+
+# -----------------------------
+# Books
+# -----------------------------
+MY_BOOKS = statement('my_books', """
+    SELECT * FROM books WHERE user_id=%(user_id)s
+""")
+
+
+# Sort orders for browsing: the books column each walks, and the query
+# parameter that carries a keyset cursor's position in it
+SORTS = {
+    'newest': ('created_at', 'created_at'),
+    'rating': ('rating_avg', 'rating'),
+}
+
+
+def _available_books_sql(sort, genre, author, min_rating, after):
+    column, position = SORTS[sort]
+    conditions = ["b.status='available'", "b.user_id != %(user_id)s"]
+    if genre:
+        conditions.append("b.genre = %(genre)s")
+    if author:
+        conditions.append("lower(b.author) = lower(%(author)s)")
+    if min_rating:
+        conditions.append("b.rating_avg >= %(min_rating)s")
+    if after:
+        conditions.append("(b.{0}, b.book_id) < (%({1})s, %(book_id)s)".format(column, position))
+    # request_sent is only probed for the rows on this page
+    return """
+        SELECT page.*,
+               EXISTS(
+                   SELECT 1
+                   FROM swap_requests sr
+                   WHERE sr.book_id = page.book_id AND sr.sender_id = %(user_id)s AND sr.status = 'pending'
+               ) AS request_sent
+        FROM (
+            SELECT b.*
+            FROM books b
+            WHERE """ + " AND ".join(conditions) + """
+            ORDER BY b.{0} DESC, b.book_id DESC
+            LIMIT %(limit)s
+        ) page
+        ORDER BY page.{0} DESC, page.book_id DESC
+    """.format(column)
+
+
+# One statement per sort and filter combination, so each keeps a plan that uses its index
+AVAILABLE_BOOKS = {
+    (sort, genre, author, min_rating, after): statement(
+        '_'.join(['available_books'] + (['by_rating'] if sort == 'rating' else []) +
+                 [name for name, on in (('genre', genre), ('author', author),
+                                        ('min_rating', min_rating), ('after', after)) if on]),
+        _available_books_sql(sort, genre, author, min_rating, after))
+    for sort in SORTS
+    for genre in (False, True) for author in (False, True)
+    for min_rating in (False, True) for after in (False, True)
+}
+
+
+def available_books_query(user_id, genre, author, after, limit, sort='newest', min_rating=None):
+    """(statement, params) for a keyset page of books up for swap in `sort`
+    order (newest first or best rated first); `after` is (created_at or
+    rating_avg, book_id)"""
+    stmt = AVAILABLE_BOOKS[(sort, bool(genre), bool(author), bool(min_rating), bool(after))]
+    params = {'user_id': user_id, 'genre': genre, 'author': author, 'min_rating': min_rating, 'limit': limit}
+    if after:
+        params[SORTS[sort][1]], params['book_id'] = after
+    return stmt, {k: v for k, v in params.items() if k in stmt.params}
+
+
+def available_books(cursor, user_id, genre, author, after, limit, sort='newest', min_rating=None):
+    """Keyset page of books up for swap; see available_books_query"""
+    stmt, params = available_books_query(user_id, genre, author, after, limit, sort, min_rating)
+    execute(cursor, stmt, params)
+    return cursor.fetchall()
+
+
+# Precomputed by recommend.py; one range scan of the (user_id, rank) key.
+# Lists can be a little stale, so books swapped or requested since are skipped.
+RECOMMENDATIONS = statement('recommendations', """
+    SELECT b.*, r.score
+    FROM book_recommendations r
+    JOIN books b ON b.book_id = r.book_id
+    WHERE r.user_id = %(user_id)s
+      AND b.status = 'available'
+      AND NOT EXISTS(
+          SELECT 1
+          FROM swap_requests sr
+          WHERE sr.book_id = r.book_id AND sr.sender_id = %(user_id)s AND sr.status = 'pending'
+      )
+    ORDER BY r.rank
+    LIMIT %(limit)s
+""")
+
+
+# Matches come from the GIN index on books.search_vector; only the
+# matching rows are ranked, and request_sent is probed for this page only
+SEARCH = statement('search_books', """
+    WITH q AS (SELECT websearch_to_tsquery('english', %(query)s) AS query)
+    SELECT page.*,
+           EXISTS(
+               SELECT 1
+               FROM swap_requests sr
+               WHERE sr.book_id = page.book_id AND sr.sender_id = %(user_id)s AND sr.status = 'pending'
+           ) AS request_sent
+    FROM (
+        SELECT b.*, ts_rank_cd(b.search_vector, q.query) AS rank
+        FROM books b, q
+        WHERE b.search_vector @@ q.query
+          AND b.status='available' AND b.user_id != %(user_id)s
+        ORDER BY rank DESC, b.book_id DESC
+        LIMIT %(limit)s OFFSET %(offset)s
+    ) page
+    ORDER BY page.rank DESC, page.book_id DESC
+""")
+
+# Version of everything the book page shows: the book row, its review set
+# and whether this viewer has a pending request for it
+BOOK_VERSION = statement('book_version', """
+    SELECT b.updated_at, r.review_count, r.reviews_updated_at, r.last_review_id,
+           EXISTS(
+               SELECT 1
+               FROM swap_requests sr
+               WHERE sr.book_id = b.book_id AND sr.sender_id = %(user_id)s AND sr.status = 'pending'
+           ) AS request_sent
+    FROM books b
+    CROSS JOIN LATERAL (
+        SELECT count(*) AS review_count, max(updated_at) AS reviews_updated_at,
+               max(review_id) AS last_review_id
+        FROM reviews WHERE book_id = b.book_id
+    ) r
+    WHERE b.book_id = %(book_id)s
+""")
+
+BOOK = statement('book', """
+    SELECT b.*, u.name as owner_name
+    FROM books b
+    JOIN users u ON b.user_id = u.user_id
+    WHERE b.book_id = %(book_id)s
+""")
+
+BOOK_REVIEWS = statement('book_reviews', """
+    SELECT r.*, u.name as reviewer_name
+    FROM reviews r
+    JOIN users u ON r.reviewer_id = u.user_id
+    WHERE r.book_id = %(book_id)s
+    ORDER BY r.created_at DESC
+    LIMIT %(limit)s
+""")
+
+
+# -----------------------------
+# Swap and Return Requests
+# -----------------------------
+# Both sides of the inbox, and the open swap circles (swap_matcher.py) this
+# user is in, in one round trip. `side` tells the rows apart; the other
+# party's name and id share a column, and unread_messages flags requests
+# whose conversation has messages past this user's read marker. The circles
+# come as one row whose `cycles` holds every offer: the book the user gets,
+# the one they give, and how many members have accepted so far.
+SWAP_REQUEST_LISTS = statement('swap_request_lists', """
+    SELECT 'received' AS side, sr.request_id, b.book_id, b.title, u.name AS other_name, sr.status,
+           sr.sender_id AS other_id,
+           EXISTS(
+               SELECT 1 FROM conversations c
+               JOIN conversation_members cm ON cm.conversation_id = c.conversation_id AND cm.user_id = %(user_id)s
+               WHERE c.request_kind = 'swap' AND c.request_id = sr.request_id
+               AND c.last_message_id > cm.last_read_message_id
+           ) AS unread_messages,
+           NULL::jsonb AS cycles
+    FROM swap_requests sr
+    JOIN books b ON sr.book_id = b.book_id
+    JOIN users u ON sr.sender_id = u.user_id
+    WHERE sr.receiver_id=%(user_id)s
+    UNION ALL
+    SELECT 'sent', sr.request_id, b.book_id, b.title, u.name, sr.status, sr.receiver_id,
+           EXISTS(
+               SELECT 1 FROM conversations c
+               JOIN conversation_members cm ON cm.conversation_id = c.conversation_id AND cm.user_id = %(user_id)s
+               WHERE c.request_kind = 'swap' AND c.request_id = sr.request_id
+               AND c.last_message_id > cm.last_read_message_id
+           ),
+           NULL
+    FROM swap_requests sr
+    JOIN books b ON sr.book_id = b.book_id
+    JOIN users u ON sr.receiver_id = u.user_id
+    WHERE sr.sender_id=%(user_id)s
+    UNION ALL
+    SELECT 'cycles', NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+           jsonb_agg(to_jsonb(offer) - 'created_at' ORDER BY offer.created_at, offer.cycle_id)
+    FROM (
+        SELECT c.cycle_id, c.created_at, c.expires_at, m.accepted_at,
+               gets.title AS gets_title, giver.name AS gets_from,
+               gives.title AS gives_title, taker.name AS gives_to,
+               counts.members, counts.accepted
+        FROM swap_cycle_members m
+        JOIN swap_cycles c ON c.cycle_id = m.cycle_id
+        JOIN books gets ON gets.book_id = m.book_id
+        JOIN users giver ON giver.user_id = gets.user_id
+        JOIN swap_cycle_members recipient ON recipient.cycle_id = m.cycle_id
+        JOIN books gives ON gives.book_id = recipient.book_id AND gives.user_id = m.user_id
+        JOIN users taker ON taker.user_id = recipient.user_id
+        CROSS JOIN LATERAL (
+            SELECT count(*) AS members, count(x.accepted_at) AS accepted
+            FROM swap_cycle_members x WHERE x.cycle_id = m.cycle_id
+        ) counts
+        WHERE m.user_id = %(user_id)s AND c.status = 'offered'
+    ) offer
+    HAVING count(*) > 0
+""")
+
+
+def _swap_request_row(row):
+    """A SWAP_REQUEST_LISTS row with the same keys the two queries used to return"""
+    row = dict(row)
+    side, name, other_id = row.pop('side'), row.pop('other_name'), row.pop('other_id')
+    del row['cycles']
+    if side == 'received':
+        return dict(row, sender_name=name, sender_id=other_id)
+    return dict(row, receiver_name=name, receiver_id=other_id)
+
+
+def swap_request_lists(cursor, user_id):
+    """(received, sent, cycles): swap requests and open swap circle offers"""
+    received, sent, cycles = [], [], []
+    for row in fetch_all(cursor, SWAP_REQUEST_LISTS, user_id=user_id):
+        if row['side'] == 'cycles':
+            cycles = row['cycles']
+        else:
+            (received if row['side'] == 'received' else sent).append(_swap_request_row(row))
+    return received, sent, cycles
+
+
+def swap_request_streams(conn, user_id, itersize):
+    """(received, sent, cycles) as in swap_request_lists, the requests as
+    RowStreams, one server-side cursor per side; the few circle offers are
+    read straight away"""
+    received, sent = (RowStream(conn, _side_sql(SWAP_REQUEST_LISTS), {'user_id': user_id, 'side': side}, itersize,
+                                transform=_swap_request_row)
+                      for side in ('received', 'sent'))
+    cursor = conn.cursor()
+    cursor.execute("SELECT cycles FROM (" + _side_sql(SWAP_REQUEST_LISTS) + ") offers",
+                   {'user_id': user_id, 'side': 'cycles'})
+    row = cursor.fetchone()
+    cursor.close()
+    return received, sent, row[0] if row else []
+
+
+# Return requests I sent (as book owner) and received (as current holder),
+# newest first on each side, in one round trip, with unread_messages as in
+# SWAP_REQUEST_LISTS
+RETURN_REQUEST_LISTS = statement('return_request_lists', """
+    SELECT * FROM (
+        SELECT 'sent' AS side, rr.*, b.title, b.author, u.name AS other_name,
+               EXISTS(
+                   SELECT 1 FROM reviews r
+                   WHERE r.book_id = rr.book_id
+                   AND r.reviewer_id = rr.holder_id
+               ) AS reviewed,
+               EXISTS(
+                   SELECT 1 FROM conversations c
+                   JOIN conversation_members cm ON cm.conversation_id = c.conversation_id AND cm.user_id = %(user_id)s
+                   WHERE c.request_kind = 'return' AND c.request_id = rr.return_request_id
+                   AND c.last_message_id > cm.last_read_message_id
+               ) AS unread_messages
+        FROM return_requests rr
+        JOIN books b ON rr.book_id = b.book_id
+        JOIN users u ON rr.holder_id = u.user_id
+        WHERE rr.owner_id = %(user_id)s
+        UNION ALL
+        SELECT 'received', rr.*, b.title, b.author, u.name,
+               EXISTS(
+                   SELECT 1 FROM reviews r
+                   WHERE r.book_id = rr.book_id
+                   AND r.reviewer_id = %(user_id)s
+               ),
+               EXISTS(
+                   SELECT 1 FROM conversations c
+                   JOIN conversation_members cm ON cm.conversation_id = c.conversation_id AND cm.user_id = %(user_id)s
+                   WHERE c.request_kind = 'return' AND c.request_id = rr.return_request_id
+                   AND c.last_message_id > cm.last_read_message_id
+               )
+        FROM return_requests rr
+        JOIN books b ON rr.book_id = b.book_id
+        JOIN users u ON rr.owner_id = u.user_id
+        WHERE rr.holder_id = %(user_id)s
+    ) lists
+    ORDER BY side, created_at DESC
+""")
+
+
+def _return_request_row(row):
+    """A RETURN_REQUEST_LISTS row with the keys the templates expect"""
+    row = dict(row)
+    side, name, reviewed = row.pop('side'), row.pop('other_name'), row.pop('reviewed')
+    if side == 'sent':
+        return dict(row, holder_name=name, holder_reviewed=reviewed)
+    return dict(row, owner_name=name, review_given=reviewed)
+
+
+def return_request_lists(cursor, user_id):
+    """(sent, received) return requests"""
+    sent, received = [], []
+    for row in fetch_all(cursor, RETURN_REQUEST_LISTS, user_id=user_id):
+        (sent if row['side'] == 'sent' else received).append(_return_request_row(row))
+    return sent, received
+
+
+def return_request_streams(conn, user_id, itersize):
+    """(sent, received) return requests as RowStreams, one server-side cursor per side"""
+    return tuple(RowStream(conn, _side_sql(RETURN_REQUEST_LISTS), {'user_id': user_id, 'side': side}, itersize,
+                           transform=_return_request_row)
+                 for side in ('sent', 'received'))
+
+
+# -----------------------------
+# Notifications
+# -----------------------------
+NOTIFICATIONS = statement('notifications', """
+    SELECT * FROM notifications
+    WHERE user_id=%(user_id)s
+    ORDER BY created_at DESC, notification_id DESC
+    LIMIT %(limit)s
+""")
+
+NOTIFICATIONS_AFTER = statement('notifications_after', """
+    SELECT * FROM notifications
+    WHERE user_id=%(user_id)s AND (created_at, notification_id) < (%(created_at)s, %(notification_id)s)
+    ORDER BY created_at DESC, notification_id DESC
+    LIMIT %(limit)s
+""")
+
+
+# -----------------------------
+# Messages
+# -----------------------------
+# The two people on a request, and the book it is about
+MESSAGE_PARTIES = {
+    'swap': statement('swap_request_parties', """
+        SELECT sr.sender_id AS first_id, first_user.name AS first_name,
+               sr.receiver_id AS second_id, second_user.name AS second_name, b.title
+        FROM swap_requests sr
+        JOIN users first_user ON first_user.user_id = sr.sender_id
+        JOIN users second_user ON second_user.user_id = sr.receiver_id
+        JOIN books b ON b.book_id = sr.book_id
+        WHERE sr.request_id = %(request_id)s
+    """),
+    'return': statement('return_request_parties', """
+        SELECT rr.owner_id AS first_id, first_user.name AS first_name,
+               rr.holder_id AS second_id, second_user.name AS second_name, b.title
+        FROM return_requests rr
+        JOIN users first_user ON first_user.user_id = rr.owner_id
+        JOIN users second_user ON second_user.user_id = rr.holder_id
+        JOIN books b ON b.book_id = rr.book_id
+        WHERE rr.return_request_id = %(request_id)s
+    """),
+}
+
+CONVERSATION = statement('conversation', """
+    SELECT c.conversation_id, c.last_message_id, m.last_read_message_id
+    FROM conversations c
+    JOIN conversation_members m ON m.conversation_id = c.conversation_id AND m.user_id = %(user_id)s
+    WHERE c.request_kind = %(kind)s AND c.request_id = %(request_id)s
+""")
+
+# Newest first; each page is an index-only scan of messages_thread_idx
+MESSAGE_THREAD = statement('message_thread', """
+    SELECT message_id, sender_id, body, created_at
+    FROM messages
+    WHERE conversation_id = %(conversation_id)s
+    ORDER BY message_id DESC
+    LIMIT %(limit)s
+""")
+
+MESSAGE_THREAD_BEFORE = statement('message_thread_before', """
+    SELECT message_id, sender_id, body, created_at
+    FROM messages
+    WHERE conversation_id = %(conversation_id)s AND message_id < %(before)s
+    ORDER BY message_id DESC
+    LIMIT %(limit)s
+""")
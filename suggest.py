@@ -0,0 +1,298 @@
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+import unicodedata
+from datetime import datetime, timedelta
+
+import psycopg2
+import psycopg2.extensions
+from flask import current_app
+
+import db
+
+log = logging.getLogger(__name__)
+
+# Words of a title or author that suggestions can start at ("potter" finds
+# "Harry Potter"); later words are only reachable from an earlier one
+MAX_WORDS = 8
+
+# Keys keep this many characters; longer queries match on their start
+KEY_CHARS = 32
+
+# Entries looked at per query, however common the prefix, so a worst case
+# (say, the asker's own books filling a whole range) stays bounded
+MAX_SCAN = 500
+
+
+def normalize(text):
+    """Case- and accent-insensitive form used for keys and queries"""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ' '.join(''.join(ch for ch in text if not unicodedata.combining(ch)).casefold().split())
+
+
+def _keys(title, author):
+    keys = set()
+    for text in (title, author):
+        words = normalize(text).split(' ')
+        for i in range(min(len(words), MAX_WORDS)):
+            keys.add(' '.join(words[i:])[:KEY_CHARS])
+    keys.discard('')
+    return keys
+
+
+# -----------------------------
+# Prefix Index
+# -----------------------------
+class SuggestIndex:
+    """Prefix index over the titles and authors of available books.
+
+    Every word-start suffix of a book's title and author is a key; keys and
+    their book ids sit in two parallel lists sorted by key, so a query is a
+    binary search for its prefix followed by a short forward scan, tens of
+    microseconds. Adding or removing a book shifts the tails of the lists,
+    a few milliseconds per book at 100k books: fine for how often books
+    change, and much cheaper than a rebuild. One lock covers both.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._ids = []
+        self._books = {}  # book_id -> (user_id, title, author, keys)
+        self._object_bytes = 0
+        self.loaded = threading.Event()
+
+    @staticmethod
+    def _book_bytes(book_id, entry):
+        user_id, title, author, keys = entry
+        return (sys.getsizeof(entry) + sys.getsizeof(book_id) + sys.getsizeof(title) + sys.getsizeof(author)
+                + sys.getsizeof(keys) + sum(sys.getsizeof(key) for key in keys))
+
+    def _insert(self, book_id, user_id, title, author):
+        entry = (user_id, title, author, tuple(_keys(title, author)))
+        for key in entry[3]:
+            i = bisect.bisect_right(self._keys, key)
+            self._keys.insert(i, key)
+            self._ids.insert(i, book_id)
+        self._books[book_id] = entry
+        self._object_bytes += self._book_bytes(book_id, entry)
+
+    def _remove(self, book_id):
+        entry = self._books.pop(book_id, None)
+        if entry is None:
+            return
+        for key in entry[3]:
+            i = bisect.bisect_left(self._keys, key)
+            while self._ids[i] != book_id:
+                i += 1
+            del self._keys[i]
+            del self._ids[i]
+        self._object_bytes -= self._book_bytes(book_id, entry)
+
+    def replace_all(self, rows):
+        """Index exactly these (book_id, user_id, title, author) rows"""
+        books, keys, ids, object_bytes = {}, [], [], 0
+        for book_id, user_id, title, author in rows:
+            entry = (user_id, title, author, tuple(_keys(title, author)))
+            books[book_id] = entry
+            object_bytes += self._book_bytes(book_id, entry)
+            for key in entry[3]:
+                keys.append((key, book_id))
+        keys.sort()
+        ids = [book_id for _, book_id in keys]
+        keys = [key for key, _ in keys]
+        with self._lock:
+            self._keys, self._ids, self._books, self._object_bytes = keys, ids, books, object_bytes
+        self.loaded.set()
+
+    def add(self, book_id, user_id, title, author):
+        """Index an available book, replacing what was indexed for it before"""
+        with self._lock:
+            entry = self._books.get(book_id)
+            if entry is not None and entry[:3] == (user_id, title, author):
+                return
+            self._remove(book_id)
+            self._insert(book_id, user_id, title, author)
+
+    def discard(self, book_ids):
+        """Drop books that are no longer available"""
+        with self._lock:
+            for book_id in book_ids:
+                self._remove(book_id)
+
+    def search(self, prefix, limit=8, exclude_user=None):
+        """[{book_id, title, author}] of books whose title or author has a word
+        starting with `prefix`, in key order; the asker's own books are left out"""
+        prefix = normalize(prefix)[:KEY_CHARS]
+        if not prefix:
+            return []
+        found, seen = [], set()
+        with self._lock:
+            i = bisect.bisect_left(self._keys, prefix)
+            end = min(len(self._keys), i + MAX_SCAN)
+            while i < end and len(found) < limit and self._keys[i].startswith(prefix):
+                book_id = self._ids[i]
+                i += 1
+                if book_id in seen:
+                    continue
+                seen.add(book_id)
+                user_id, title, author, _ = self._books[book_id]
+                if user_id != exclude_user:
+                    found.append({'book_id': book_id, 'title': title, 'author': author})
+        return found
+
+    def stats(self):
+        """Sizes for /metrics; memory_bytes counts the lists, the dict and the
+        strings and tuples they hold (interned and shared objects once each)"""
+        with self._lock:
+            memory = (sys.getsizeof(self._keys) + sys.getsizeof(self._ids) + sys.getsizeof(self._books)
+                      + self._object_bytes)
+            return {'books': len(self._books), 'keys': len(self._keys), 'memory_bytes': memory}
+
+
+# -----------------------------
+# Loading and Refresh
+# -----------------------------
+def _full_load(conn, index):
+    """Index every available book from one scan; returns the newest updated_at it saw"""
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    try:
+        cursor = conn.cursor('suggest_load')
+        cursor.itersize = 10000
+        started = time.perf_counter()
+        cursor.execute("SELECT book_id, user_id, title, author FROM books WHERE status = 'available'")
+        index.replace_all(cursor)
+        cursor.close()
+        cursor = conn.cursor()
+        cursor.execute("SELECT max(updated_at) FROM books")
+        newest = cursor.fetchone()[0] or datetime(1970, 1, 1)
+        stats = index.stats()
+        log.info("suggest index: %d books, %d keys, %.1f MiB, built in %.2fs", stats['books'], stats['keys'],
+                 stats['memory_bytes'] / 2 ** 20, time.perf_counter() - started)
+        return newest
+    finally:
+        conn.rollback()
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+
+
+def _sync(conn, index, since, overlap):
+    """Apply books changed since `since` (by any worker); returns the new high-water mark.
+
+    New rows carry their transaction's start time, so one that commits late
+    can land behind the mark; re-reading the last `overlap` seconds catches
+    those, and applying a change twice is harmless.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT book_id, user_id, title, author, status, updated_at FROM books
+            WHERE updated_at > %s
+            ORDER BY updated_at
+        """, (since - timedelta(seconds=overlap),))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.rollback()
+    for book_id, user_id, title, author, status, updated_at in rows:
+        if status == 'available':
+            index.add(book_id, user_id, title, author)
+        else:
+            index.discard([book_id])
+        since = max(since, updated_at)
+    return since
+
+
+class Loader:
+    """Builds a worker's index from one bulk scan, then keeps it in step with
+    changes made by other workers and by bulk imports, polling
+    books.updated_at every `interval` seconds (or when woken). Changes this
+    worker makes are applied straight away by the routes that make them."""
+
+    def __init__(self, index, connect_kwargs, interval=30.0, overlap=60.0):
+        self.index = index
+        self._connect_kwargs = connect_kwargs
+        self.interval = interval
+        self.overlap = overlap
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='suggest-loader', daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        """Sync now rather than at the next interval"""
+        self._wake.set()
+
+    def _run(self):
+        since = None
+        backoff = 1
+        while True:
+            try:
+                conn = psycopg2.connect(**self._connect_kwargs)
+                try:
+                    if since is None:
+                        since = _full_load(conn, self.index)
+                    backoff = 1
+                    while True:
+                        self._wake.wait(self.interval)
+                        self._wake.clear()
+                        since = _sync(conn, self.index, since, self.overlap)
+                finally:
+                    conn.close()
+            except (psycopg2.Error, OSError):
+                log.exception("Suggest index lost its connection; retrying in %ss", backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+
+_index = None
+_loader = None
+_index_pid = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Return this worker's index, starting its loader on first use (and after a fork)"""
+    global _index, _loader, _index_pid
+    if _index is None or _index_pid != os.getpid():
+        with _index_lock:
+            if _index is None or _index_pid != os.getpid():
+                _index = SuggestIndex()
+                _loader = Loader(_index, db.connect_kwargs(current_app.config),
+                                 interval=current_app.config['SUGGEST_REFRESH_SECONDS'])
+                _index_pid = os.getpid()
+    return _index
+
+
+def request_sync():
+    """Have the loader pick up changes now, e.g. after a bulk import"""
+    get_index()
+    _loader.wake()
+
+
+def render_metrics():
+    """Prometheus lines for this worker's index, if it has been started"""
+    if _index is None or _index_pid != os.getpid():
+        return ''
+    stats = _index.stats()
+    lines = []
+    for name, key, help in (('bookswap_suggest_books', 'books', 'Available books in the suggest index.'),
+                            ('bookswap_suggest_keys', 'keys', 'Prefix keys in the suggest index.'),
+                            ('bookswap_suggest_memory_bytes', 'memory_bytes', 'Approximate suggest index size.')):
+        lines.extend(['# HELP %s %s' % (name, help), '# TYPE %s gauge' % name, '%s %d' % (name, stats[key])])
+    lines.extend(['# HELP bookswap_suggest_ready Whether the initial load has finished.',
+                  '# TYPE bookswap_suggest_ready gauge',
+                  'bookswap_suggest_ready %d' % _index.loaded.is_set()])
+    return '\n'.join(lines) + '\n'
+
+
+def _start():
+    get_index()
+
+
+def init_app(app):
+    app.config.setdefault('SUGGEST_LIMIT', 8)
+    app.config.setdefault('SUGGEST_REFRESH_SECONDS', float(os.environ.get('SUGGEST_REFRESH_SECONDS', 30)))
+    # Start building on a worker's first request, not at import (which CLI commands share)
+    app.before_request(_start)
@@ -0,0 +1,203 @@
+import logging
+
+import psycopg2.extras
+
+import outbox_worker
+
+log = logging.getLogger(__name__)
+
+# Matching and offer expiry run one at a time (arbitrary key)
+ADVISORY_LOCK_KEY = 7438203
+
+# A pending edge the matcher may use: not for a book already promised in an
+# open offer, and not one its sender turned down in an earlier circle
+_USABLE = """
+    sr.status = 'pending'
+    AND NOT EXISTS (
+        SELECT 1 FROM swap_cycle_members m JOIN swap_cycles c ON c.cycle_id = m.cycle_id
+        WHERE m.book_id = sr.book_id AND c.status = 'offered'
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM swap_cycle_members m
+        WHERE m.request_id = sr.request_id AND m.declined_at IS NOT NULL
+    )
+"""
+
+
+# -----------------------------
+# Cycle Search
+# -----------------------------
+def _hops(cursor, users, forward, limit):
+    """Usable edges out of (forward) or into the given users, one per user pair"""
+    near, far = ('sender_id', 'receiver_id') if forward else ('receiver_id', 'sender_id')
+    cursor.execute("""
+        SELECT DISTINCT ON (sr.{near}, sr.{far}) sr.request_id, sr.book_id, sr.sender_id, sr.receiver_id
+        FROM swap_requests sr
+        WHERE sr.{near} = ANY(%s) AND {usable}
+        ORDER BY sr.{near}, sr.{far}, sr.request_id
+        LIMIT %s
+    """.format(near=near, far=far, usable=_USABLE), (list(users), limit))
+    return cursor.fetchall()
+
+
+def _meet(edge, forward, backward):
+    """Shortest simple cycle edge + (receiver ~> m) + (m ~> sender) over the meeting users m"""
+    best = None
+    for user in forward.keys() & backward.keys():
+        path = [edge] + forward[user] + backward[user]
+        if len({e['sender_id'] for e in path}) == len(path) and (best is None or len(path) < len(best)):
+            best = path
+    return best
+
+
+def find_cycle(cursor, edge, max_length=4, max_frontier=1000):
+    """Shortest cycle of usable requests through `edge` (a swap_requests row),
+    at most max_length long, as a list of rows in order; None if there is none.
+
+    Bidirectional breadth-first search: paths out of the edge's receiver grow
+    forward and paths into its sender grow backward, always widening the
+    smaller side, until they meet. Only the few hops around the new edge are
+    read, each through an index on the pending requests, so the cost doesn't
+    grow with the size of the whole graph; max_frontier bounds the work
+    around very popular users.
+    """
+    forward = {edge['receiver_id']: []}   # user -> edges from the receiver to them
+    backward = {edge['sender_id']: []}    # user -> edges from them to the sender
+    forward_frontier, backward_frontier = [edge['receiver_id']], [edge['sender_id']]
+    length = 1
+    while True:
+        cycle = _meet(edge, forward, backward)
+        if cycle:
+            return cycle
+        if length >= max_length or not forward_frontier or not backward_frontier:
+            return None
+        grow_forward = len(forward_frontier) <= len(backward_frontier)
+        paths, frontier = (forward, forward_frontier) if grow_forward else (backward, backward_frontier)
+        grown = []
+        for hop in _hops(cursor, frontier, grow_forward, max_frontier):
+            if hop['request_id'] == edge['request_id']:
+                continue
+            if grow_forward:
+                here, there = hop['sender_id'], hop['receiver_id']
+                path = paths[here] + [hop]
+            else:
+                here, there = hop['receiver_id'], hop['sender_id']
+                path = [hop] + paths[here]
+            if there not in paths:
+                paths[there] = path
+                grown.append(there)
+        if grow_forward:
+            forward_frontier = grown
+        else:
+            backward_frontier = grown
+        length += 1
+
+
+# -----------------------------
+# Offers
+# -----------------------------
+def _offer(cursor, cycle, ttl_hours):
+    cursor.execute("INSERT INTO swap_cycles (expires_at) VALUES (now() + %s * interval '1 hour') RETURNING cycle_id",
+                   (ttl_hours,))
+    cycle_id = cursor.fetchone()['cycle_id']
+    psycopg2.extras.execute_values(cursor,
+        "INSERT INTO swap_cycle_members (cycle_id, request_id, user_id, book_id) VALUES %s",
+        [(cycle_id, e['request_id'], e['sender_id'], e['book_id']) for e in cycle], page_size=len(cycle))
+    outbox_worker.enqueue(cursor, [
+        (e['sender_id'], 'swap_request',
+         f'A {len(cycle)}-way swap circle can get you a book you asked for. Review it on your Swap Requests page.',
+         f'swap_cycle_offered:{cycle_id}:{e["sender_id"]}') for e in cycle])
+    return cycle_id
+
+
+def requeue(cursor, request_ids):
+    """Put requests back in front of the matcher, e.g. when the circle they were in fell through"""
+    if request_ids:
+        cursor.execute("""
+            INSERT INTO swap_match_queue (request_id)
+            SELECT request_id FROM swap_requests
+            WHERE request_id = ANY(%s) AND status = 'pending'
+            ORDER BY request_id
+            ON CONFLICT (request_id) DO NOTHING
+        """, (list(request_ids),))
+
+
+def expire_offers(cursor):
+    """Close offers past their deadline or with a request that's no longer pending (or gone).
+    Members who never accepted an expired offer are treated as declining it."""
+    cursor.execute("""
+        UPDATE swap_cycles c
+        SET status = CASE WHEN c.expires_at < now() THEN 'expired' ELSE 'cancelled' END
+        WHERE c.status = 'offered'
+          AND (c.expires_at < now() OR EXISTS (
+              SELECT 1 FROM swap_cycle_members m
+              WHERE m.cycle_id = c.cycle_id
+                AND NOT EXISTS (SELECT 1 FROM swap_requests sr WHERE sr.request_id = m.request_id AND sr.status = 'pending')
+          ))
+        RETURNING c.cycle_id, c.status
+    """)
+    closed = cursor.fetchall()
+    expired = [row['cycle_id'] for row in closed if row['status'] == 'expired']
+    if expired:
+        cursor.execute("""
+            UPDATE swap_cycle_members SET declined_at = now()
+            WHERE cycle_id = ANY(%s) AND accepted_at IS NULL
+        """, (expired,))
+    if closed:
+        cursor.execute("SELECT request_id FROM swap_cycle_members WHERE cycle_id = ANY(%s)",
+                       ([row['cycle_id'] for row in closed],))
+        requeue(cursor, [row['request_id'] for row in cursor.fetchall()])
+    return len(closed)
+
+
+def process_queue(conn, batch_size=200, max_length=4, max_frontier=1000, ttl_hours=48):
+    """Close stale offers, then look for cycles through every queued request.
+    Returns (requests scanned, cycles offered), or None if another matcher holds the lock."""
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cursor.execute("SELECT pg_try_advisory_lock(%s) AS locked", (ADVISORY_LOCK_KEY,))
+    locked = cursor.fetchone()['locked']
+    conn.commit()
+    if not locked:
+        cursor.close()
+        return None
+    scanned = offered = 0
+    try:
+        expire_offers(cursor)
+        conn.commit()
+        while True:
+            cursor.execute("""
+                DELETE FROM swap_match_queue
+                WHERE request_id IN (
+                    SELECT request_id FROM swap_match_queue
+                    ORDER BY queued_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING request_id
+            """, (batch_size,))
+            request_ids = [row['request_id'] for row in cursor.fetchall()]
+            if not request_ids:
+                conn.commit()
+                break
+            for request_id in request_ids:
+                # Re-read each time: an offer made earlier in this batch may have used it
+                cursor.execute("SELECT sr.request_id, sr.book_id, sr.sender_id, sr.receiver_id "
+                               "FROM swap_requests sr WHERE sr.request_id = %s AND " + _USABLE, (request_id,))
+                edge = cursor.fetchone()
+                if edge is None or edge['sender_id'] == edge['receiver_id']:
+                    continue
+                cycle = find_cycle(cursor, edge, max_length, max_frontier)
+                if cycle:
+                    cycle_id = _offer(cursor, cycle, ttl_hours)
+                    log.info("offered swap cycle %d with %d members", cycle_id, len(cycle))
+                    offered += 1
+            conn.commit()
+            scanned += len(request_ids)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+        conn.commit()
+        cursor.close()
+    return scanned, offered
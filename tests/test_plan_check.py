@@ -0,0 +1,26 @@
+"""Every route query must be index-driven. Needs a database with data.sql loaded:
+DATABASE_URL=postgresql://localhost/book_exchange python -m pytest tests"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason="DATABASE_URL is not set")
+
+
+@pytest.fixture
+def conn():
+    import migrate
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    migrate.apply_migrations(conn, log=lambda message: None)
+    yield conn
+    conn.close()
+
+
+def test_route_queries_use_indexes(conn):
+    import plan_check
+    assert plan_check.find_seq_scans(conn) == {}